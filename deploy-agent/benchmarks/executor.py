@@ -0,0 +1,79 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the per stage overhead of Executor.run_cmd on no-op scripts.
+
+The overhead is the time run_cmd takes minus the time of a bare
+subprocess.run of the same command. Run it from deploy-agent with:
+
+    python -m benchmarks.executor --stages 50
+"""
+
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from deployd.common.executor import Executor
+
+
+def make_executor(log_fn) -> Executor:
+    executor = Executor(callback=lambda deploy_report: None)
+    executor.LOG_FILENAME = log_fn
+    executor.MAX_RUNNING_TIME = 60
+    executor.MIN_RUNNING_TIME = 30
+    executor.MAX_RETRY = 1
+    executor.MAX_TAIL_BYTES = 10240
+    executor.PROCESS_POLL_INTERVAL = 2
+    executor.BACK_OFF = 2
+    executor.MAX_SLEEP_INTERVAL = 60
+    return executor
+
+
+def time_stages(run, cmd, stages) -> float:
+    start = time.time()
+    for _ in range(stages):
+        run(cmd)
+    return (time.time() - start) / stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--stages", type=int, default=50)
+    args = parser.parse_args()
+
+    fd, log_fn = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        executor = make_executor(log_fn)
+        # warm up, the first fork and log open are not per stage costs
+        time_stages(executor.run_cmd, ["true"], 3)
+        for cmd in (["true"], ["sleep", "0.2"]):
+            bare = time_stages(subprocess.run, cmd, args.stages)
+            supervised = time_stages(executor.run_cmd, cmd, args.stages)
+            print(
+                "{:>10}: subprocess {:.1f}ms, run_cmd {:.1f}ms, overhead {:.1f}ms".format(
+                    " ".join(cmd),
+                    bare * 1000,
+                    supervised * 1000,
+                    (supervised - bare) * 1000,
+                )
+            )
+    finally:
+        os.remove(log_fn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare TarFile.extractall with ParallelExtractor on many small files.
+
+Run it from deploy-agent, with --dir on the filesystem of the builds directory:
+
+    python -m benchmarks.extractor --files 20000 --workers 1 4 8
+"""
+
+import argparse
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+from deployd.download.extractor import ParallelExtractor
+
+
+def build_archive(path, files, size) -> None:
+    """Write a node_modules like tarball of files small files"""
+    data = b"x" * size
+    with tarfile.open(path, "w:gz") as tfile:
+        for i in range(files):
+            info = tarfile.TarInfo("pkg/node_modules/m{}/f{}.js".format(i // 20, i))
+            info.size = size
+            info.mode = 0o644
+            tfile.addfile(info, io.BytesIO(data))
+
+
+def extract(archive_fn, dest, workers) -> float:
+    start = time.time()
+    with tarfile.open(archive_fn) as tfile:
+        if workers:
+            ParallelExtractor(workers).extract_tar(tfile, dest)
+        else:
+            tfile.extractall(dest)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=512, help="bytes per file")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--dir", default=None, help="scratch directory")
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        archive_fn = os.path.join(base_dir, "package.tar.gz")
+        build_archive(archive_fn, args.files, args.size)
+        print("{} files of {} bytes".format(args.files, args.size))
+        # 0 workers is the current TarFile.extractall path
+        for workers in [0] + args.workers:
+            timings = []
+            for i in range(args.rounds):
+                # a fresh directory every round, extracting over a tree that
+                # is still being removed measures the removal
+                dest = os.path.join(base_dir, "dest-{}-{}".format(workers, i))
+                timings.append(extract(archive_fn, dest, workers))
+            label = "extractall" if not workers else "{} workers".format(workers)
+            print("{:>12}: best {:.3f}s".format(label, min(timings)))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    main()
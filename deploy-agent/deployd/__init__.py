@@ -22,6 +22,21 @@ METRIC_PORT_HEALTH = (
     else None
 )
 METRIC_CACHE_PATH = os.getenv("METRIC_CACHE_PATH", None)
+# metrics are queued and sent in batches by a background thread
+METRIC_QUEUE_SIZE = int(os.getenv("METRIC_QUEUE_SIZE", "10000"))
+METRIC_FLUSH_INTERVAL_MS = int(os.getenv("METRIC_FLUSH_INTERVAL_MS", "500"))
+# cached metrics are replayed by a background thread, at most this many per second
+METRIC_REPLAY_RATE = int(os.getenv("METRIC_REPLAY_RATE", "500"))
+# comma separated name patterns of the counters and timings aggregated on the
+# host over a window, timings are then sent as percentiles. Empty, the
+# default, sends every timing as is, see agent.conf
+METRIC_AGGREGATION = os.getenv("METRIC_AGGREGATION", "")
+# name patterns of the counters summed over the window, they keep their name
+METRIC_COUNTER_AGGREGATION = os.getenv("METRIC_COUNTER_AGGREGATION", "*")
+METRIC_AGGREGATION_WINDOW_SEC = int(os.getenv("METRIC_AGGREGATION_WINDOW_SEC", "60"))
+# statsd address counters of more than one are sent to as a single name:N|c
+# packet, sc.increment can only count one
+METRIC_STATSD_ADDR = os.getenv("METRIC_STATSD_ADDR", "127.0.0.1:8125")
 TELEFIG_BINARY = os.getenv("TELEFIG_BINARY", None)
 MAIN_LOGGER = "deployd"
 STATSBOARD_URL = os.getenv("STATSBOARD_URL", "https://statsboard.pinadmin.com/api/v1/")
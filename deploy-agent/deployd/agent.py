@@ -14,25 +14,26 @@
 
 import argparse
 from typing import List, Optional, Union
-import daemon
 import logging
 import os
 import sys
-from random import randrange
+from random import randrange, uniform
 import time
 import traceback
 
 from deployd.client.client import Client
 from deployd.client.serverless_client import ServerlessClient
 from deployd.common.config import Config
+from deployd.concurrent_deploy import ConcurrentDeploy
 from deployd.common.exceptions import AgentException
 from deployd.common.helper import Helper
-from deployd.common.env_status import EnvStatus
+from deployd.common.build_gc import BuildCollector
+from deployd.common.env_status import create_env_status
+from deployd.common.health_snapshot import HealthSnapshot
 from deployd.common.single_instance import SingleInstance
 from deployd.common.stats import TimeElapsed, create_sc_timing, create_sc_increment
 from deployd.common.utils import (
     get_telefig_version,
-    get_container_health_info,
     check_prereqs,
 )
 from deployd.common.utils import uptime as utils_uptime, listen as utils_listen
@@ -87,10 +88,12 @@ class DeployAgent(object):
         self.stat_stage_time_elapsed = None
         self.deploy_goal_previous = None
         self._first_run = False
+        self._long_poll = False
         self._helper = helper or Helper(self._config)
+        self._build_collector = BuildCollector(self._config.get_builds_directory())
         self._STATUS_FILE = self._config.get_env_status_fn()
         self._client = client
-        self._env_status = estatus or EnvStatus(self._STATUS_FILE)
+        self._env_status = estatus or create_env_status(self._config)
         # load environment deploy status file from local disk
         self.load_status_file()
         self._telefig_version = get_telefig_version()
@@ -116,17 +119,18 @@ class DeployAgent(object):
             self._first_run = True
         return self._first_run
 
-    def _send_deploy_status_stats(self, deploy_report) -> None:
-        if not self._response.deployGoal or not deploy_report:
+    def _send_deploy_status_stats(self, deploy_report, deploy_goal=None) -> None:
+        deploy_goal = deploy_goal or self._response.deployGoal
+        if not deploy_goal or not deploy_report:
             return
 
         tags = {"first_run": self.first_run}
-        if self._response.deployGoal.deployStage:
-            tags["deploy_stage"] = self._response.deployGoal.deployStage
-        if self._response.deployGoal.envName:
-            tags["env_name"] = self._response.deployGoal.envName
-        if self._response.deployGoal.stageName:
-            tags["stage_name"] = self._response.deployGoal.stageName
+        if deploy_goal.deployStage:
+            tags["deploy_stage"] = deploy_goal.deployStage
+        if deploy_goal.envName:
+            tags["env_name"] = deploy_goal.envName
+        if deploy_goal.stageName:
+            tags["stage_name"] = deploy_goal.stageName
         if deploy_report.status_code:
             tags["status_code"] = deploy_report.status_code
         if self._telefig_version:
@@ -141,13 +145,21 @@ class DeployAgent(object):
             self._executor = Executor(callback=PingServer(self), config=self._config)
         # include healthStatus info for each container
         if len(self._envs) > 0:
+            health = HealthSnapshot(
+                self._config.get_docker_socket(),
+                timeout=self._config.get_health_check_timeout(),
+            )
+            try:
+                health.take(self._envs.values())
+            except Exception:
+                log.exception("Failed to take the health snapshot")
             for status in self._envs.values():
                 # for each service, we check the container health status
                 log.info(f"the current service is: {status.report.envName}")
                 try:
                     if status.report.redeploy is None:
                         status.report.redeploy = 0
-                    healthStatus = get_container_health_info(
+                    healthStatus = health.get_container_health_info(
                         status.build_info.build_commit,
                         status.report.envName,
                         status.report.redeploy,
@@ -184,14 +196,18 @@ class DeployAgent(object):
                     )
                     continue
             self._env_status.dump_envs(self._envs)
+
+        concurrent_envs = self._config.get_max_concurrent_envs()
+        if concurrent_envs > 1 and not isinstance(self._client, ServerlessClient):
+            ConcurrentDeploy(self, concurrent_envs).run()
+            return
+
         # start to ping server to get the latest deploy goal
-        self._response = self._client.send_reports(self._envs)
-        # we only need to send RESET once in one deploy-agent run
-        if len(self._envs) > 0:
-            for status in self._envs.values():
-                if status.report.state == "RESET_BY_SYSTEM":
-                    status.report.state = None
-            self._env_status.dump_envs(self._envs)
+        if self._long_poll:
+            self._response = self._client.send_reports(self._envs, long_poll=True)
+        else:
+            self._response = self._client.send_reports(self._envs)
+        self._clear_reset_state()
 
         if self._response:
             report = self._update_internal_deploy_goal(self._response)
@@ -265,8 +281,32 @@ class DeployAgent(object):
         else:
             log.info("Failed to get response from server, exit.")
 
+    def _clear_reset_state(self) -> None:
+        # we only need to send RESET once in one deploy-agent run
+        if len(self._envs) > 0:
+            for status in self._envs.values():
+                if status.report.state == "RESET_BY_SYSTEM":
+                    status.report.state = None
+            self._env_status.dump_envs(self._envs)
+
+    def _enable_long_poll(self) -> None:
+        self._long_poll = (
+            self._config.get_ping_long_poll_seconds() > 0
+            and not isinstance(self._client, ServerlessClient)
+        )
+        if self._long_poll:
+            log.info("Long-poll pings enabled")
+
+    def _get_sleep_time(self) -> float:
+        """seconds to wait before the next serve_build"""
+        if self._long_poll and self._client.long_poll_held():
+            # the service already waited for a change, reconnect with jitter
+            return uniform(0, self._config.get_ping_long_poll_jitter())
+        return self._config.get_daemon_sleep_time()
+
     def serve_forever(self) -> None:
         log.info("Running deploy agent in daemon mode")
+        self._enable_long_poll()
         while True:
             try:
                 self.serve_build()
@@ -275,16 +315,23 @@ class DeployAgent(object):
                     "Deploy Agent got exception: {}".format(traceback.format_exc())
                 )
             finally:
-                time.sleep(self._config.get_daemon_sleep_time())
+                time.sleep(self._get_sleep_time())
                 self.load_status_file()
 
     def serve_once(self) -> None:
         log.info("Running deploy agent in non daemon mode")
+        self._enable_long_poll()
         try:
             if len(self._envs) > 0 and not isinstance(self._client, ServerlessClient):
                 # randomly sleep some time before pinging server. Skip sleeping if in serverless mode.
                 # TODO: consider pause stat_time_elapsed_internal here
-                sleep_secs = randrange(self._config.get_init_sleep_time())
+                # a long-poll ping waits for the goal on the service side
+                max_sleep_secs = (
+                    self._config.get_ping_long_poll_jitter()
+                    if self._long_poll
+                    else self._config.get_init_sleep_time()
+                )
+                sleep_secs = randrange(max(max_sleep_secs, 1))
                 log.info(
                     "Randomly sleep {} seconds before starting.".format(sleep_secs)
                 )
@@ -292,6 +339,10 @@ class DeployAgent(object):
             else:
                 log.info("No status file. Could be first time agent ran")
             self.serve_build()
+            # the deploy is over, let the stale builds go before exiting
+            self._build_collector.join()
+            # and the stale facts refresh, the process exits right after
+            self._client.join()
         except Exception:
             log.exception(
                 "Deploy Agent got exceptions: {}".format(traceback.format_exc())
@@ -349,13 +400,13 @@ class DeployAgent(object):
                 return self._executor.execute_command(curr_stage)
 
     # provides command line to start download scripts or tar ball.
-    def get_download_script(self, deploy_goal) -> List[str]:
+    def get_download_script(self, deploy_goal, status=None) -> List[str]:
         if not (deploy_goal.build and deploy_goal.build.artifactUrl):
             raise AgentException("Cannot find build or build url in the deploy goal")
 
         url = deploy_goal.build.artifactUrl
         build = deploy_goal.build.buildId
-        env_name = self._curr_report.report.envName
+        env_name = (status or self._curr_report).report.envName
         if not self._config.get_config_filename():
             return ["deploy-downloader", "-v", build, "-u", url, "-e", env_name]
         else:
@@ -371,16 +422,18 @@ class DeployAgent(object):
                 env_name,
             ]
 
-    def get_staging_script(self) -> list:
-        build = self._curr_report.build_info.build_id
-        env_name = self._curr_report.report.envName
-        if not self._config.get_config_filename():
+    def get_staging_script(self, status=None, config=None) -> list:
+        status = status or self._curr_report
+        config = config or self._config
+        build = status.build_info.build_id
+        env_name = status.report.envName
+        if not config.get_config_filename():
             return [
                 "deploy-stager",
                 "-v",
                 build,
                 "-t",
-                self._config.get_target(),
+                config.get_target(),
                 "-e",
                 env_name,
             ]
@@ -388,11 +441,11 @@ class DeployAgent(object):
             return [
                 "deploy-stager",
                 "-f",
-                self._config.get_config_filename(),
+                config.get_config_filename(),
                 "-v",
                 build,
                 "-t",
-                self._config.get_target(),
+                config.get_target(),
                 "-e",
                 env_name,
             ]
@@ -436,11 +489,11 @@ class DeployAgent(object):
             else:
                 return PingStatus.PLAN_NO_CHANGE
 
-    def clean_stale_builds(self) -> None:
+    def clean_stale_builds(self, env_name=None) -> None:
         if not self._envs:
             return
 
-        if not (self._curr_report and self._curr_report.report):
+        if not env_name and not (self._curr_report and self._curr_report.report):
             return
 
         builds_to_keep = [
@@ -448,9 +501,16 @@ class DeployAgent(object):
             for status in self._envs.values()
             if status.build_info
         ]
+        # and the builds the env symlinks point to
+        for name, status in self._envs.items():
+            enabled_build = self._helper.get_enabled_build(
+                self._config.get_env_target(name, status.runtime_config)
+            )
+            if enabled_build:
+                builds_to_keep.append(enabled_build)
         builds_dir = self._config.get_builds_directory()
-        num_retain_builds = self._config.get_num_builds_retain()
-        env_name = self._curr_report.report.envName
+        num_retain_builds = self._helper.get_num_builds_retain(builds_dir)
+        env_name = env_name or self._curr_report.report.envName
         # clear stale builds
         if len(builds_to_keep) > 0:
             self.clean_stale_files(
@@ -465,28 +525,42 @@ class DeployAgent(object):
         ):
             if build not in files_to_keep:
                 log.info("Stale file {} found in {}... removing.".format(build, dir))
-                self._helper.clean_package(dir, build, env_name)
+                self._build_collector.retire(build, env_name)
 
     def _timing_stats_deploy_stage_time_elapsed(self) -> None:
         """a deploy goal has finished, send stats for the elapsed time"""
-        if (
-            self.deploy_goal_previous
-            and self.deploy_goal_previous.deployStage
-            and self.stat_stage_time_elapsed
-        ):
-            tags = {"first_run": self.first_run}
-            if self.deploy_goal_previous.deployStage:
-                tags["deploy_stage"] = self.deploy_goal_previous.deployStage
-            if self.deploy_goal_previous.envName:
-                tags["env_name"] = self.deploy_goal_previous.envName
-            if self.deploy_goal_previous.stageName:
-                tags["stage_name"] = self.deploy_goal_previous.stageName
+        self._send_stage_time_elapsed(
+            self.deploy_goal_previous, self.stat_stage_time_elapsed
+        )
+
+    def _get_stage_tags(self, deploy_goal) -> dict:
+        tags = {"first_run": self.first_run}
+        if deploy_goal.deployStage:
+            tags["deploy_stage"] = deploy_goal.deployStage
+        if deploy_goal.envName:
+            tags["env_name"] = deploy_goal.envName
+        if deploy_goal.stageName:
+            tags["stage_name"] = deploy_goal.stageName
+        return tags
+
+    def _send_stage_time_elapsed(self, deploy_goal, stage_time_elapsed) -> None:
+        if deploy_goal and deploy_goal.deployStage and stage_time_elapsed:
             create_sc_timing(
                 "deployd.stats.deploy.stage.time_elapsed_sec",
-                self.stat_stage_time_elapsed.get(),
-                tags=tags,
+                stage_time_elapsed.get(),
+                tags=self._get_stage_tags(deploy_goal),
             )
 
+    def _start_stage_time_elapsed(self, deploy_goal) -> TimeElapsed:
+        """a deploy goal has started, send stats for its start time"""
+        stage_time_elapsed = TimeElapsed()
+        create_sc_timing(
+            "deployd.stats.deploy.stage.time_start_sec",
+            stage_time_elapsed.get(),
+            tags=self._get_stage_tags(deploy_goal),
+        )
+        return stage_time_elapsed
+
     # private functions: update per deploy step configuration specified by services owner on the
     # environment config page
     def _update_internal_deploy_goal(self, response) -> DeployReport:
@@ -504,40 +578,16 @@ class DeployAgent(object):
         # update deploy_status from response for the environment
         self._envs[env_name].update_by_response(response)
 
-        # update script variables
-        if deploy_goal.scriptVariables:
-            log.info(
-                "Start to generate script variables for deploy: {}".format(
-                    deploy_goal.deployId
-                )
-            )
-            env_dir = self._config.get_agent_directory()
-            working_dir = os.path.join(env_dir, "{}_SCRIPT_CONFIG".format(env_name))
-            with open(working_dir, "w+") as f:
-                for key, value in deploy_goal.scriptVariables.items():
-                    f.write("{}={}\n".format(key, value))
+        self._write_script_variables(deploy_goal)
 
         # timing stats - deploy stage start
         if deploy_goal != self.deploy_goal_previous:
             # a deploy goal has changed
-            tags = {"first_run": self.first_run}
-
             # deploy stage has changed, close old previous timer
             self._timing_stats_deploy_stage_time_elapsed()
 
             # create a new timer for the new deploy goal
-            if deploy_goal.deployStage:
-                tags["deploy_stage"] = deploy_goal.deployStage
-            if deploy_goal.envName:
-                tags["env_name"] = deploy_goal.envName
-            if deploy_goal.stageName:
-                tags["stage_name"] = deploy_goal.stageName
-            self.stat_stage_time_elapsed = TimeElapsed()
-            create_sc_timing(
-                "deployd.stats.deploy.stage.time_start_sec",
-                self.stat_stage_time_elapsed.get(),
-                tags=tags,
-            )
+            self.stat_stage_time_elapsed = self._start_stage_time_elapsed(deploy_goal)
             self.deploy_goal_previous = deploy_goal
 
         # load deploy goal to the config
@@ -547,6 +597,22 @@ class DeployAgent(object):
         log.info("current deploy goal is: {}".format(deploy_goal))
         return DeployReport(status_code=AgentStatus.SUCCEEDED)
 
+    def _write_script_variables(self, deploy_goal) -> None:
+        if not deploy_goal.scriptVariables:
+            return
+        log.info(
+            "Start to generate script variables for deploy: {}".format(
+                deploy_goal.deployId
+            )
+        )
+        env_dir = self._config.get_agent_directory()
+        working_dir = os.path.join(
+            env_dir, "{}_SCRIPT_CONFIG".format(deploy_goal.envName)
+        )
+        with open(working_dir, "w+") as f:
+            for key, value in deploy_goal.scriptVariables.items():
+                f.write("{}={}\n".format(key, value))
+
     def _update_deploy_alias(self, deploy_goal) -> None:
         env_name = deploy_goal.envName
         if not self._envs or (env_name not in self._envs):
@@ -736,6 +802,9 @@ def main():
     )
     utils_listen()
     if args.daemon:
+        # only the daemon mode pays for importing python-daemon
+        import daemon
+
         logger = logging.getLogger()
         handles = []
         for handler in logger.handlers:
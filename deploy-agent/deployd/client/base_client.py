@@ -21,11 +21,24 @@ class BaseClient(ABC):
     """
 
     @abstractmethod
-    def send_reports(self, env_reports=None):
+    def send_reports(self, env_reports=None, long_poll=False):
         """Args:
             env_reports: a dict with env name as key and DeployStatus as value.
+            long_poll: let the service hold the ping until the goal changes.
 
         Returns:
             PingResponse describing next action for deploy agent.
         """
         pass
+
+    def long_poll_held(self) -> bool:
+        """Returns:
+        True when the service held the last ping until the goal changed.
+        """
+        return False
+
+    def join(self) -> None:
+        """Wait, for a bounded time, for the background work of the client,
+        before a non daemon agent exits.
+        """
+        pass
@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Optional
+from typing import List, Optional
 import lockfile
 import logging
 import os
@@ -27,6 +27,7 @@ from deployd import __version__
 from deployd.client.base_client import BaseClient
 from deployd.client.restfulclient import RestfulClient
 from deployd.common.decorators import retry
+from deployd.common.facts_cache import FactsCache
 from deployd.common.stats import create_stats_timer, create_sc_increment
 from deployd.common import utils
 from deployd.types.ping_request import PingRequest
@@ -70,6 +71,30 @@ class Client(BaseClient):
         self._account_id = None
         self._normandie_status = None
         self._knox_status = None
+        self._facts_cache = None
+
+    def _get_info_from_facter(self, keys) -> Optional[dict]:
+        ttl = self._config.get_facts_cache_ttl()
+        if not ttl:
+            return utils.get_info_from_facter(keys)
+        if not self._facts_cache:
+            # facts which do not change during the life of the instance
+            immutable_keys = (
+                self._config.get_facter_id_key(),
+                self._config.get_facter_az_key(),
+                self._config.get_facter_secondary_az_key(),
+                self._config.get_facter_account_id_key(),
+            )
+            self._facts_cache = FactsCache(
+                self._config.get_facts_cache_fn(),
+                ttl,
+                ttls=dict((key, None) for key in immutable_keys if key),
+            )
+        return self._facts_cache.get(keys)
+
+    def join(self) -> None:
+        if self._facts_cache:
+            self._facts_cache.join()
 
     def _read_host_info(self) -> bool:
         if self._use_facter:
@@ -93,7 +118,7 @@ class Client(BaseClient):
                 keys_to_fetch.add(group_key)
 
             if keys_to_fetch:
-                facter_data = utils.get_info_from_facter(keys_to_fetch)
+                facter_data = self._get_info_from_facter(keys_to_fetch)
 
             if not self._hostname:
                 self._hostname = facter_data.get(name_key, None)
@@ -193,7 +218,7 @@ class Client(BaseClient):
                 keys_to_fetch.add(account_id_key)
 
             if keys_to_fetch:
-                facter_data = utils.get_info_from_facter(keys_to_fetch)
+                facter_data = self._get_info_from_facter(keys_to_fetch)
 
             if not self._availability_zone:
                 self._availability_zone = facter_data.get(az_key, None)
@@ -332,50 +357,82 @@ class Client(BaseClient):
         else:
             return "ERROR"
 
-    def send_reports(self, env_reports=None) -> Optional[PingResponse]:
+    def _get_ping_request(self, env_reports) -> Optional[PingRequest]:
+        if not self._read_host_info():
+            log.error("Fail to read host info")
+            create_sc_increment(
+                name="deploy.failed.agent.hostinfocollection",
+                tags={"host": self._hostname},
+            )
+            return None
+        reports = [status.report for status in env_reports.values()]
+        for report in reports:
+            if isinstance(report.errorMessage, bytes):
+                report.errorMessage = report.errorMessage.decode("utf-8")
+
+            # We ignore non-ascii charater for now, we should further solve this problem on
+            # the server side:
+            # https://app.asana.com/0/11815463290546/40714916594784
+            if report.errorMessage:
+                report.errorMessage = report.errorMessage.encode(
+                    "ascii", "ignore"
+                ).decode()
+        return PingRequest(
+            hostId=self._id,
+            hostName=self._hostname,
+            hostIp=self._ip,
+            groups=self._hostgroup,
+            reports=reports,
+            agentVersion=__version__,
+            autoscalingGroup=self._autoscaling_group,
+            availabilityZone=self._availability_zone,
+            ec2Tags=self._ec2_tags,
+            stageType=self._stage_type,
+            accountId=self._account_id,
+            normandieStatus=self._normandie_status,
+            knoxStatus=self._knox_status,
+        )
+
+    def send_reports(self, env_reports=None, long_poll=False) -> Optional[PingResponse]:
         try:
-            if self._read_host_info():
-                reports = [status.report for status in env_reports.values()]
-                for report in reports:
-                    if isinstance(report.errorMessage, bytes):
-                        report.errorMessage = report.errorMessage.decode("utf-8")
-
-                    # We ignore non-ascii charater for now, we should further solve this problem on
-                    # the server side:
-                    # https://app.asana.com/0/11815463290546/40714916594784
-                    if report.errorMessage:
-                        report.errorMessage = report.errorMessage.encode(
-                            "ascii", "ignore"
-                        ).decode()
-                ping_request = PingRequest(
-                    hostId=self._id,
-                    hostName=self._hostname,
-                    hostIp=self._ip,
-                    groups=self._hostgroup,
-                    reports=reports,
-                    agentVersion=__version__,
-                    autoscalingGroup=self._autoscaling_group,
-                    availabilityZone=self._availability_zone,
-                    ec2Tags=self._ec2_tags,
-                    stageType=self._stage_type,
-                    accountId=self._account_id,
-                    normandieStatus=self._normandie_status,
-                    knoxStatus=self._knox_status,
-                )
+            ping_request = self._get_ping_request(env_reports)
+            if ping_request:
+                # a held ping measures the wait for a goal, not the service
+                metric, wait_seconds = "deploy.agent.request.latency", 0
+                if long_poll:
+                    metric = "deploy.agent.request.long_poll"
+                    wait_seconds = self._config.get_ping_long_poll_seconds()
+                with create_stats_timer(metric, tags={"host": self._hostname}):
+                    ping_response = self.send_reports_internal(
+                        ping_request, wait_seconds
+                    )
+
+                log.debug("%s -> %s" % (ping_request, ping_response))
+                return ping_response
+        except Exception:
+            log.error(traceback.format_exc())
+            create_sc_increment(
+                name="deploy.failed.agent.requests", tags={"host": self._hostname}
+            )
+            return None
 
+    def get_deploy_candidates(self, env_reports=None) -> Optional[List[PingResponse]]:
+        """Send the reports like send_reports, but get the deploy goals of all
+        the environments with pending work, in the priority order of the server.
+        """
+        try:
+            ping_request = self._get_ping_request(env_reports)
+            if ping_request:
                 with create_stats_timer(
-                    "deploy.agent.request.latency", tags={"host": self._hostname}
+                    "deploy.agent.request.latency",
+                    tags={"host": self._hostname, "candidates": True},
                 ):
-                    ping_response = self.send_reports_internal(ping_request)
+                    candidates = self.get_deploy_candidates_internal(ping_request)
 
-                log.debug("%s -> %s" % (ping_request, ping_response))
-                return ping_response
-            else:
-                log.error("Fail to read host info")
-                create_sc_increment(
-                    name="deploy.failed.agent.hostinfocollection",
-                    tags={"host": self._hostname},
+                log.debug(
+                    "%s -> %s" % (ping_request, ",".join(str(c) for c in candidates))
                 )
+                return candidates
         except Exception:
             log.error(traceback.format_exc())
             create_sc_increment(
@@ -384,7 +441,15 @@ class Client(BaseClient):
             return None
 
     @retry(ExceptionToCheck=Exception, delay=1, tries=3)
-    def send_reports_internal(self, request) -> PingResponse:
+    def get_deploy_candidates_internal(self, request) -> List[PingResponse]:
         ping_service = RestfulClient(self._config)
-        response = ping_service.ping(request)
+        return ping_service.get_deploy_candidates(request)
+
+    @retry(ExceptionToCheck=Exception, delay=1, tries=3)
+    def send_reports_internal(self, request, wait_seconds=0) -> PingResponse:
+        ping_service = RestfulClient(self._config)
+        response = ping_service.ping(request, wait_seconds)
         return response
+
+    def long_poll_held(self) -> bool:
+        return RestfulClient(self._config).long_poll_held
@@ -12,9 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Callable, Optional
+from typing import Callable, List, Optional
+import gzip
+import json
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 
 from deployd.types.ping_response import PingResponse
 from deployd.common.decorators import singleton
@@ -25,6 +29,9 @@ requests.packages.urllib3.disable_warnings()
 
 log = logging.getLogger(__name__)
 
+# set by a service which held a long-poll ping
+LONG_POLL_HEADER = "X-Teletraan-Long-Poll"
+
 
 @singleton
 class RestfulClient(object):
@@ -35,14 +42,32 @@ class RestfulClient(object):
         self.token = config.get_restful_service_token()
         self.verify = config.get_verify_https_certificate() == "True"
         self.default_timeout = 30
+        self.gzip = config.get_restful_service_gzip()
+        # one long-lived session, so pings reuse the keep-alive connection
+        # instead of a TCP and TLS handshake every time
+        self._adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=config.get_restful_service_pool_size()
+        )
+        self._session = requests.Session()
+        self._session.mount("https://", self._adapter)
+        self._session.mount("http://", self._adapter)
+        # whether the service held the last ping until the goal changed
+        self.long_poll_held = False
 
     @staticmethod
     def sc_fail(reason) -> None:
         """send RestfulClient failure metrics"""
         create_sc_increment(name="deploy.agent.rest.failure", tags={"reason": reason})
 
+    def _get_num_connections(self) -> int:
+        """Return the number of connections the session has opened so far"""
+        pools = self._adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
     def __call(self, method) -> Callable:
-        def api(path, params=None, data=None) -> Optional[dict]:
+        def api(
+            path, params=None, data=None, timeout=None, response_headers=None
+        ) -> Optional[dict]:
             url = "%s/%s%s" % (self.url_prefix, self.url_version, path)
             if self.token:
                 headers = {
@@ -51,25 +76,39 @@ class RestfulClient(object):
                 }
             else:
                 headers = {"Content-type": "application/json"}
+            kwargs = {"json": data}
+            if self.gzip and data is not None:
+                headers["Content-Encoding"] = "gzip"
+                kwargs = {"data": gzip.compress(json.dumps(data).encode("utf-8"))}
+            connections = self._get_num_connections()
             try:
-                response = getattr(requests, method)(
+                response = self._session.request(
+                    method,
                     url,
                     headers=headers,
                     params=params,
-                    json=data,
-                    timeout=self.default_timeout,
+                    timeout=timeout or self.default_timeout,
                     verify=self.verify,
+                    **kwargs,
                 )
             except Exception as exception:
                 ex = type(exception).__name__
                 self.sc_fail(ex)
                 raise
 
+            create_sc_increment(
+                name="deploy.agent.rest.connection",
+                tags={"reused": self._get_num_connections() == connections},
+            )
+
             create_sc_increment(
                 name="deploy.agent.rest.status",
                 tags={"status_code": response.status_code},
             )
 
+            if response_headers is not None:
+                response_headers.update(response.headers)
+
             if response.status_code > 300:
                 msg = "Teletraan failed to call backend server. Hint: %s, %s" % (
                     response.status_code,
@@ -85,13 +124,42 @@ class RestfulClient(object):
 
         return api
 
-    def _ping_internal(self, ping_request) -> Optional[dict]:
-        return self.__call("post")("/system/ping", data=ping_request)
+    def _ping_internal(
+        self, ping_request, wait_seconds=0, response_headers=None
+    ) -> Optional[dict]:
+        if not wait_seconds:
+            return self.__call("post")(
+                "/system/ping", data=ping_request, response_headers=response_headers
+            )
+        # the service answers once the goal changes or wait_seconds expire
+        return self.__call("post")(
+            "/system/ping",
+            params={"longPollSeconds": wait_seconds},
+            data=ping_request,
+            timeout=wait_seconds + self.default_timeout,
+            response_headers=response_headers,
+        )
 
-    def ping(self, ping_request) -> PingResponse:
+    def ping(self, ping_request, wait_seconds=0) -> PingResponse:
+        """
+        :param wait_seconds: let the service hold the request open until the
+            deploy goal changes, for at most wait_seconds
+        """
+        self.long_poll_held = False
+        headers = CaseInsensitiveDict()
         # python object -> json
-        response = self._ping_internal(ping_request.to_json())
+        response = self._ping_internal(ping_request.to_json(), wait_seconds, headers)
+        self.long_poll_held = bool(wait_seconds) and LONG_POLL_HEADER in headers
 
         # json -> python object
         ping_response = PingResponse(jsonValue=response)
         return ping_response
+
+    def get_deploy_candidates(self, ping_request) -> List[PingResponse]:
+        response = self.__call("post")(
+            "/system/ping/alldeploycandidates", data=ping_request.to_json()
+        )
+        return [
+            PingResponse(jsonValue=candidate)
+            for candidate in (response or {}).get("candidates") or []
+        ]
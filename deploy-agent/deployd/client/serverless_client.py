@@ -64,7 +64,7 @@ class ServerlessClient(BaseClient):
             deploy_stage if deploy_stage is not None else DeployStage.PRE_DOWNLOAD
         )
 
-    def send_reports(self, env_reports=None) -> Optional[PingResponse]:
+    def send_reports(self, env_reports=None, long_poll=False) -> Optional[PingResponse]:
         reports: list = [status.report for status in env_reports.values()]
         for report in reports:
             if report.envName != self._env_name:
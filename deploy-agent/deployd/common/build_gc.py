@@ -0,0 +1,137 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+from deployd.common.utils import mkdir_p
+
+log = logging.getLogger(__name__)
+
+
+class BuildCollector(object):
+    """Delete stale builds in a low priority background thread.
+
+    A stale build directory and its archives are first renamed into
+    ``<builds_dir>/.trash``, which takes no time whatever their size, so the
+    deploy loop only pays for the renames. A daemon thread at the lowest CPU
+    priority, which also lowers its default IO priority, then unlinks the
+    trash. Anything left in the trash by an exit is deleted with the next
+    stale build.
+    """
+
+    TRASH_DIRNAME = ".trash"
+
+    def __init__(self, builds_dir) -> None:
+        self._builds_dir = builds_dir
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @property
+    def _trash_dir(self) -> str:
+        return os.path.join(self._builds_dir, self.TRASH_DIRNAME)
+
+    def retire(self, build, build_name) -> None:
+        """
+        Move a build to the trash and wake up the collector:
+        :param build: build id
+               build_name: environment name
+        """
+        try:
+            # Remove extracted and staged pointers from disk
+            for suffix in (".extracted", ".staged"):
+                pointer = os.path.join(self._builds_dir, build + suffix)
+                if os.path.exists(pointer):
+                    os.remove(pointer)
+        except OSError:
+            log.exception("Failed: remove old pointer file from disk")
+
+        # the package and the leftovers of an interrupted download
+        archive_prefix = "{}-{}.".format(build_name, build)
+        try:
+            names = [build] + [
+                fn
+                for fn in os.listdir(self._builds_dir)
+                if fn.startswith(archive_prefix)
+            ]
+            mkdir_p(self._trash_dir)
+        except OSError:
+            log.exception("Failed: list builds in {}".format(self._builds_dir))
+            return
+
+        for name in names:
+            path = os.path.join(self._builds_dir, name)
+            if not os.path.lexists(path):
+                continue
+            try:
+                os.rename(
+                    path,
+                    os.path.join(
+                        self._trash_dir, "{}.{}".format(name, uuid.uuid4().hex)
+                    ),
+                )
+            except OSError:
+                log.exception("Failed: move {} to the trash".format(path))
+        self._start()
+
+    def _start(self) -> None:
+        with self._lock:
+            self._wakeup.set()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="build-gc", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            log.debug("Cannot lower the priority of the build collector")
+        while True:
+            with self._lock:
+                if not self._wakeup.is_set():
+                    self._thread = None
+                    return
+                self._wakeup.clear()
+            self.empty_trash()
+
+    def empty_trash(self) -> None:
+        """delete everything in the trash"""
+        try:
+            names = os.listdir(self._trash_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self._trash_dir, name)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                log.info("Removed stale {} from disk".format(name))
+            except BaseException:
+                # Catch base exception class, as there's a multitude of reasons a rmtree can fail
+                log.exception("Failed: remove {} from disk".format(path))
+
+    def join(self, timeout=None) -> None:
+        """wait until the trash is empty"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
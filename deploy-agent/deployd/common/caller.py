@@ -12,40 +12,104 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import codecs
+import collections
+import os
+import selectors
 import subprocess
 import traceback
 import logging
 import time
 from typing import Optional, Tuple
 
+from deployd.common.output_tee import READ_CHUNK_BYTES
+
 log = logging.getLogger(__name__)
 
+# most characters of stdout and of stderr call_and_log keeps, the oldest
+# lines are dropped first
+MAX_OUTPUT_CHARS = 1024 * 1024
+
+
+class _StreamCapture(object):
+    """Timestamped lines of one output stream, at most max_chars of them"""
+
+    def __init__(self, start, max_chars) -> None:
+        self._start = start
+        self._max_chars = max_chars
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._partial = ""
+        self._lines = collections.deque()
+        self._size = 0
+        self._dropped = 0
+
+    def feed(self, data, final=False) -> None:
+        text = self._partial + self._decoder.decode(data, final)
+        lines = text.splitlines(keepends=True)
+        self._partial = ""
+        if lines and not final and not lines[-1].endswith(("\n", "\r")):
+            self._partial = lines.pop()
+        stamp = "[%.2f]" % (time.time() - self._start)
+        for line in lines:
+            self._append(stamp + line)
+
+    def _append(self, line) -> None:
+        self._lines.append(line)
+        self._size += len(line)
+        while self._size > self._max_chars and len(self._lines) > 1:
+            dropped = self._lines.popleft()
+            self._size -= len(dropped)
+            self._dropped += len(dropped)
+
+    def get_output(self) -> str:
+        output = "".join(self._lines).strip()
+        if self._dropped:
+            return "[dropped %d characters]\n%s" % (self._dropped, output)
+        return output
+
 
 class Caller(object):
     def __init__(self) -> None:
         pass
 
     @staticmethod
-    def call_and_log(cmd, **kwargs) -> Tuple[Optional[str], str, Optional[int]]:
-        output = ""
+    def call_and_log(
+        cmd, max_chars=MAX_OUTPUT_CHARS, **kwargs
+    ) -> Tuple[Optional[str], str, Optional[int]]:
+        """Run cmd and capture its output.
+
+        Both pipes are drained as data arrives, so a command filling one of
+        them while the other is idle does not stall. Every line is prefixed
+        with the seconds since the start.
+        return: stdout, stderr and the exit status of cmd
+        """
         start = time.time()
         try:
             process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                encoding="utf-8",
-                **kwargs,
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs
+            )
+            captures = {
+                process.stdout: _StreamCapture(start, max_chars),
+                process.stderr: _StreamCapture(start, max_chars),
+            }
+            with selectors.DefaultSelector() as selector:
+                for stream in captures:
+                    selector.register(stream, selectors.EVENT_READ)
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        data = os.read(key.fd, READ_CHUNK_BYTES)
+                        capture = captures[key.fileobj]
+                        if data:
+                            capture.feed(data)
+                            continue
+                        capture.feed(b"", final=True)
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+            return (
+                captures[process.stdout].get_output(),
+                captures[process.stderr].get_output(),
+                process.wait(),
             )
-            while process.poll() is None:
-                line = process.stdout.readline()
-                if line:
-                    output = output + "[%.2f]" % (time.time() - start) + line
-                line = process.stderr.readline()
-                if line:
-                    output = output + "[%.2f]" % (time.time() - start) + line
-            temp, error = process.communicate()
-            return output.strip(), error.strip(), process.poll()
         except Exception as e:
             log.error(traceback.format_exc())
             return None, str(e), 1
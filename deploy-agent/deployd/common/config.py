@@ -12,12 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import getpass
 import logging
 import os
 import json
 
-from typing import Any, List, Optional
+from typing import Any, Callable, List, Optional
 
 from deployd.common.exceptions import DeployConfigException
 from deployd.common.types import DeployType
@@ -30,15 +31,24 @@ from configparser import ConfigParser
 
 log = logging.getLogger(__name__)
 
+# a snapshot entry for a variable the config does not have
+_MISSING = object()
+
 
 class Config(object):
     _DEFAULT_CONFIG_SECTION = "default_config"
     _configs = {}
+    # export the deploy variables into the environment of the agent
+    _export = True
 
     def __init__(self, filenames=None, config_reader=None) -> None:
         self._configs = {}
         self._filenames = None
         self._environ = {}
+        # variable name -> value, or parsed value for (name, default, parse),
+        # valid until the config file or the runtime config changes
+        self._snapshot = {}
+        self._mtime = None
         if config_reader:
             self._config_reader = config_reader
             return
@@ -52,11 +62,39 @@ class Config(object):
             exit_abruptly(1)
 
         self._filenames = filenames
+        self._mtime = self._get_mtime()
         loaded_filenames = self._config_reader.read(self._filenames)
         if len(loaded_filenames) == 0:
             print("Cannot read config files: {}".format(self._filenames))
             exit_abruptly(1)
 
+    def _get_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self._filenames).st_mtime_ns
+        except OSError:
+            return None
+
+    def _reload_if_changed(self) -> None:
+        """Read the config file again if it changed since it was loaded"""
+        if not self._filenames:
+            return
+        mtime = self._get_mtime()
+        if mtime is None or mtime == self._mtime:
+            return
+        config_reader = ConfigParser()
+        if not config_reader.read(self._filenames):
+            return
+        log.info("Config file {} changed, reload it".format(self._filenames))
+        self._config_reader = config_reader
+        self._mtime = mtime
+        self._snapshot = {}
+
+    def _set_runtime_config(self, runtime_config) -> None:
+        configs = dict(runtime_config) if runtime_config else {}
+        if configs != self._configs:
+            self._configs = configs
+            self._snapshot = {}
+
     def get_config_filename(self) -> Optional[List[str]]:
         return self._filenames
 
@@ -71,18 +109,37 @@ class Config(object):
         else:
             return DeployType.REGULAR
 
+    def copy(self) -> "Config":
+        """Return a config reading the same files, with deploy variables of its own.
+
+        The copy never touches os.environ, commands get its variables from
+        get_subprocess_environ(), so several envs can be deployed at once.
+        """
+        config = copy.copy(self)
+        config._configs = dict(self._configs)
+        config._snapshot = dict(self._snapshot)
+        config._environ = {}
+        config._export = False
+        # the agent environment without the variables of the agent's env
+        config._base_environ = {
+            k: v for k, v in os.environ.items() if k not in self._environ
+        }
+        return config
+
+    def get_subprocess_environ(self) -> dict:
+        if self._export:
+            return dict(os.environ)
+        return dict(self._base_environ, **self._environ)
+
     def update_variables(self, deploy_status) -> None:
         if not deploy_status:
             return
 
-        for k in self._environ.keys():
-            os.environ.pop(k)
+        self._reload_if_changed()
+        self._set_runtime_config(deploy_status.runtime_config)
+        previous_environ = self._environ
         self._environ = {}
 
-        self._configs = {}
-        if deploy_status.runtime_config:
-            self._configs.update(deploy_status.runtime_config)
-
         # update environment variables
         self._environ["DEPLOY_ID"] = deploy_status.report.deployId
 
@@ -138,29 +195,63 @@ class Config(object):
                 self._environ["BUILD_URL"] = deploy_status.build_info.build_url
 
         self._environ["BUILDS_DIR"] = self.get_builds_directory()
-        os.environ.update(self._environ)
-
-    def get_var(self, var_name, default_value=None) -> Any:
+        if self._export:
+            self._export_environ(previous_environ)
+
+    def _export_environ(self, previous_environ) -> None:
+        """Apply the change from previous_environ to os.environ"""
+        for key in previous_environ:
+            if key not in self._environ:
+                os.environ.pop(key, None)
+        for key, value in self._environ.items():
+            if os.environ.get(key) != value:
+                os.environ[key] = value
+
+    def _lookup(self, var_name) -> Any:
+        if var_name in self._snapshot:
+            return self._snapshot[var_name]
         try:
             if self._configs and var_name in self._configs:
-                return self._configs[var_name]
-
-            return self._config_reader.get(self._DEFAULT_CONFIG_SECTION, var_name)
+                value = self._configs[var_name]
+            else:
+                value = self._config_reader.get(self._DEFAULT_CONFIG_SECTION, var_name)
         except Exception:
-            if default_value is not None:
-                return default_value
-            raise DeployConfigException("{} cannot be found.".format(var_name))
+            value = _MISSING
+        self._snapshot[var_name] = value
+        return value
+
+    def get_var(self, var_name, default_value=None) -> Any:
+        value = self._lookup(var_name)
+        if value is not _MISSING:
+            return value
+        if default_value is not None:
+            return default_value
+        raise DeployConfigException("{} cannot be found.".format(var_name))
+
+    def _get_parsed(self, var_name, default_value, parse: Callable) -> Any:
+        """Return parse(get_var(var_name, default_value)), parsed only once"""
+        key = (var_name, default_value, parse)
+        if key not in self._snapshot:
+            self._snapshot[key] = parse(self.get_var(var_name, default_value))
+        return self._snapshot[key]
 
     def get_intvar(self, var_name, default_value=None) -> int:
-        return int(self.get_var(var_name, default_value))
+        return self._get_parsed(var_name, default_value, int)
 
     def get_target(self) -> Optional[str]:
-        target_default_dir = self.get_var("target_default_dir", "/tmp")
         if not (self._configs and self._configs.get("target")):
-            return os.path.join(target_default_dir, self._environ["ENV_NAME"])
+            return self.get_env_target(self._environ["ENV_NAME"])
 
         return self._configs.get("target")
 
+    def get_env_target(self, env_name, runtime_config=None) -> Optional[str]:
+        """Return the target of env_name given the runtime config of that env"""
+        if runtime_config and runtime_config.get("target"):
+            return runtime_config.get("target")
+
+        target_default_dir = self.get_var("target_default_dir", "/tmp")
+        return os.path.join(target_default_dir, env_name)
+
     def get_subprocess_log_name(self) -> str:
         if "ENV_NAME" in self._environ:
             return "{}/{}.log".format(
@@ -183,9 +274,24 @@ class Config(object):
     def get_env_status_fn(self) -> str:
         return os.path.join(self.get_agent_directory(), "env_status")
 
+    def get_env_status_backend(self) -> str:
+        return self.get_var("env_status_backend", "json")
+
+    def get_docker_socket(self) -> Optional[str]:
+        return self.get_var("docker_socket", "/var/run/docker.sock")
+
+    def get_health_check_timeout(self) -> int:
+        return self.get_intvar("health_check_timeout", 5)
+
     def get_host_info_fn(self) -> str:
         return os.path.join(self.get_agent_directory(), "host_info")
 
+    def get_facts_cache_fn(self) -> str:
+        return os.path.join(self.get_agent_directory(), "host_facts")
+
+    def get_facts_cache_ttl(self) -> int:
+        return self.get_intvar("facts_cache_ttl_sec", 3600)
+
     def get_builds_directory(self) -> str:
         return self.get_var("builds_dir", "/tmp/deployd/builds")
 
@@ -204,6 +310,12 @@ class Config(object):
     def get_restful_service_token(self) -> str:
         return self.get_var("teletraan_service_token", "")
 
+    def get_restful_service_pool_size(self) -> int:
+        return self.get_intvar("teletraan_service_pool_size", 2)
+
+    def get_restful_service_gzip(self) -> bool:
+        return self.get_var("teletraan_service_gzip", "False") == "True"
+
     # aws specific configuration
     def get_aws_access_key(self) -> Optional[str]:
         return self.get_var("aws_access_key_id", None)
@@ -211,6 +323,12 @@ class Config(object):
     def get_aws_access_secret(self) -> Optional[str]:
         return self.get_var("aws_secret_access_key", None)
 
+    def get_s3_download_concurrency(self) -> int:
+        return self.get_intvar("s3_download_concurrency", 1)
+
+    def get_s3_download_part_size(self) -> int:
+        return self.get_intvar("s3_download_part_size_mb", 8) * 1024 * 1024
+
     # agent process configs
     def get_agent_ping_interval(self) -> int:
         return self.get_intvar("min_running_time", 60)
@@ -227,6 +345,12 @@ class Config(object):
     def get_subprocess_max_log_bytes(self) -> int:
         return self.get_intvar("max_tail_bytes", 10240)
 
+    def get_subprocess_output_pipe(self) -> bool:
+        return self.get_var("subprocess_output_pipe", "False") == "True"
+
+    def get_subprocess_log_rotate_bytes(self) -> int:
+        return self.get_intvar("subprocess_log_rotate_mb", 0) * 1024 * 1024
+
     def get_subprocess_max_sleep_interval(self) -> int:
         return self.get_intvar("max_sleep_interval", 60)
 
@@ -236,9 +360,51 @@ class Config(object):
     def get_backoff_factor(self) -> int:
         return self.get_intvar("back_off_factor", 2)
 
+    def get_max_concurrent_envs(self) -> int:
+        return self.get_intvar("max_concurrent_envs", 1)
+
+    def get_in_process_stages(self) -> bool:
+        return self.get_var("in_process_stages", "False") == "True"
+
+    def get_streaming_download(self) -> bool:
+        return self.get_var("streaming_download", "False") == "True"
+
+    def get_delta_download(self) -> bool:
+        return self.get_var("delta_download", "False") == "True"
+
+    def get_extract_workers(self) -> int:
+        return self.get_intvar("extract_workers", 1)
+
+    def get_link_script_templates(self) -> bool:
+        return self.get_var("link_script_templates", "False") == "True"
+
+    def get_transform_workers(self) -> int:
+        return self.get_intvar("transform_workers", 1)
+
+    def get_resumable_download(self) -> bool:
+        return self.get_var("resumable_download", "False") == "True"
+
+    def get_artifact_cache_directory(self) -> str:
+        return self.get_var(
+            "artifact_cache_dir",
+            os.path.join(self.get_builds_directory(), ".artifact_cache"),
+        )
+
+    def get_artifact_cache_max_bytes(self) -> int:
+        return self.get_intvar("artifact_cache_max_mb", 0) * 1024 * 1024
+
     def get_num_builds_retain(self) -> int:
         return self.get_intvar("num_builds_to_retain", 2)
 
+    def get_max_builds_retain(self) -> int:
+        return self.get_intvar("max_builds_to_retain", self.get_num_builds_retain())
+
+    def get_disk_low_watermark(self) -> int:
+        return self.get_intvar("disk_low_watermark", 50)
+
+    def get_disk_high_watermark(self) -> int:
+        return self.get_intvar("disk_high_watermark", 90)
+
     def respect_puppet(self) -> int:
         return self.get_intvar("respect_puppet", 0)
 
@@ -261,6 +427,12 @@ class Config(object):
     def get_init_sleep_time(self) -> int:
         return self.get_intvar("init_sleep_time", 50)
 
+    def get_ping_long_poll_seconds(self) -> int:
+        return self.get_intvar("ping_long_poll_seconds", 0)
+
+    def get_ping_long_poll_jitter(self) -> int:
+        return self.get_intvar("ping_long_poll_jitter", 5)
+
     def get_log_level(self) -> int:
         log_level = self.get_var("log_level", "DEBUG")
         if log_level == "INFO":
@@ -307,8 +479,8 @@ class Config(object):
             "account_id_key", "ec2_metadata.identity-credentials.ec2.info"
         )
 
-    def _get_download_allow_list(self, key: str) -> List:
-        allow_list_str = self.get_var(key, "[]")
+    @staticmethod
+    def _parse_allow_list(allow_list_str) -> List:
         allow_list = []
         try:
             allow_list = json.loads(allow_list_str)
@@ -318,6 +490,9 @@ class Config(object):
             )
         return allow_list
 
+    def _get_download_allow_list(self, key: str) -> List:
+        return self._get_parsed(key, "[]", self._parse_allow_list)
+
     def get_http_download_allow_list(self) -> List:
         return self._get_download_allow_list("http_download_allow_list")
 
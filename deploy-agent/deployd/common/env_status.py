@@ -16,6 +16,8 @@ import json
 import logging
 import lockfile
 import os
+import sqlite3
+import threading
 import traceback
 
 from deployd import IS_PINTEREST
@@ -30,6 +32,8 @@ class EnvStatus(object):
         self._status_fn = status_fn
         self._lock_fn = "{}.lock".format(self._status_fn)
         self._lock = lockfile.FileLock(self._lock_fn)
+        # content of the last dump, an unchanged status is not written again
+        self._last_data = None
 
     def load_envs(self) -> dict:
         """
@@ -77,19 +81,29 @@ class EnvStatus(object):
                 os.remove(file_path)
                 log.debug("Removed {}.".format(file_path))
 
+    def _write(self, data) -> None:
+        """Replace the status file atomically, a crash never leaves half of it"""
+        tmp_fn = "{}.tmp".format(self._status_fn)
+        with open(tmp_fn, "w") as config_output:
+            config_output.write(data)
+            config_output.flush()
+            os.fsync(config_output.fileno())
+        os.replace(tmp_fn, self._status_fn)
+
+    def _dump(self, envs) -> None:
+        json_data = {}
+        if envs:
+            json_data = {key: value.to_json() for key, value in envs.items()}
+        data = json.dumps(json_data, sort_keys=True, indent=2, separators=(",", ": "))
+        if data == self._last_data and os.path.exists(self._status_fn):
+            return
+        with self._lock:
+            self._write(data)
+        self._last_data = data
+
     def dump_envs(self, envs) -> bool:
         try:
-            json_data = {}
-            if envs:
-                json_data = {key: value.to_json() for key, value in envs.items()}
-            with self._lock, open(self._status_fn, "w") as config_output:
-                json.dump(
-                    json_data,
-                    config_output,
-                    sort_keys=True,
-                    indent=2,
-                    separators=(",", ": "),
-                )
+            self._dump(envs)
 
             if IS_PINTEREST:
                 self._touch_or_rm_host_type_file(envs, "canary")
@@ -100,3 +114,122 @@ class EnvStatus(object):
         except Exception:
             log.error(traceback.format_exc())
             return False
+
+
+class SqliteEnvStatus(EnvStatus):
+    """Keep the env status in a SQLite database, one row per env.
+
+    dump_envs only writes the envs whose status changed, in one transaction,
+    so a host with many envs does not rewrite all of them on every ping and
+    a crash mid-write leaves the previous status intact. A new database
+    imports the json status file once, and renames it to env_status.imported.
+    The import is written to a temporary database which is renamed into
+    place once committed, a failed import is retried on the next load.
+    """
+
+    _CREATE_TABLE = (
+        "CREATE TABLE IF NOT EXISTS envs (name TEXT PRIMARY KEY, status TEXT)"
+    )
+
+    def __init__(self, status_fn) -> None:
+        super(SqliteEnvStatus, self).__init__(status_fn)
+        self._db_fn = "{}.db".format(status_fn)
+        self._db_lock = threading.Lock()
+        self._conn = None
+        # env name -> json of the rows in the database
+        self._rows = None
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self._db_fn, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(self._CREATE_TABLE)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def load_envs(self) -> dict:
+        if not os.path.exists(self._db_fn) and os.path.exists(self._status_fn):
+            log.info("Import {} into {}".format(self._status_fn, self._db_fn))
+            envs = super(SqliteEnvStatus, self).load_envs()
+            if self._import(envs):
+                # nothing must read or edit the json status once it is stale
+                imported_fn = "{}.imported".format(self._status_fn)
+                os.replace(self._status_fn, imported_fn)
+                log.info("Moved {} to {}".format(self._status_fn, imported_fn))
+            return envs
+        envs = {}
+        try:
+            with self._db_lock:
+                rows = self._get_conn().execute("SELECT name, status FROM envs")
+                self._rows = dict(rows.fetchall())
+            envs = {
+                name: DeployStatus(json_value=json.loads(status))
+                for name, status in self._rows.items()
+            }
+        except Exception:
+            log.exception("Something went wrong in load_envs")
+        return envs
+
+    def _import(self, envs) -> bool:
+        """Create the database with envs, only once every row is committed"""
+        tmp_fn = "{}.tmp".format(self._db_fn)
+        rows = [
+            (key, json.dumps(value.to_json(), sort_keys=True))
+            for key, value in envs.items()
+        ]
+        try:
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+            conn = sqlite3.connect(tmp_fn)
+            try:
+                with conn:
+                    conn.execute(self._CREATE_TABLE)
+                    conn.executemany(
+                        "INSERT INTO envs (name, status) VALUES (?, ?)", rows
+                    )
+            finally:
+                conn.close()
+            os.replace(tmp_fn, self._db_fn)
+            return True
+        except Exception:
+            log.exception("Failed to import {}".format(self._status_fn))
+            return False
+
+    def _dump(self, envs) -> None:
+        rows = {
+            key: json.dumps(value.to_json(), sort_keys=True)
+            for key, value in (envs or {}).items()
+        }
+        with self._db_lock:
+            conn = self._get_conn()
+            if self._rows is None:
+                self._rows = dict(conn.execute("SELECT name, status FROM envs"))
+            changed = [
+                (name, status)
+                for name, status in rows.items()
+                if self._rows.get(name) != status
+            ]
+            removed = [(name,) for name in self._rows if name not in rows]
+            if not changed and not removed:
+                return
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO envs (name, status) VALUES (?, ?)",
+                        changed,
+                    )
+                    conn.executemany("DELETE FROM envs WHERE name = ?", removed)
+            except sqlite3.Error as e:
+                # what is in the database is unknown, read it again next time
+                self._rows = None
+                raise IOError(e)
+            self._rows = rows
+
+
+def create_env_status(config) -> EnvStatus:
+    """Return the env status of the backend configured by env_status_backend"""
+    status_fn = config.get_env_status_fn()
+    if config.get_env_status_backend() == "sqlite":
+        return SqliteEnvStatus(status_fn)
+    return EnvStatus(status_fn)
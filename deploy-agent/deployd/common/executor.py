@@ -12,7 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import datetime
 import subprocess
 import logging
 import os
@@ -20,14 +19,31 @@ import signal
 import stat
 import time
 import traceback
-from typing import Tuple
 
+from deployd.common.exit_watcher import ExitWatcher, TimerQueue
+from deployd.common.forked_process import ForkedProcess, get_in_process_main
+from deployd.common.output_tee import OutputTee, decode_tail, rotate_log
 from deployd.common.types import DeployReport, PingStatus, PRE_STAGE_STEPS, AgentStatus
 
 log = logging.getLogger(__name__)
 
+# deadlines of a running command
+_PING = "ping"
+_TIMEOUT = "timeout"
+_RETRY = "retry"
+
 
 class Executor(object):
+    # run the agent's own console scripts in a forked child of the agent
+    IN_PROCESS_STAGES = False
+    # capture the script output through a pipe instead of the log file
+    OUTPUT_PIPE = False
+    # rotate the subprocess log over this size, 0 never rotates
+    LOG_ROTATE_BYTES = 0
+    # pass the variables and script directory of the config to every command
+    # instead of exporting them into the agent's own environment and cwd
+    ISOLATED = False
+
     def __init__(self, callback=None, config=None) -> None:
         self._ping_server = callback
         if not config:
@@ -46,6 +62,9 @@ class Executor(object):
         self.TERMINATE_TIMEOUT = config.get_subprocess_terminate_timeout()
         self.BACK_OFF = config.get_backoff_factor()
         self.MAX_SLEEP_INTERVAL = config.get_subprocess_max_sleep_interval()
+        self.IN_PROCESS_STAGES = config.get_in_process_stages()
+        self.OUTPUT_PIPE = config.get_subprocess_output_pipe()
+        self.LOG_ROTATE_BYTES = config.get_subprocess_log_rotate_bytes()
         self._config = config
         log.debug(
             "Executor configs have been updated: "
@@ -54,88 +73,61 @@ class Executor(object):
             )
         )
 
-    def get_subprocess_output(self, fd, file_pos) -> str:
+    def get_subprocess_output(self, fd, file_pos, output=None) -> str:
+        if output is not None:
+            output.drain()
+            return output.get_output()
+        # only read the tail, however much the script wrote since file_pos
         curr_pos = fd.tell()
-        fd.seek(file_pos, 0)
-        output = fd.read()
+        end = os.fstat(fd.fileno()).st_size
+        fd.seek(max(file_pos, end - self.MAX_TAIL_BYTES - 1), 0)
+        data = fd.read()
         fd.seek(curr_pos, 0)
-        return output[-(self.MAX_TAIL_BYTES + 1) : -1]
+        return decode_tail(data, self.MAX_TAIL_BYTES)
 
     def run_cmd(self, cmd, **kw) -> DeployReport:
         if not isinstance(cmd, list):
             cmd = cmd.split(" ")
         cmd_str = " ".join(cmd)
+        if self.ISOLATED and "env" not in kw:
+            kw["env"] = self._config.get_subprocess_environ()
         log.info("Running: {} with {} retries.".format(cmd_str, self.MAX_RETRY))
 
         deploy_report = DeployReport(
             status_code=AgentStatus.UNKNOWN, error_code=0, retry_times=0
         )
         process_interval = self.PROCESS_POLL_INTERVAL
-        start = datetime.datetime.now()
-        init_start = datetime.datetime.now()
+        timers = TimerQueue()
+        timers.schedule(_PING, self.MIN_RUNNING_TIME)
         total_retry = 0
 
-        with open(self.LOG_FILENAME, "a+") as fdout:
+        rotate_log(self.LOG_FILENAME, self.LOG_ROTATE_BYTES)
+        with open(self.LOG_FILENAME, "ab+") as fdout:
             while total_retry < self.MAX_RETRY:
+                output = None
                 try:
                     fdout.seek(0, 2)
                     file_pos = fdout.tell()
-                    process = subprocess.Popen(
-                        cmd, stdout=fdout, stderr=fdout, preexec_fn=os.setsid, **kw
-                    )
-                    while process.poll() is None:
-                        start, deploy_report = self.ping_server_if_possible(
-                            start, cmd, deploy_report
-                        )
-                        """
-                        terminate case 1:
-                        the server changed the deploy goal, notify process and wait for it to shut down
-                        If service script does not handle SIGTERM, terminate case 2 below should kill
-                        """
-                        if deploy_report.status_code == AgentStatus.ABORTED_BY_SERVER:
-                            self._graceful_shutdown(process)
-                            return deploy_report
-
-                        """
-                        terminate case 2:
-                        the script gets timeout error, return to the agent to report to the server
-                        """
-                        if (
-                            datetime.datetime.now() - init_start
-                        ).seconds >= self.MAX_RUNNING_TIME:
-                            Executor._kill_process(process)
-                            # the best way to get output is to tail the log
-                            deploy_report.output_msg = self.get_subprocess_output(
-                                fd=fdout, file_pos=file_pos
-                            )
-                            log.info(
-                                "Exceed max running time: {}.".format(
-                                    self.MAX_RUNNING_TIME
-                                )
-                            )
-                            log.info(
-                                "Output from subprocess: {}".format(
-                                    deploy_report.output_msg
-                                )
-                            )
-                            deploy_report.status_code = AgentStatus.SCRIPT_TIMEOUT
-                            deploy_report.error_code = 1
-                            return deploy_report
-
-                        # sleep some seconds before next poll
-                        sleep_time = self._get_sleep_interval(
-                            start, self.PROCESS_POLL_INTERVAL
+                    if self.OUTPUT_PIPE:
+                        output = OutputTee(
+                            self.LOG_FILENAME,
+                            self.MAX_TAIL_BYTES,
+                            self.LOG_ROTATE_BYTES,
                         )
-                        # Wait up to sleep_time for the process to terminate (new in Python 3.3)
-                        try:
-                            process.wait(sleep_time)
-                        except subprocess.TimeoutExpired:
-                            pass
+                        process = self._start_process(cmd, output.writer, **kw)
+                        output.close_writer()
+                    else:
+                        process = self._start_process(cmd, fdout, **kw)
+                    timers.schedule(_TIMEOUT, self.MAX_RUNNING_TIME)
+                    if not self._wait_for_process(
+                        process, cmd, fdout, file_pos, deploy_report, timers, output
+                    ):
+                        return deploy_report
 
                     # finish executing sub process
                     deploy_report.error_code = process.returncode
                     deploy_report.output_msg = self.get_subprocess_output(
-                        fd=fdout, file_pos=file_pos
+                        fd=fdout, file_pos=file_pos, output=output
                     )
                     if process.returncode == 0:
                         log.info("Running: {} succeeded.".format(cmd_str))
@@ -146,6 +138,10 @@ class Executor(object):
                     deploy_report.error_code = 1
                     deploy_report.output_msg = error_msg
                     log.error(error_msg)
+                finally:
+                    timers.cancel(_TIMEOUT)
+                    if output is not None:
+                        output.close()
 
                 # fails when:
                 # subprocess execution fails
@@ -162,24 +158,27 @@ class Executor(object):
                     deploy_report.status_code = AgentStatus.TOO_MANY_RETRY
                     return deploy_report
 
-                init_start = datetime.datetime.now()  # reset the initial start time
-
                 log.info(
                     "Failed: {}, at {} retry. Error:\n{}".format(
                         cmd_str, deploy_report.retry_times, deploy_report.output_msg
                     )
                 )
-                sleep_time = self._get_sleep_interval(start, process_interval)
-                time.sleep(sleep_time)
-                start, deploy_report = self.ping_server_if_possible(
-                    start, cmd, deploy_report
-                )
-                if deploy_report.status_code == AgentStatus.ABORTED_BY_SERVER:
-                    return deploy_report
+                # back off before the next retry, keep pinging meanwhile
+                timers.schedule(_RETRY, process_interval)
+                retry = False
+                while not retry:
+                    time.sleep(timers.next_timeout())
+                    for event in timers.pop_expired():
+                        if event == _PING:
+                            self._ping(cmd, deploy_report, timers)
+                            if (
+                                deploy_report.status_code
+                                == AgentStatus.ABORTED_BY_SERVER
+                            ):
+                                return deploy_report
+                        elif event == _RETRY:
+                            retry = True
 
-                # sleep the rest of the time
-                if process_interval - sleep_time > 0:
-                    time.sleep(process_interval - sleep_time)
                 # exponential backoff
                 process_interval = min(
                     process_interval * self.BACK_OFF, self.MAX_SLEEP_INTERVAL
@@ -188,34 +187,76 @@ class Executor(object):
         deploy_report.status_code = AgentStatus.TOO_MANY_RETRY
         return deploy_report
 
-    def ping_server_if_possible(
-        self, start, cmd_str, deploy_report
-    ) -> Tuple[datetime.datetime, DeployReport]:
-        now = datetime.datetime.now()
-        processed_time = (now - start).seconds
-        log.debug("start: {}, now: {}, process: {}".format(start, now, processed_time))
-        if processed_time >= self.MIN_RUNNING_TIME and self._ping_server:
-            start = now
+    def _start_process(self, cmd, fdout, **kw):
+        main = get_in_process_main(cmd) if self.IN_PROCESS_STAGES and not kw else None
+        if main:
+            return ForkedProcess(cmd, main, stdout=fdout, preexec_fn=os.setsid)
+        return subprocess.Popen(
+            cmd, stdout=fdout, stderr=fdout, preexec_fn=os.setsid, **kw
+        )
+
+    def _wait_for_process(
+        self, process, cmd, fdout, file_pos, deploy_report, timers, output=None
+    ) -> bool:
+        """Sleep until the process exits or the next deadline.
+
+        return: bool, False when the process was terminated and the deploy
+        report is final
+        """
+        with ExitWatcher(process, output) as watcher:
+            while watcher.wait(timers.next_timeout()) is None:
+                for event in timers.pop_expired():
+                    if event == _PING:
+                        self._ping(cmd, deploy_report, timers)
+                        """
+                        terminate case 1:
+                        the server changed the deploy goal, notify process and wait for it to shut down
+                        If service script does not handle SIGTERM, terminate case 2 below should kill
+                        """
+                        if deploy_report.status_code == AgentStatus.ABORTED_BY_SERVER:
+                            self._graceful_shutdown(process, watcher)
+                            return False
+                    elif event == _TIMEOUT:
+                        """
+                        terminate case 2:
+                        the script gets timeout error, return to the agent to report to the server
+                        """
+                        Executor._kill_process(process)
+                        # the best way to get output is to tail the log
+                        deploy_report.output_msg = self.get_subprocess_output(
+                            fd=fdout, file_pos=file_pos, output=output
+                        )
+                        log.info(
+                            "Exceed max running time: {}.".format(self.MAX_RUNNING_TIME)
+                        )
+                        log.info(
+                            "Output from subprocess: {}".format(
+                                deploy_report.output_msg
+                            )
+                        )
+                        deploy_report.status_code = AgentStatus.SCRIPT_TIMEOUT
+                        deploy_report.error_code = 1
+                        return False
+        return True
+
+    def _ping(self, cmd, deploy_report, timers) -> None:
+        """Report to the server and schedule the next ping"""
+        timers.schedule(_PING, self.MIN_RUNNING_TIME)
+        if not self._ping_server:
+            return
+        log.info(
+            "Exceed min running time: {}, reporting to the server".format(
+                self.MIN_RUNNING_TIME
+            )
+        )
+        result = self._ping_server(deploy_report)
+        if result == PingStatus.PLAN_CHANGED:
+            deploy_report.status_code = AgentStatus.ABORTED_BY_SERVER
             log.info(
-                "Exceed min running time: {}, reporting to the server".format(
-                    self.MIN_RUNNING_TIME
+                "Deploy goal has changed, aborting the current command {}.".format(
+                    " ".join(cmd)
                 )
             )
-            result = self._ping_server(deploy_report)
-            if result == PingStatus.PLAN_CHANGED:
-                deploy_report.status_code = AgentStatus.ABORTED_BY_SERVER
-                log.info(
-                    "Deploy goal has changed, aborting the current command {}.".format(
-                        " ".join(cmd_str)
-                    )
-                )
-
-        return start, deploy_report
-
-    def _get_sleep_interval(self, start, interval) -> int:
-        now = datetime.datetime.now()
-        max_sleep_seconds = self.MIN_RUNNING_TIME - (now - start).seconds
-        return min(interval, max(max_sleep_seconds, 1))
 
     @staticmethod
     def _kill_process(process) -> None:
@@ -225,7 +266,7 @@ class Executor(object):
         except Exception as e:
             log.debug("Failed to kill process: {}".format(e))
 
-    def _graceful_shutdown(self, process) -> None:
+    def _graceful_shutdown(self, process, watcher) -> None:
         try:
             log.info(
                 "Gracefully shutdown currently running process with timeout {}".format(
@@ -233,14 +274,18 @@ class Executor(object):
                 )
             )
             os.killpg(process.pid, signal.SIGTERM)
-            process.wait(self.TERMINATE_TIMEOUT)
+            if watcher.wait(self.TERMINATE_TIMEOUT) is None:
+                raise subprocess.TimeoutExpired(process.args, self.TERMINATE_TIMEOUT)
         except Exception as e:
             log.debug("Failed to gracefully shutdown: {}".format(e))
             Executor._kill_process(process)
 
     def execute_command(self, script) -> DeployReport:
         try:
-            deploy_step = os.getenv("DEPLOY_STEP")
+            if self.ISOLATED:
+                deploy_step = self._config.get_subprocess_environ().get("DEPLOY_STEP")
+            else:
+                deploy_step = os.getenv("DEPLOY_STEP")
             if not os.path.exists(self._config.get_script_directory()):
                 """if the teletraan directory does not exist in the pre stage steps. It
                 means it's a newly added host (never deployed before). Show a warning message
@@ -278,10 +323,12 @@ class Executor(object):
                     log.info("script: {} does not exist.".format(script))
                     return DeployReport(status_code=AgentStatus.SUCCEEDED)
 
-            os.chdir(self._config.get_script_directory())
             # change the mode of the script
             st = os.stat(script)
             os.chmod(script, st.st_mode | stat.S_IXUSR)
+            if self.ISOLATED:
+                return self.run_cmd(script, cwd=self._config.get_script_directory())
+            os.chdir(self._config.get_script_directory())
             return self.run_cmd(script)
         except Exception as e:
             error_msg = str(e)
@@ -0,0 +1,113 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import os
+import selectors
+import subprocess
+import time
+from typing import List, Optional
+
+
+class TimerQueue(object):
+    """Named deadlines kept in a heap ordered by time.monotonic()"""
+
+    def __init__(self) -> None:
+        self._heap = []
+        self._seq = 0
+
+    def schedule(self, name, delay) -> None:
+        heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, name))
+        self._seq += 1
+
+    def cancel(self, name) -> None:
+        self._heap = [entry for entry in self._heap if entry[2] != name]
+        heapq.heapify(self._heap)
+
+    def next_timeout(self) -> Optional[float]:
+        """Seconds until the earliest deadline, None when there is none"""
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - time.monotonic(), 0)
+
+    def pop_expired(self) -> List[str]:
+        """Remove and return the names of the deadlines which have passed"""
+        now = time.monotonic()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expired.append(heapq.heappop(self._heap)[2])
+        return expired
+
+
+class ExitWatcher(object):
+    """Wake up the moment a child process exits.
+
+    A pidfd becomes readable when the process exits, so waiting is a single
+    select() instead of polling. Without pidfd support (python < 3.9 or
+    linux < 5.3) it falls back to process.wait(timeout). An OutputTee passed
+    as output is drained while waiting.
+    """
+
+    # seconds between two polls of the process without pidfd but with output
+    _POLL_INTERVAL = 0.05
+
+    def __init__(self, process, output=None) -> None:
+        self._process = process
+        self._output = output
+        self._pidfd = None
+        self._selector = selectors.DefaultSelector()
+        pidfd_open = getattr(os, "pidfd_open", None)
+        if pidfd_open is not None:
+            try:
+                self._pidfd = pidfd_open(process.pid)
+                self._selector.register(self._pidfd, selectors.EVENT_READ)
+            except OSError:
+                self._pidfd = None
+        if output is not None:
+            self._selector.register(output.fileno(), selectors.EVENT_READ)
+
+    def __enter__(self) -> "ExitWatcher":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def wait(self, timeout=None) -> Optional[int]:
+        """Wait up to timeout seconds, return the exit code or None"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._process.poll() is None:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            if self._pidfd is None:
+                if not self._selector.get_map():
+                    try:
+                        return self._process.wait(remaining)
+                    except subprocess.TimeoutExpired:
+                        return None
+                if remaining is None or remaining > self._POLL_INTERVAL:
+                    remaining = self._POLL_INTERVAL
+            for key, _ in self._selector.select(remaining):
+                if key.fd != self._pidfd and not self._output.drain():
+                    self._selector.unregister(key.fd)
+        if self._output is not None:
+            # what the process wrote right before it exited
+            self._output.drain()
+        return self._process.returncode
+
+    def close(self) -> None:
+        self._selector.close()
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
@@ -0,0 +1,146 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+import lockfile
+
+from deployd.common import utils
+
+log = logging.getLogger(__name__)
+
+
+class FactsCache(object):
+    """On-disk cache of facter results with a TTL per key.
+
+    Keys never fetched before are fetched synchronously. Keys older than their
+    TTL are served from the cache while a background thread refreshes them,
+    so a ping never waits for facter once the cache is warm. A TTL of None
+    caches the key forever, e.g. for the instance id. Keys facter returns no
+    value for are not cached.
+    """
+
+    # seconds join() waits for a background refresh
+    JOIN_TIMEOUT = 60
+
+    def __init__(
+        self,
+        cache_fn,
+        default_ttl,
+        ttls=None,
+        fetch: Optional[Callable[[set], Optional[dict]]] = None,
+    ) -> None:
+        self._cache_fn = cache_fn
+        self._file_lock = lockfile.FileLock("{}.lock".format(cache_fn))
+        self._default_ttl = default_ttl
+        self._ttls = ttls or {}
+        self._fetch = fetch or utils.get_info_from_facter
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._facts = self._load()
+
+    def _load(self) -> Dict[str, dict]:
+        if not os.path.exists(self._cache_fn):
+            return {}
+        try:
+            with self._file_lock:
+                return self._load_unlocked()
+        except Exception:
+            log.exception("Failed to load the facts cache {}".format(self._cache_fn))
+            return {}
+
+    def _dump(self, facts) -> None:
+        try:
+            with self._file_lock:
+                on_disk = self._load_unlocked()
+                on_disk.update(facts)
+                tmp_fn = "{}.tmp".format(self._cache_fn)
+                with open(tmp_fn, "w") as f:
+                    json.dump(on_disk, f)
+                os.rename(tmp_fn, self._cache_fn)
+        except Exception:
+            log.exception("Failed to write the facts cache {}".format(self._cache_fn))
+
+    def _load_unlocked(self) -> Dict[str, dict]:
+        try:
+            with open(self._cache_fn, "r") as f:
+                facts = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return {
+            key: fact for key, fact in facts.items() if fact.get("value") is not None
+        }
+
+    def _is_stale(self, key, now) -> bool:
+        ttl = self._ttls.get(key, self._default_ttl)
+        return ttl is not None and now - self._facts[key]["time"] > ttl
+
+    def _refresh(self, keys) -> None:
+        data = self._fetch(set(keys))
+        if data is None:
+            # facter failed, keep serving what we have
+            return
+        now = time.time()
+        # a failed or partial facter run must not pin a missing value
+        facts = {
+            key: {"value": data[key], "time": now}
+            for key in keys
+            if data.get(key) is not None
+        }
+        if not facts:
+            return
+        with self._lock:
+            self._facts.update(facts)
+        self._dump(facts)
+
+    def _refresh_in_background(self, keys) -> None:
+        with self._lock:
+            if self._refresh_thread and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(
+                target=self._refresh, args=(keys,), name="facts-refresh"
+            )
+            self._refresh_thread.daemon = True
+            self._refresh_thread.start()
+
+    def join(self, timeout=None) -> None:
+        """Wait for the background refresh, at most timeout seconds"""
+        thread = self._refresh_thread
+        if thread is not None:
+            thread.join(self.JOIN_TIMEOUT if timeout is None else timeout)
+
+    def get(self, keys: Iterable[str]) -> dict:
+        """Return {key: value} like utils.get_info_from_facter"""
+        keys = set(keys)
+        now = time.time()
+        with self._lock:
+            missing = [key for key in keys if key not in self._facts]
+            stale = [
+                key for key in keys if key in self._facts and self._is_stale(key, now)
+            ]
+        if missing:
+            log.info("Facts {} are not cached, fetch them".format(missing))
+            self._refresh(missing)
+        if stale:
+            log.info("Facts {} are stale, refresh them in background".format(stale))
+            self._refresh_in_background(stale)
+        with self._lock:
+            return {
+                key: self._facts[key]["value"] for key in keys if key in self._facts
+            }
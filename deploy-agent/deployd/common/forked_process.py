@@ -0,0 +1,126 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib
+import logging
+import os
+import subprocess
+import sys
+import time
+import traceback
+from typing import Callable, List, Optional
+
+from deployd.common.stats import flush_metrics
+
+# console scripts which can run in a forked child of the agent, see setup.py
+IN_PROCESS_COMMANDS = {
+    "deploy-downloader": "deployd.download.downloader",
+    "deploy-stager": "deployd.staging.stager",
+}
+
+
+def get_in_process_main(cmd) -> Optional[Callable]:
+    """Return the main() of the console script cmd runs, None if it has none.
+
+    The module is imported by the agent itself, so every forked child reuses
+    it instead of starting an interpreter and importing boto3 and friends.
+    """
+    module = IN_PROCESS_COMMANDS.get(os.path.basename(cmd[0]))
+    if not module:
+        return None
+    return importlib.import_module(module).main
+
+
+def _exit_code(status) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class ForkedProcess(object):
+    """Run a console script main() in a forked child of the agent.
+
+    It implements the part of subprocess.Popen the Executor uses, so timeouts,
+    pings and process group kills work the same for both.
+    """
+
+    # seconds between two checks in wait() with a timeout
+    _WAIT_INTERVAL = 0.05
+
+    def __init__(self, cmd: List[str], main, stdout, preexec_fn=None) -> None:
+        self.args = cmd
+        self.returncode = None
+        # do not let the child write what the agent has buffered
+        sys.stdout.flush()
+        sys.stderr.flush()
+        stdout.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            self._run_child(cmd, main, stdout, preexec_fn)
+
+    @staticmethod
+    def _run_child(cmd, main, stdout, preexec_fn) -> None:
+        code = 1
+        try:
+            if preexec_fn:
+                preexec_fn()
+            os.dup2(stdout.fileno(), 1)
+            os.dup2(stdout.fileno(), 2)
+            sys.stdout = os.fdopen(1, "w", buffering=1, closefd=False)
+            sys.stderr = os.fdopen(2, "w", buffering=1, closefd=False)
+            # log like the console script does, not into the agent log
+            root = logging.getLogger()
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+            sys.argv = list(cmd)
+            code = main() or 0
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                sys.stderr.write("{}\n".format(e.code))
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                # os._exit skips atexit, which sends the queued metrics
+                flush_metrics()
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.returncode = _exit_code(status)
+        return self.returncode
+
+    def wait(self, timeout=None) -> int:
+        if self.returncode is not None:
+            return self.returncode
+        if timeout is None:
+            _, status = os.waitpid(self.pid, 0)
+            self.returncode = _exit_code(status)
+            return self.returncode
+        deadline = time.time() + timeout
+        while self.poll() is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(min(self._WAIT_INTERVAL, remaining))
+        return self.returncode
@@ -0,0 +1,165 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import http.client
+import json
+import logging
+import os
+import re
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from deployd.common.utils import (
+    check_http_health,
+    get_container_health_info,
+    get_health_info_from_containers,
+    get_healthcheck_url,
+    read_healthcheck_configs,
+    redeploy_check_without_container_status,
+)
+
+log = logging.getLogger(__name__)
+
+# "Up 2 hours (healthy)", "Up 3 seconds (health: starting)"
+_HEALTH_PATTERN = re.compile(r"\((?:health: )?(healthy|unhealthy|starting)\)")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection to a server listening on a unix socket"""
+
+    def __init__(self, socket_path, timeout=None) -> None:
+        super(UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+
+def list_containers(socket_path, timeout=None) -> List[dict]:
+    """GET /containers/json from the Docker Engine API"""
+    conn = UnixHTTPConnection(socket_path, timeout=timeout)
+    try:
+        conn.request("GET", "/containers/json")
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise IOError("docker returned {}: {}".format(response.status, body[:200]))
+        return json.loads(body)
+    finally:
+        conn.close()
+
+
+class HealthSnapshot(object):
+    """Health of the services of every env, taken once per agent cycle.
+
+    A single /containers/json request to the Docker socket replaces the
+    docker ps and docker inspect per container of get_container_health_info,
+    the health of each container is in its status. The http healthchecks of
+    the envs without containers run concurrently, with a timeout. Without
+    the socket, every env falls back to get_container_health_info.
+    """
+
+    def __init__(self, socket_path, timeout=5, max_workers=8) -> None:
+        self._socket_path = socket_path
+        self._timeout = timeout
+        self._max_workers = max_workers
+        # (image;name;labels, name, labels, health status) of the containers
+        self._containers = None
+        self._by_commit = {}
+        self._http_checks = {}
+
+    @staticmethod
+    def _index(container) -> Optional[tuple]:
+        match = _HEALTH_PATTERN.search(container.get("Status") or "")
+        if not match:
+            # no healthcheck, docker inspect has no health status either
+            return None
+        names = container.get("Names") or []
+        name = names[0].lstrip("/") if names else container.get("Id", "")
+        labels = ",".join(
+            "{}={}".format(k, v) for k, v in (container.get("Labels") or {}).items()
+        )
+        line = "{};{};{}".format(container.get("Image", ""), name, labels)
+        return line, name, labels, match.group(1)
+
+    def _get_containers(self, commit) -> List[tuple]:
+        containers = self._by_commit.get(commit)
+        if containers is None:
+            containers = [c[1:] for c in self._containers if commit in c[0]]
+            self._by_commit[commit] = containers
+        return containers
+
+    def take(self, statuses) -> None:
+        """query the Docker socket, then run the http checks the envs need"""
+        self._containers = None
+        self._by_commit = {}
+        self._http_checks = {}
+        if not self._socket_path or not os.path.exists(self._socket_path):
+            return
+        try:
+            containers = list_containers(self._socket_path, timeout=self._timeout)
+        except Exception:
+            log.exception("Failed to list containers from {}".format(self._socket_path))
+            return
+        self._containers = [
+            c for c in (self._index(container) for container in containers) if c
+        ]
+
+        urls = set()
+        for status in statuses:
+            commit = status.build_info.build_commit if status.build_info else None
+            if commit is None or self._get_containers(commit):
+                continue
+            try:
+                configs = read_healthcheck_configs(status.report.envName)
+            except Exception:
+                continue
+            if configs:
+                urls.add(get_healthcheck_url(configs))
+        if urls:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+                self._http_checks = {
+                    url: pool.submit(check_http_health, url, self._timeout)
+                    for url in urls
+                }
+
+    def _check_http_health(self, url) -> bool:
+        future = self._http_checks.get(url)
+        if future is None:
+            return check_http_health(url, self._timeout)
+        return future.result()
+
+    def get_container_health_info(self, commit, service, redeploy) -> Optional[str]:
+        """get_container_health_info from the snapshot"""
+        if self._containers is None:
+            return get_container_health_info(
+                commit, service, redeploy, http_check=self._check_http_health
+            )
+        try:
+            log.info(f"Get health info for service {service} with commit {commit}")
+            returnValue = get_health_info_from_containers(
+                self._get_containers(commit), commit, service, redeploy
+            )
+            if returnValue:
+                return returnValue
+            return redeploy_check_without_container_status(
+                commit, service, redeploy, http_check=self._check_http_health
+            )
+        except Exception:
+            log.error(f"Failed to get container health info with commit {commit}")
+            return None
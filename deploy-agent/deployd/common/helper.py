@@ -12,7 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import glob
 import logging
 import os
 import shutil
@@ -68,6 +67,36 @@ class Helper(object):
             return True, filename[len(prefix) : filename.index(".")]
         return False, None
 
+    def get_num_builds_retain(self, builds_dir) -> int:
+        """
+        Number of builds to retain given the disk usage of builds_dir:
+        more while the disk is below the low watermark, one above the high one.
+        """
+        num_builds = self._config.get_num_builds_retain()
+        try:
+            usage = shutil.disk_usage(builds_dir)
+        except OSError:
+            return num_builds
+        used_percent = 100.0 * usage.used / usage.total
+        if used_percent >= self._config.get_disk_high_watermark():
+            log.warning(
+                "{} is {:.0f}% full, retain a single build".format(
+                    builds_dir, used_percent
+                )
+            )
+            return 1
+        if used_percent < self._config.get_disk_low_watermark():
+            return max(num_builds, self._config.get_max_builds_retain())
+        return num_builds
+
+    @staticmethod
+    def get_enabled_build(target) -> Optional[str]:
+        """The build the target symlink points to"""
+        try:
+            return os.path.basename(os.readlink(target))
+        except OSError:
+            return None
+
     @staticmethod
     def get_stale_builds(build_timestamps, num_builds_to_retain=2) -> Generator:
         """
@@ -88,39 +117,3 @@ class Helper(object):
 
             yield build
             yielded_builds += 1
-
-    @staticmethod
-    def clean_package(base_dir, build, build_name) -> None:
-        """
-        Clean a package:
-        :param base_dir: builds dir
-               build: build id
-               build_name: environment name
-        """
-        local_fn = "{}-{}.*".format(build_name, build)
-        try:
-            # Remove extracted pointer from disk
-            extracted_file = os.path.join(base_dir, "{}.extracted".format(build))
-            if os.path.exists(extracted_file):
-                os.remove(extracted_file)
-            # Remove staged pointer from disk
-            staged_file = os.path.join(base_dir, "{}.staged".format(build))
-            if os.path.exists(staged_file):
-                os.remove(staged_file)
-        except OSError:
-            log.exception("Failed: remove old pointer file from disk")
-
-        try:
-            # Remove build directory from disk
-            shutil.rmtree(os.path.join(base_dir, build))
-        except BaseException:
-            # Catch base exception class, as there's a multitude of reasons a rmtree can fail
-            log.exception("Failed: remove build directory from disk")
-
-        try:
-            # Remove archive from disk
-            fns = glob.glob(os.path.join(base_dir, local_fn))
-            if fns:
-                os.remove(fns[0])
-        except OSError:
-            log.exception("Failed: remove build archive from disk")
@@ -0,0 +1,139 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import subprocess
+
+log = logging.getLogger(__name__)
+
+READ_CHUNK_BYTES = 64 * 1024
+
+# cat processes draining pipes which outlived their command
+_drainers = []
+
+
+def rotate_log(log_fn, max_bytes) -> bool:
+    """Move log_fn to log_fn.1 once it is larger than max_bytes.
+
+    A max_bytes of 0 never rotates.
+    return: bool, True if the log was rotated
+    """
+    if not max_bytes:
+        return False
+    try:
+        if os.path.getsize(log_fn) <= max_bytes:
+            return False
+        os.replace(log_fn, "{}.1".format(log_fn))
+    except OSError:
+        return False
+    log.info("Rotated subprocess log {}".format(log_fn))
+    return True
+
+
+def decode_tail(data, max_bytes) -> str:
+    """Return the last max_bytes characters of the output minus the last one"""
+    return data.decode("utf-8", "replace")[-(max_bytes + 1) : -1]
+
+
+class OutputTee(object):
+    """Capture the output of a command through a pipe.
+
+    The agent drains the pipe into the subprocess log and into a ring buffer
+    of the last tail_bytes, so its memory use does not depend on how much
+    the command prints. The log is rotated whenever it grows over
+    rotate_bytes.
+
+    A daemon started by the command inherits the write end. Once the command
+    exits, a detached ``cat`` keeps appending what it writes to the log until
+    it closes the pipe, so it never gets a SIGPIPE, not even after the agent
+    exits.
+    """
+
+    def __init__(self, log_fn, tail_bytes, rotate_bytes=0) -> None:
+        self._log_fn = log_fn
+        self._tail_bytes = tail_bytes
+        self._rotate_bytes = rotate_bytes
+        self._tail = bytearray()
+        self._log = open(log_fn, "ab")
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        self._read_fd = read_fd
+        # stdout and stderr of the command
+        self.writer = os.fdopen(write_fd, "wb")
+
+    def fileno(self) -> int:
+        return self._read_fd
+
+    def close_writer(self) -> None:
+        """Close the agent's copy of the write end once the command started"""
+        if not self.writer.closed:
+            self.writer.close()
+
+    def drain(self) -> bool:
+        """Read what is in the pipe without blocking.
+
+        return: bool, False once the pipe hit EOF
+        """
+        while True:
+            try:
+                chunk = os.read(self._read_fd, READ_CHUNK_BYTES)
+            except BlockingIOError:
+                self._log.flush()
+                return True
+            if not chunk:
+                self._log.flush()
+                return False
+            self._write(chunk)
+
+    def _write(self, chunk) -> None:
+        if self._rotate_bytes and self._log.tell() + len(chunk) > self._rotate_bytes:
+            self._log.close()
+            os.replace(self._log_fn, "{}.1".format(self._log_fn))
+            self._log = open(self._log_fn, "ab")
+        self._log.write(chunk)
+        self._tail += chunk
+        # keep one more byte, the tail drops the last character
+        del self._tail[: -(self._tail_bytes + 1)]
+
+    def get_output(self) -> str:
+        return decode_tail(bytes(self._tail), self._tail_bytes)
+
+    def _hand_over(self) -> None:
+        """Keep draining the pipe in a process of its own"""
+        _drainers[:] = [drainer for drainer in _drainers if drainer.poll() is None]
+        # the flag belongs to the open pipe, which cat shares
+        os.set_blocking(self._read_fd, True)
+        try:
+            _drainers.append(
+                subprocess.Popen(
+                    ["cat"],
+                    stdin=self._read_fd,
+                    stdout=self._log,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True,
+                )
+            )
+            log.info("The pipe of {} is still open, drain it".format(self._log_fn))
+        except OSError:
+            log.exception("Failed: drain the pipe of {}".format(self._log_fn))
+
+    def close(self) -> None:
+        self.close_writer()
+        if self._read_fd is not None:
+            if self.drain():
+                self._hand_over()
+            os.close(self._read_fd)
+            self._read_fd = None
+        self._log.close()
@@ -12,20 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import fnmatch
 import logging
-from typing import Generator, Optional, Union
+import math
+import queue
+import threading
+import time
+from typing import Generator, List, Optional, Union
 from deployd import (
     __version__,
     IS_PINTEREST,
     METRIC_PORT_HEALTH,
     METRIC_CACHE_PATH,
+    METRIC_QUEUE_SIZE,
+    METRIC_FLUSH_INTERVAL_MS,
+    METRIC_REPLAY_RATE,
+    METRIC_AGGREGATION,
+    METRIC_AGGREGATION_WINDOW_SEC,
+    METRIC_COUNTER_AGGREGATION,
+    METRIC_STATSD_ADDR,
     STATSBOARD_URL,
 )
 import timeit
 import socket
 import json
 import os
-import requests
 
 if IS_PINTEREST:
     from pinstatsd.statsd import sc, sc_v2, statsd_context_timer
@@ -63,9 +75,16 @@ class TimingOnlyStatClient:
     """timing only stat client in order to use caching"""
 
     @staticmethod
-    def timing(*args, **kwargs) -> None:
-        client = MetricClient()
-        return client.send_context_timer(*args, **kwargs)
+    def timing(name, value, sample_rate=None, tags=None) -> None:
+        _pipeline.put(
+            Stat(
+                mtype="timing",
+                name=name,
+                value=value,
+                sample_rate=sample_rate,
+                tags=tags,
+            )
+        )
 
 
 def create_stats_timer(name, sample_rate=1.0, tags=None):
@@ -83,33 +102,35 @@ def create_stats_timer(name, sample_rate=1.0, tags=None):
 
 def create_sc_timing(name, value, sample_rate=1.0, tags=None) -> None:
     if IS_PINTEREST:
-        mtype = "timing"
-        client = MetricClient()
-        client.send(
-            mtype=mtype, name=name, value=value, sample_rate=sample_rate, tags=tags
+        _pipeline.put(
+            Stat(
+                mtype="timing",
+                name=name,
+                value=value,
+                sample_rate=sample_rate,
+                tags=tags,
+            )
         )
-    else:
-        return
 
 
 def create_sc_increment(name, sample_rate=1.0, tags=None) -> None:
     if IS_PINTEREST:
-        mtype = "increment"
-        client = MetricClient()
-        client.send(mtype=mtype, name=name, sample_rate=sample_rate, tags=tags)
-    else:
-        return
+        _pipeline.put(
+            Stat(mtype="increment", name=name, sample_rate=sample_rate, tags=tags)
+        )
 
 
 def create_sc_gauge(name, value, sample_rate=1.0, tags=None) -> None:
     if IS_PINTEREST:
-        mtype = "gauge"
-        client = MetricClient()
-        client.send(
-            mtype=mtype, name=name, value=value, sample_rate=sample_rate, tags=tags
+        _pipeline.put(
+            Stat(
+                mtype="gauge",
+                name=name,
+                value=value,
+                sample_rate=sample_rate,
+                tags=tags,
+            )
         )
-    else:
-        return
 
 
 def send_statsboard_metric(name, value, tags=None) -> None:
@@ -118,83 +139,21 @@ def send_statsboard_metric(name, value, tags=None) -> None:
     tags_str = ",".join(tags_params)
     url = f"{STATSBOARD_URL}put/{name}?value={value}&tags={tags_str}"
 
+    import requests
+
     resp = requests.put(url)
     if resp.status_code == 200:
         log.info("Successfully send the metric to statsboard")
 
 
 class MetricCacheConfigurationError(ValueError):
-    """Raised when MetricCache has missing configuration"""
+    """Raised when the metric cache has missing configuration"""
 
     def __init__(self, name, value) -> None:
         msg = "{} is {}".format(name, value)
         super(MetricCacheConfigurationError, self).__init__(msg)
 
 
-class MetricCache:
-    """local cache for metrics
-    creates empty cache file
-    """
-
-    def __init__(self, path=METRIC_CACHE_PATH) -> None:
-        if not path:
-            raise MetricCacheConfigurationError("path", path)
-        self.path = path
-        # maximum cache size in bytes
-        self.max_size = 10 * 1024 * 1024
-        # init cache
-        if not self.exists():
-            self.truncate()
-
-    def limit(self) -> bool:
-        """check to see if cache file has exceeded maximum size
-        return: bool
-        """
-        return os.path.getsize(self.path) > self.max_size
-
-    def exists(self) -> bool:
-        """cache file exists and is read/write
-        return: bool
-        """
-        if (
-            os.access(self.path, os.F_OK)
-            and os.access(self.path, os.R_OK)
-            and os.access(self.path, os.W_OK)
-        ):
-            return True
-        return False
-
-    def is_empty(self) -> bool:
-        """check if the cache not empty
-        return: bool
-        """
-        return not os.stat(self.path).st_size > 0
-
-    def read(self) -> Generator:
-        """read metrics from cache, then delete
-        return: generator
-        """
-        with open(self.path, "r") as fh:
-            for line in fh:
-                yield Stat(ins=line)
-
-    def write(self, output) -> None:
-        """write metrics to cache file respecting max cache size
-        appends newline to metric
-        """
-        if self.limit():
-            msg = "cache file {} has exceeded maximum file size of {}"
-            log.error(msg.format(self.path, self.max_size))
-            return
-        with open(self.path, "a") as fh:
-            fh.write("{}\n".format(output))
-
-    def truncate(self) -> None:
-        """purge cache file"""
-        with open(self.path, "w") as fh:
-            fh.truncate()
-
-
 class Stat:
     """stat class for simple data management, dataclasses are py3.7+
     supports all methods for stats
@@ -254,6 +213,238 @@ class Stat:
         return False
 
 
+def _file_size(path) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class SegmentedMetricCache:
+    """local cache for metrics made of fixed-size segment files
+
+    stats are appended as compact json arrays to the newest segment in
+    <path>.segments, once max_segments are full the oldest segment is
+    evicted, so a long outage loses the oldest metrics instead of the newest.
+    a cache file of json lines left at path by older agents is replayed as
+    the oldest segment.
+    """
+
+    # statsd style type codes, keep the segments compact
+    MTYPE_CODES = {"increment": "c", "gauge": "g", "timing": "ms"}
+    CODE_MTYPES = {code: mtype for mtype, code in MTYPE_CODES.items()}
+
+    def __init__(
+        self, path=METRIC_CACHE_PATH, segment_size=1024 * 1024, max_segments=10
+    ) -> None:
+        if not path:
+            raise MetricCacheConfigurationError("path", path)
+        self.path = path
+        self.segment_dir = "{}.segments".format(path)
+        # maximum segment size in bytes
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+
+    def segments(self) -> List[str]:
+        """segment files, oldest first
+        return: list
+        """
+        try:
+            names = os.listdir(self.segment_dir)
+        except OSError:
+            return []
+        return [
+            os.path.join(self.segment_dir, name)
+            for name in sorted(names)
+            if name.endswith(".seg")
+        ]
+
+    def _next_segment(self, segments) -> str:
+        seq = 0
+        if segments:
+            seq = int(os.path.basename(segments[-1]).split(".")[0]) + 1
+        return os.path.join(self.segment_dir, "{:010d}.seg".format(seq))
+
+    def is_empty(self) -> bool:
+        """check if the cache not empty
+        return: bool
+        """
+        return not _file_size(self.path) and not any(
+            _file_size(fn) for fn in self.segments()
+        )
+
+    @classmethod
+    def encode(cls, stat) -> str:
+        return json.dumps(
+            [
+                cls.MTYPE_CODES.get(stat.mtype, stat.mtype),
+                stat.name,
+                stat.value,
+                stat.sample_rate,
+                stat.tags,
+            ],
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def decode(cls, line) -> Optional[Stat]:
+        """decode a segment line, or a json line of the legacy cache file
+        return: Stat, None on error
+        """
+        if line.startswith("{"):
+            stat = Stat(ins=line)
+            return stat if stat.deserialize() else None
+        try:
+            mtype, name, value, sample_rate, tags = json.loads(line)
+        except (ValueError, TypeError):
+            return None
+        return Stat(
+            mtype=cls.CODE_MTYPES.get(mtype, mtype),
+            name=name,
+            value=value,
+            sample_rate=sample_rate,
+            tags=tags,
+        )
+
+    def write(self, stat) -> None:
+        """append a stat to the newest segment, evict the oldest segments"""
+        self.write_batch([stat])
+
+    def write_batch(self, stats) -> None:
+        """append stats with a single open of the newest segment"""
+        data = "".join("{}\n".format(self.encode(stat)) for stat in stats)
+        with self._lock:
+            segments = self.segments()
+            if not segments or _file_size(segments[-1]) + len(data) > self.segment_size:
+                os.makedirs(self.segment_dir, exist_ok=True)
+                segments.append(self._next_segment(segments))
+            with open(segments[-1], "a") as fh:
+                fh.write(data)
+            for fn in segments[: -self.max_segments]:
+                log.error("metric cache is full, evicting {}".format(fn))
+                self.remove(fn)
+
+    def seal(self) -> List[str]:
+        """start a new segment, so the returned ones are no longer written
+        return: list, files to replay, oldest first
+        """
+        with self._lock:
+            segments = [fn for fn in self.segments() if _file_size(fn)]
+            if segments:
+                open(self._next_segment(segments), "a").close()
+        if _file_size(self.path):
+            segments.insert(0, self.path)
+        return segments
+
+    def read(self, fn) -> Generator:
+        """read the stats of one sealed segment
+        return: generator
+        """
+        try:
+            with open(fn, "r") as fh:
+                lines = fh.readlines()
+        except OSError:
+            # evicted meanwhile
+            return
+        for line in lines:
+            stat = self.decode(line)
+            if stat is None:
+                log.error("unable to parse stat: {}".format(line))
+                continue
+            yield stat
+
+    def remove(self, fn) -> None:
+        """delete a replayed segment"""
+        if fn == self.path:
+            with open(fn, "w") as fh:
+                fh.truncate()
+            return
+        try:
+            os.remove(fn)
+        except FileNotFoundError:
+            pass
+
+
+def merge_stat(merged, stat) -> bool:
+    """merge an increment or a gauge into merged, a dict of the stats so far:
+    increments are summed into one counter, gauges keep the last value
+    return: bool, False for a stat to keep as it is
+    """
+    if stat.mtype not in ("increment", "gauge"):
+        return False
+    key = (
+        stat.mtype,
+        stat.name,
+        stat.sample_rate,
+        json.dumps(stat.tags, sort_keys=True),
+    )
+    first = merged.get(key)
+    if stat.mtype == "increment":
+        count = stat.value if stat.value is not None else 1
+        if first is not None:
+            first.value += count
+            return True
+        stat.value = count
+    elif first is not None:
+        first.value = stat.value
+        return True
+    merged[key] = stat
+    return True
+
+
+def aggregate_stats(stats) -> List[Stat]:
+    """merge stats of the same metric, see merge_stat,
+    timings are kept as they are
+    return: list
+    """
+    merged = {}
+    aggregated = [stat for stat in stats if not merge_stat(merged, stat)]
+    return list(merged.values()) + aggregated
+
+
+class StatsdCounter(object):
+    """send a counter with its count in one statsd packet, name:N|c
+
+    sc.increment always counts one, a counter aggregated from N increments
+    would otherwise take N datagrams. Tags use the dogstatsd format.
+    """
+
+    def __init__(self, addr=METRIC_STATSD_ADDR) -> None:
+        host, _, port = addr.rpartition(":")
+        self._addr = (host or "127.0.0.1", int(port))
+        self._sock = None
+
+    @staticmethod
+    def format(name, count, tags=None) -> bytes:
+        """every increment counted was queued, the count is not sampled"""
+        packet = "{}:{}|c".format(name, count)
+        if tags:
+            packet += "|#" + ",".join(
+                "{}:{}".format(key, value) for key, value in sorted(tags.items())
+            )
+        return packet.encode()
+
+    def send(self, name, count, tags=None) -> None:
+        if self._sock is None:
+            self._sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self._sock.sendto(self.format(name, count, tags), self._addr)
+
+
+class _RateLimiter(object):
+    """block so that at most rate datagrams are sent per second"""
+
+    def __init__(self, rate) -> None:
+        self._interval = 1.0 / rate
+        self._next_send = time.monotonic()
+
+    def wait(self, datagrams) -> None:
+        now = time.monotonic()
+        if self._next_send > now:
+            time.sleep(self._next_send - now)
+        self._next_send = max(self._next_send, now) + datagrams * self._interval
+
+
 class MetricClientConfigurationError(ValueError):
     """Raised when MetricClient has missing configuration"""
 
@@ -265,12 +456,24 @@ class MetricClientConfigurationError(ValueError):
 class MetricClient:
     """metrics client wrapper, enables disk cache"""
 
+    # seconds a health check result is reused
+    HEALTH_CHECK_TTL = 5
+    # time.monotonic() of the last health check and its result
+    _health = (None, False)
+    # datagrams sent per second by the replay thread
+    REPLAY_RATE = METRIC_REPLAY_RATE
+    # every stat is sent to sc and sc_v2
+    DATAGRAMS_PER_STAT = 2
+    # one replay thread per process
+    _replay_lock = threading.Lock()
+    _replay_thread = None
+
     def __init__(self, port=METRIC_PORT_HEALTH, cache_path=METRIC_CACHE_PATH) -> None:
         if not port:
             raise MetricClientConfigurationError("port", port)
         self.port = port
-        self.cache = MetricCache(path=cache_path)
-        self.stat = None
+        self.cache = SegmentedMetricCache(path=cache_path)
+        self._counter = None
 
     @staticmethod
     def _add_default_tags(tags=None) -> Optional[dict]:
@@ -295,68 +498,119 @@ class MetricClient:
             mtype=mtype, name=name, value=value, sample_rate=sample_rate, tags=tags
         )
 
-    def _send_mtype(self) -> None:
+    def _get_counter(self) -> StatsdCounter:
+        if self._counter is None:
+            self._counter = StatsdCounter()
+        return self._counter
+
+    def _increment(self, func, name, stat) -> None:
+        """increment by the count of an aggregated stat, sent as one packet"""
+        count = stat.value if stat.value is not None else 1
+        if count == 1:
+            func(name, stat.sample_rate, stat.tags)
+        else:
+            self._get_counter().send(name, count, stat.tags)
+
+    def _send_mtype(self, stat) -> None:
         """send metric to sc using corrected
         calls per metric type
         """
-        func = getattr(sc, self.stat.mtype)
-        func_v2 = getattr(sc_v2, self.stat.mtype)
+        func = getattr(sc, stat.mtype)
+        func_v2 = getattr(sc_v2, stat.mtype)
 
         # remove specific tags
-        if isinstance(self.stat.tags, dict):
-            self.stat.tags.pop("host", None)
+        if isinstance(stat.tags, dict):
+            stat.tags.pop("host", None)
 
         # name suffix to differentiate sc from sc_v2
-        name_sc_v2 = "{}.cluster".format(self.stat.name)
+        name_sc_v2 = "{}.cluster".format(stat.name)
 
-        if self.stat.mtype == "increment":
+        if stat.mtype == "increment":
             # v2 is called first due to tag mutability
-            func_v2(name_sc_v2, self.stat.sample_rate, self.stat.tags)
-            func(self.stat.name, self.stat.sample_rate, self.stat.tags)
-        elif self.stat.mtype == "gauge" or self.stat.mtype == "timing":
+            self._increment(func_v2, name_sc_v2, stat)
+            self._increment(func, stat.name, stat)
+        elif stat.mtype == "gauge" or stat.mtype == "timing":
             func_v2(
                 name_sc_v2,
-                self.stat.value,
-                sample_rate=self.stat.sample_rate,
-                tags=self.stat.tags,
+                stat.value,
+                sample_rate=stat.sample_rate,
+                tags=stat.tags,
             )
             func(
-                self.stat.name,
-                self.stat.value,
-                sample_rate=self.stat.sample_rate,
-                tags=self.stat.tags,
+                stat.name,
+                stat.value,
+                sample_rate=stat.sample_rate,
+                tags=stat.tags,
             )
         else:
             msg = "encountered unsupported mtype:{} while sending name:{}, value:{}, sample_rate:{}, tags:{}"
             log.error(
                 msg.format(
-                    self.stat.mtype,
-                    self.stat.name,
-                    self.stat.value,
-                    self.stat.sample_rate,
-                    self.stat.tags,
+                    stat.mtype,
+                    stat.name,
+                    stat.value,
+                    stat.sample_rate,
+                    stat.tags,
                 )
             )
 
-    def _send(self) -> None:
+    def _send(self, stat) -> None:
         """send metric to sc"""
         try:
-            self._send_mtype()
+            self._send_mtype(stat)
         except Exception as error:
             log.error("unable to send metric: {}".format(error))
 
-    def _flush_cache(self) -> None:
-        """read from cache, send every metric, truncate cache"""
-        log.warning("flushing metrics from cache")
-        for stat in self.cache.read():
-            if not stat.deserialize():
-                # unable to parse stat, skip
-                log.error("unable to parse stat: {}".format(stat))
-                continue
-            self.stat = stat
-            self._send()
-        # truncate cache file after flush
-        self.cache.truncate()
+    @classmethod
+    def _reset_after_fork(cls) -> None:
+        """in a forked child, the replay lock may be held by a parent thread"""
+        cls._replay_lock = threading.Lock()
+        cls._replay_thread = None
+
+    def _start_replay(self) -> None:
+        """replay the cache in a background thread, unless one is running"""
+        with MetricClient._replay_lock:
+            thread = MetricClient._replay_thread
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(
+                target=self._replay_cache, name="metric-replay", daemon=True
+            )
+            MetricClient._replay_thread = thread
+            thread.start()
+
+    def _replay_stat(self, stat, limiter) -> None:
+        """send a cached stat, charging its datagrams to the limiter"""
+        limiter.wait(self.DATAGRAMS_PER_STAT)
+        self._send(stat)
+
+    def _replay_cache(self) -> None:
+        """send the sealed segments rate limited: timings as they are read,
+        increments and gauges merged across all the segments at the end.
+        every segment is deleted once read, the merged stats are written
+        back to the cache if the sink goes down before they are sent
+        """
+        log.warning("replaying metrics from cache")
+        limiter = _RateLimiter(self.REPLAY_RATE)
+        merged = {}
+        try:
+            for fn in self.cache.seal():
+                if not self.is_healthy_cached():
+                    log.warning("metric sink is down, stop replaying the cache")
+                    break
+                for stat in self.cache.read(fn):
+                    if not merge_stat(merged, stat):
+                        self._replay_stat(stat, limiter)
+                self.cache.remove(fn)
+            else:
+                if self.is_healthy_cached():
+                    for stat in merged.values():
+                        self._replay_stat(stat, limiter)
+                    return
+            if merged:
+                self.cache.write_batch(list(merged.values()))
+        except Exception:
+            log.exception("unable to replay the metric cache")
 
     def send_context_timer(self, name, value, sample_rate=None, tags=None) -> None:
         """convert a context_timer to timing
@@ -371,22 +625,41 @@ class MetricClient:
     ) -> None:
         """add default tags, send metric, write to, or flush cache
         depending on health check"""
-        tags = self._add_default_tags(tags)
-        if self.is_healthy():
-            # trigger flush cache first
-            if self.cache and (self.cache.exists() and not self.cache.is_empty()):
-                self._flush_cache()
-            # send metric
-            self.stat = self._parse_stat(
-                mtype=mtype, name=name, value=value, sample_rate=sample_rate, tags=tags
-            )
-            self._send()
-        else:
-            # health check failed, write stat to cache
-            stat = self._parse_stat(
-                mtype=mtype, name=name, value=value, sample_rate=sample_rate, tags=tags
-            )
-            self.cache.write(stat.serialize())
+        self.send_batch(
+            [
+                self._parse_stat(
+                    mtype=mtype,
+                    name=name,
+                    value=value,
+                    sample_rate=sample_rate,
+                    tags=tags,
+                )
+            ]
+        )
+
+    def send_batch(self, stats) -> None:
+        """send stats after a single health check, cache them when it fails"""
+        healthy = self.is_healthy_cached()
+        if healthy and not self.cache.is_empty():
+            self._start_replay()
+        for stat in stats:
+            stat.tags = self._add_default_tags(stat.tags)
+            if healthy:
+                self._send(stat)
+        if not healthy and stats:
+            # health check failed, write stats to cache
+            self.cache.write_batch(stats)
+
+    def is_healthy_cached(self) -> bool:
+        """is_healthy, reusing the last result for HEALTH_CHECK_TTL seconds
+        return: bool
+        """
+        now = time.monotonic()
+        checked_at, healthy = MetricClient._health
+        if checked_at is None or now - checked_at > self.HEALTH_CHECK_TTL:
+            healthy = self.is_healthy()
+            MetricClient._health = (now, healthy)
+        return healthy
 
     def is_healthy(self) -> bool:
         """health-check by connecting to local IPv4 TCP listening socket
@@ -407,6 +680,287 @@ class MetricClient:
         return passing
 
 
+class DDSketch(object):
+    """quantile sketch with a bounded relative error
+
+    values are counted in logarithmic buckets of ratio gamma, so any quantile
+    is within relative_accuracy of the exact one whatever the distribution,
+    in memory proportional to the log of the value range.
+    """
+
+    def __init__(self, relative_accuracy=0.01) -> None:
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets = {}
+        # values too small for a bucket, timings are never negative
+        self._zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value) -> None:
+        if value > 1e-9:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+        else:
+            self._zero_count += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q) -> Optional[float]:
+        """return: float, the value at quantile q in [0, 1], None when empty"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self._zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if rank < seen:
+                # midpoint of the bucket (gamma^(i-1), gamma^i]
+                value = 2 * self._gamma**index / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+
+class MetricAggregator(object):
+    """aggregate counters and timings on the host over a window
+
+    stats whose name matches one of the patterns are kept instead of sent,
+    increments also when they match one of the counter patterns, all of them
+    by default: increments of the same metric and tags are summed into one
+    counter, sent as a single statsd packet, timings go into a
+    DDSketch and are sent as the gauges <name>.count, <name>.p50,
+    <name>.p90, <name>.p99 and <name>.max once the window is over.
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(
+        self,
+        patterns=METRIC_AGGREGATION,
+        window=METRIC_AGGREGATION_WINDOW_SEC,
+        counter_patterns=METRIC_COUNTER_AGGREGATION,
+    ) -> None:
+        self._patterns = self._split(patterns)
+        self._counter_patterns = self._patterns + self._split(counter_patterns)
+        self._window = window
+        self._matches = {}
+        self._counter_matches = {}
+        self._counters = {}
+        self._timings = {}
+        self._window_start = time.monotonic()
+
+    @staticmethod
+    def _split(patterns) -> List[str]:
+        if isinstance(patterns, str):
+            patterns = patterns.split(",")
+        return [pattern.strip() for pattern in patterns if pattern.strip()]
+
+    @staticmethod
+    def _match(name, patterns, matches) -> bool:
+        matched = matches.get(name)
+        if matched is None:
+            matched = any(fnmatch.fnmatchcase(name, p) for p in patterns)
+            matches[name] = matched
+        return matched
+
+    @staticmethod
+    def _key(stat) -> tuple:
+        return (stat.name, stat.sample_rate, json.dumps(stat.tags, sort_keys=True))
+
+    def offer(self, stat) -> bool:
+        """aggregate the stat if configured for it
+        return: bool, False when the stat must be sent as is
+        """
+        if stat.mtype == "increment":
+            if not self._match(
+                stat.name, self._counter_patterns, self._counter_matches
+            ):
+                return False
+        elif stat.mtype != "timing" or not self._match(
+            stat.name, self._patterns, self._matches
+        ):
+            return False
+        key = self._key(stat)
+        if stat.mtype == "increment":
+            counter = self._counters.get(key)
+            count = stat.value if stat.value is not None else 1
+            if counter is None:
+                stat.value = count
+                self._counters[key] = stat
+            else:
+                counter.value += count
+        elif isinstance(stat.value, (int, float)):
+            entry = self._timings.get(key)
+            if entry is None:
+                entry = self._timings[key] = (stat, DDSketch())
+            entry[1].add(stat.value)
+        else:
+            return False
+        return True
+
+    def flush(self, force=False) -> List[Stat]:
+        """return: list, the aggregated stats once the window is over"""
+        now = time.monotonic()
+        if not force and now - self._window_start < self._window:
+            return []
+        self._window_start = now
+        stats = list(self._counters.values())
+        for stat, sketch in self._timings.values():
+            summary = [("count", sketch.count)]
+            summary.extend(
+                ("p{}".format(p), sketch.quantile(p / 100.0)) for p in self.PERCENTILES
+            )
+            summary.append(("max", sketch.max))
+            for suffix, value in summary:
+                stats.append(
+                    Stat(
+                        mtype="gauge",
+                        name="{}.{}".format(stat.name, suffix),
+                        value=value,
+                        sample_rate=stat.sample_rate,
+                        tags=dict(stat.tags) if stat.tags else stat.tags,
+                    )
+                )
+        self._counters = {}
+        self._timings = {}
+        return stats
+
+
+class MetricPipeline(object):
+    """Process-wide queue between the metric calls and the MetricClient.
+
+    create_sc_* only put the stat on a bounded queue, a daemon thread sends
+    the queued stats in one batch every flush interval through one
+    MetricClient. Stats are written to its cache when the queue is full
+    or the sink is down. Stats configured for aggregation go through a
+    MetricAggregator and are sent once per aggregation window.
+    """
+
+    def __init__(
+        self,
+        max_size=METRIC_QUEUE_SIZE,
+        flush_interval=METRIC_FLUSH_INTERVAL_MS / 1000.0,
+        client_factory=MetricClient,
+        aggregator_factory=MetricAggregator,
+    ) -> None:
+        self._max_size = max_size
+        self._flush_interval = flush_interval
+        self._client_factory = client_factory
+        self._client = None
+        self._aggregator_factory = aggregator_factory
+        self._aggregator = aggregator_factory()
+        self._queue = queue.Queue(maxsize=max_size)
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _get_client(self) -> MetricClient:
+        if self._client is None:
+            self._client = self._client_factory()
+        return self._client
+
+    def _reset_after_fork(self) -> None:
+        """in a forked child, drop the parent's queue, lock and thread"""
+        if self._pid is None or self._pid == os.getpid():
+            return
+        self._queue = queue.Queue(maxsize=self._max_size)
+        self._flush_lock = threading.Lock()
+        self._client = None
+        self._aggregator = self._aggregator_factory()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def _ensure_started(self) -> None:
+        self._reset_after_fork()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self._pid is None:
+            atexit.register(self.flush)
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._run, name="metric-pipeline", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, stat) -> None:
+        """queue a stat, never blocks on the network"""
+        if stat.tags:
+            # the caller may reuse its tags dict
+            stat.tags = dict(stat.tags)
+        try:
+            self._ensure_started()
+            self._queue.put_nowait(stat)
+        except queue.Full:
+            self._spill([stat])
+        except Exception:
+            log.exception("unable to queue metric {}".format(stat.name))
+
+    def _spill(self, stats) -> None:
+        try:
+            client = self._get_client()
+            for stat in stats:
+                stat.tags = client._add_default_tags(stat.tags)
+                client.cache.write(stat)
+        except Exception as error:
+            log.error("unable to cache metrics: {}".format(error))
+
+    def _drain(self) -> List[Stat]:
+        stats = []
+        while True:
+            try:
+                stats.append(self._queue.get_nowait())
+            except queue.Empty:
+                return stats
+
+    def flush(self, force=True) -> None:
+        """send everything queued so far
+        :param force: also send the aggregates before the window is over
+        """
+        self._reset_after_fork()
+        with self._flush_lock:
+            stats = [stat for stat in self._drain() if not self._aggregator.offer(stat)]
+            stats.extend(self._aggregator.flush(force=force))
+            if not stats:
+                return
+            try:
+                self._get_client().send_batch(stats)
+            except Exception as error:
+                log.error("unable to send metrics: {}".format(error))
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self._flush_interval)
+            try:
+                self.flush(force=False)
+            except Exception:
+                # the thread must not die, stats would pile up in the queue
+                log.exception("unable to flush metrics")
+
+
+_pipeline = MetricPipeline()
+
+
+def _reset_after_fork() -> None:
+    # the locks may be held by another thread of the parent at fork time
+    MetricClient._reset_after_fork()
+    _pipeline._reset_after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def flush_metrics() -> None:
+    """send the queued metrics now, for processes about to os._exit"""
+    if IS_PINTEREST:
+        _pipeline.flush()
+
+
 class TimeElapsed:
     """keep track of elapsed time in seconds"""
 
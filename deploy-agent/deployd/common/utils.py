@@ -14,16 +14,17 @@
 
 import code
 import errno
+import fcntl
 import hashlib
 import logging
 import os
+import shutil
 import signal
 import sys
 import traceback
 import subprocess
-from typing import Any, Optional, Union
+from typing import Any, Generator, Optional, Union
 import yaml
-import requests
 
 
 import json
@@ -37,6 +38,9 @@ from deployd.common.stats import (
 
 log = logging.getLogger(__name__)
 
+# ioctl request number of FICLONE, see linux/fs.h
+FICLONE = 0x40049409
+
 # noinspection PyProtectedMember
 
 
@@ -102,6 +106,36 @@ def mkdir_p(path) -> None:
             raise
 
 
+def link_or_copy(src, dst) -> str:
+    """Materialize src at dst without copying the data when possible.
+
+    Try a hardlink first, then a reflink, and copy as a last resort.
+    return: str, the method used: "hardlink", "reflink" or "copy"
+    """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            raise
+    return reflink_or_copy(src, dst)
+
+
+def reflink_or_copy(src, dst) -> str:
+    """Write the content of src to a new file dst, sharing its blocks if possible.
+
+    Unlike a hardlink, dst is an inode of its own.
+    return: str, the method used: "reflink" or "copy"
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return "reflink"
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    return "copy"
+
+
 def uptime() -> int:
     """return int: seconds of uptime in int, default 0"""
     sec = 0
@@ -121,7 +155,10 @@ def ensure_dirs(config) -> None:
 
 def is_first_run(config) -> bool:
     env_status_file = config.get_env_status_fn()
-    return not os.path.exists(env_status_file)
+    return not (
+        os.path.exists(env_status_file)
+        or os.path.exists("{}.db".format(env_status_file))
+    )
 
 
 def check_prereqs(config) -> bool:
@@ -266,8 +303,9 @@ def redeploy_check_for_non_container(commit, service, redeploy, healthcheckConfi
     return service + ":unhealthy"
 
 
-def redeploy_check_without_container_status(commit, service, redeploy):
-    log.info(f"Get health info for service {service} with commit {commit}")
+def read_healthcheck_configs(service) -> Optional[dict]:
+    """the healthcheck configs of a non container service, None without
+    an http healthcheck"""
     fn = os.path.join("/mnt/deployd/", "{}_HEALTHCHECK".format(service))
     if not os.path.isfile(fn):
         return None
@@ -275,90 +313,137 @@ def redeploy_check_without_container_status(commit, service, redeploy):
         healthcheckConfigs = dict(
             (n.strip("\"\n' ") for n in line.split("=", 1)) for line in f
         )
-        if "HEALTHCHECK_HTTP" not in healthcheckConfigs:
-            return None
-        log.info(f"Healthcheck is enabled on service {service}")
-        url = healthcheckConfigs["HEALTHCHECK_HTTP"]
-        if "http://" not in url:
-            url = "http://" + url
-        try:
-            resp = requests.get(url)
-            if resp.status_code >= 200 and resp.status_code < 300:
-                create_sc_increment(
-                    name="deployd.service_health_status",
-                    tags={"status": "healthy", "service": service, "commit": commit},
-                )
-                return service + ":healthy"
-        except requests.ConnectionError:
-            return redeploy_check_for_non_container(
-                commit, service, redeploy, healthcheckConfigs
+    if "HEALTHCHECK_HTTP" not in healthcheckConfigs:
+        return None
+    return healthcheckConfigs
+
+
+def get_healthcheck_url(healthcheckConfigs) -> str:
+    url = healthcheckConfigs["HEALTHCHECK_HTTP"]
+    if "http://" not in url:
+        url = "http://" + url
+    return url
+
+
+def check_http_health(url, timeout=None) -> bool:
+    """True on a 2xx response, raises requests.RequestException when down or
+    slower than timeout"""
+    import requests
+
+    resp = requests.get(url, timeout=timeout)
+    return resp.status_code >= 200 and resp.status_code < 300
+
+
+def redeploy_check_without_container_status(
+    commit, service, redeploy, http_check=check_http_health
+):
+    log.info(f"Get health info for service {service} with commit {commit}")
+    healthcheckConfigs = read_healthcheck_configs(service)
+    if not healthcheckConfigs:
+        return None
+    # imported on use, the stager and downloader import this module too
+    import requests
+
+    log.info(f"Healthcheck is enabled on service {service}")
+    try:
+        if http_check(get_healthcheck_url(healthcheckConfigs)):
+            create_sc_increment(
+                name="deployd.service_health_status",
+                tags={"status": "healthy", "service": service, "commit": commit},
             )
-        return redeploy_check_for_non_container(
-            commit, service, redeploy, healthcheckConfigs
+            return service + ":healthy"
+    except requests.RequestException:
+        pass
+    return redeploy_check_for_non_container(
+        commit, service, redeploy, healthcheckConfigs
+    )
+
+
+def get_docker_cli_containers(commit) -> Generator:
+    """(name, labels, health status) of the running containers matching
+    commit, with one docker inspect each"""
+    cmd = ["docker", "ps", "--format", "{{.Image}};{{.Names}};{{.Labels}}"]
+    output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE).stdout
+    if not output:
+        return
+    lines = output.decode().strip().splitlines()
+    for line in lines:
+        if commit in line:
+            parts = line.split(";")
+            name = parts[1]
+            try:
+                command = [
+                    "docker",
+                    "inspect",
+                    "-f",
+                    "{{.State.Health.Status}}",
+                    name,
+                ]
+                status = subprocess.run(
+                    command, check=True, stdout=subprocess.PIPE
+                ).stdout
+            except Exception:
+                continue
+            if status:
+                yield name, parts[2], status.decode().strip()
+
+
+def get_health_info_from_containers(
+    containers, commit, service, redeploy
+) -> Optional[str]:
+    """
+    Health info of the containers of a service:
+    :param containers: (name, labels, health status) of the containers
+        running commit, labels formatted like docker ps does
+    return: str, name:status of every container or redeploy-N, None without
+        a container
+    """
+    result = []
+    for name, labels, status in containers:
+        try:
+            if status == "unhealthy" and "redeploy_when_unhealthy=enabled" in labels:
+                ret = redeploy_check_for_container(labels.split(","), service, redeploy)
+                if ret > 0:
+                    create_sc_increment(
+                        name="deployd.service_health_status",
+                        tags={
+                            "status": "redeploy",
+                            "service": service,
+                            "commit": commit,
+                        },
+                    )
+                    return "redeploy-" + str(ret)
+            result.append(f"{name}:{status}")
+        except Exception:
+            continue
+    returnValue = ";".join(result) if result else None
+    if returnValue and "unhealthy" in returnValue:
+        create_sc_increment(
+            name="deployd.service_health_status",
+            tags={"status": "unhealthy", "service": service, "commit": commit},
         )
+    elif returnValue and "unhealthy" not in returnValue:
+        create_sc_increment(
+            name="deployd.service_health_status",
+            tags={"status": "healthy", "service": service, "commit": commit},
+        )
+    return returnValue
 
 
-def get_container_health_info(commit, service, redeploy) -> Optional[str]:
+def get_container_health_info(
+    commit, service, redeploy, http_check=check_http_health
+) -> Optional[str]:
     try:
         log.info(f"Get health info for service {service} with commit {commit}")
-        result = []
-        cmd = ["docker", "ps", "--format", "{{.Image}};{{.Names}};{{.Labels}}"]
-        output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE).stdout
-        if output:
-            lines = output.decode().strip().splitlines()
-            for line in lines:
-                if commit in line:
-                    parts = line.split(";")
-                    name = parts[1]
-                    try:
-                        command = [
-                            "docker",
-                            "inspect",
-                            "-f",
-                            "{{.State.Health.Status}}",
-                            name,
-                        ]
-                        status = subprocess.run(
-                            command, check=True, stdout=subprocess.PIPE
-                        ).stdout
-                        if status:
-                            status = status.decode().strip()
-                            if (
-                                status == "unhealthy"
-                                and "redeploy_when_unhealthy=enabled" in parts[2]
-                            ):
-                                labels = parts[2].split(",")
-                                ret = redeploy_check_for_container(
-                                    labels, service, redeploy
-                                )
-                                if ret > 0:
-                                    create_sc_increment(
-                                        name="deployd.service_health_status",
-                                        tags={
-                                            "status": "redeploy",
-                                            "service": service,
-                                            "commit": commit,
-                                        },
-                                    )
-                                    return "redeploy-" + str(ret)
-                            result.append(f"{name}:{status}")
-                    except Exception:
-                        continue
-            returnValue = ";".join(result) if result else None
-            if returnValue and "unhealthy" in returnValue:
-                create_sc_increment(
-                    name="deployd.service_health_status",
-                    tags={"status": "unhealthy", "service": service, "commit": commit},
-                )
-            elif returnValue and "unhealthy" not in returnValue:
-                create_sc_increment(
-                    name="deployd.service_health_status",
-                    tags={"status": "healthy", "service": service, "commit": commit},
-                )
-            if returnValue:
-                return returnValue
+        returnValue = get_health_info_from_containers(
+            get_docker_cli_containers(commit), commit, service, redeploy
+        )
+        if returnValue:
+            return returnValue
         # if no check happens for the current service, check if it is a non container with healthcheck enabled
-        return redeploy_check_without_container_status(commit, service, redeploy)
+        return redeploy_check_without_container_status(
+            commit, service, redeploy, http_check=http_check
+        )
     except Exception:
         log.error(f"Failed to get container health info with commit {commit}")
         return None
@@ -0,0 +1,290 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deploy several environments of a host at the same time.
+
+Instead of the single goal of a regular ping, the agent asks the server for
+the deploy candidates of every environment with pending work
+(/system/ping/alldeploycandidates), ordered by priority. Goals of the same
+systemPriority have no declared ordering between them, so their stages run
+side by side in worker slots, each env with its own config, executor and
+subprocess log. Goals of another priority, or without one, wait until the
+running envs are done, which keeps the order of a serial agent.
+"""
+
+import copy
+import logging
+import threading
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+from deployd import MAIN_LOGGER
+from deployd.common.executor import Executor
+from deployd.common.types import (
+    AgentStatus,
+    DeployReport,
+    DeployStage,
+    DeployStatus,
+    OpCode,
+    PingStatus,
+)
+from deployd.types.ping_response import PingResponse
+
+log: logging.Logger = logging.getLogger(name=MAIN_LOGGER)
+
+# stop deploying an env for this run after one of these, like a serial agent
+FAILED_STATUSES = (
+    AgentStatus.AGENT_FAILED,
+    AgentStatus.TOO_MANY_RETRY,
+    AgentStatus.SCRIPT_TIMEOUT,
+)
+
+
+def select_concurrent_goals(candidates, running, slots) -> List[PingResponse]:
+    """Pick the candidates to start now.
+
+    :param candidates: PingResponses with a goal, in the order of the server
+    :param running: dict of env name -> systemPriority of the envs in flight
+    :param slots: number of free worker slots
+    """
+    if not candidates or slots <= 0:
+        return []
+    priority = candidates[0].deployGoal.systemPriority
+    if priority is None and running:
+        return []
+    if any(p is None or p != priority for p in running.values()):
+        return []
+    selected = []
+    for response in candidates:
+        goal = response.deployGoal
+        if goal.systemPriority != priority:
+            break
+        if goal.envName not in running:
+            selected.append(response)
+        if priority is None:
+            break
+    return selected[:slots]
+
+
+class EnvWorker(object):
+    """Run the deploy stage of one env in a worker slot.
+
+    The env gets a copy of the agent config, so its deploy variables are
+    passed to its commands instead of being exported into the agent.
+    """
+
+    def __init__(self, agent, status, callback) -> None:
+        self._agent = agent
+        self._status = status
+        self._config = agent._config.copy()
+        self._executor = Executor(callback=callback)
+        self._executor.ISOLATED = True
+        # load the deploy goal to the config, as the serial agent does
+        self._config.update_variables(status)
+        self._executor.update_configs(self._config)
+
+    def run(self, deploy_goal) -> DeployReport:
+        curr_stage = deploy_goal.deployStage
+        log.info(
+            "The current deploy stage of {} is: {}".format(
+                deploy_goal.envName, curr_stage
+            )
+        )
+        if curr_stage == DeployStage.DOWNLOADING:
+            return self._executor.run_cmd(
+                self._agent.get_download_script(deploy_goal, status=self._status)
+            )
+        elif curr_stage == DeployStage.STAGING:
+            return self._executor.run_cmd(
+                self._agent.get_staging_script(status=self._status, config=self._config)
+            )
+        else:
+            return self._executor.execute_command(curr_stage)
+
+
+class ConcurrentDeploy(object):
+    """Drive the goals of all the envs of a DeployAgent with worker slots"""
+
+    def __init__(self, agent, slots) -> None:
+        self._agent = agent
+        self._slots = slots
+        # guards the env reports and pings shared by the worker slots
+        self._lock = threading.RLock()
+        # env name -> goal of the envs in flight
+        self._goals = {}
+        # env name -> latest goal of the server
+        self._latest = {}
+        # env name -> (goal, TimeElapsed) of the stage timer of the env
+        self._stage_timers = {}
+        self._failed = set()
+
+    def _ping(self) -> Optional[List[PingResponse]]:
+        with self._lock:
+            if not self._agent._env_status.dump_envs(self._agent._envs):
+                # like _update_ping_reports, report the envs in flight as
+                # agent failures so the server aborts their deploys
+                for env_name in self._goals:
+                    status = self._agent._envs.get(env_name)
+                    if status:
+                        status.update_by_deploy_report(
+                            DeployReport(
+                                status_code=AgentStatus.AGENT_FAILED,
+                                error_code=1,
+                                output_msg="Failed to dump status to the disk",
+                            )
+                        )
+            # the workers keep updating the reports during the ping
+            envs = copy.deepcopy(self._agent._envs)
+        candidates = self._agent._client.get_deploy_candidates(envs)
+        if candidates is not None:
+            latest = {
+                response.deployGoal.envName: response.deployGoal
+                for response in candidates
+                if response.deployGoal
+            }
+            with self._lock:
+                self._latest = latest
+        return candidates
+
+    def ping_env(self, env_name, deploy_report) -> int:
+        """Executor callback: report the progress of env_name, check its goal"""
+        with self._lock:
+            status = self._agent._envs.get(env_name)
+            if status:
+                status.update_by_deploy_report(deploy_report)
+        if self._ping() is None:
+            return PingStatus.PING_FAILED
+        with self._lock:
+            goal = self._goals[env_name]
+            latest = self._latest.get(env_name)
+        # like plan_changed, a goal gone from the server is a change
+        if (
+            not latest
+            or latest.deployId != goal.deployId
+            or latest.deployStage != goal.deployStage
+        ):
+            return PingStatus.PLAN_CHANGED
+        return PingStatus.PLAN_NO_CHANGE
+
+    def _update_stage_timer(self, env_name, deploy_goal=None) -> None:
+        """close the stage timer of env_name, start one for deploy_goal"""
+        previous = self._stage_timers.get(env_name)
+        if previous and deploy_goal is not None and previous[0] == deploy_goal:
+            return
+        if previous:
+            self._agent._send_stage_time_elapsed(*self._stage_timers.pop(env_name))
+        if deploy_goal is not None:
+            self._stage_timers[env_name] = (
+                deploy_goal,
+                self._agent._start_stage_time_elapsed(deploy_goal),
+            )
+
+    def _remove_env(self, deploy_goal) -> None:
+        with self._lock:
+            env_name = self._agent._resolve_deleted_env_name(
+                deploy_goal.envName, deploy_goal.envId
+            )
+            if env_name in self._agent._envs:
+                del self._agent._envs[env_name]
+            else:
+                log.info("Cannot find env {} in the ping report".format(env_name))
+
+    def _start(self, pool, response) -> object:
+        deploy_goal = response.deployGoal
+        env_name = deploy_goal.envName
+        with self._lock:
+            status = self._agent._envs.get(env_name)
+            if status is None:
+                status = self._agent._envs[env_name] = DeployStatus()
+            status.update_by_response(response)
+            self._agent._write_script_variables(deploy_goal)
+            self._update_stage_timer(env_name, deploy_goal)
+            self._goals[env_name] = deploy_goal
+            worker = EnvWorker(
+                self._agent,
+                status,
+                lambda deploy_report: self.ping_env(env_name, deploy_report),
+            )
+        log.info("Start deploy goal {} in a worker slot".format(deploy_goal))
+        return pool.submit(worker.run, deploy_goal)
+
+    def _finish(self, env_name, future) -> None:
+        try:
+            deploy_report = future.result()
+        except Exception:
+            deploy_report = DeployReport(
+                status_code=AgentStatus.AGENT_FAILED,
+                error_code=1,
+                output_msg=traceback.format_exc(),
+                retry_times=1,
+            )
+        with self._lock:
+            deploy_goal = self._goals.pop(env_name)
+            status = self._agent._envs.get(env_name)
+            if status:
+                status.update_by_deploy_report(deploy_report)
+            self._agent._send_deploy_status_stats(deploy_report, deploy_goal)
+        if deploy_report.status_code in FAILED_STATUSES:
+            log.error(
+                "Unexpected exceptions in {}: {}, error message {}".format(
+                    env_name, deploy_report.status_code, deploy_report.output_msg
+                )
+            )
+            self._failed.add(env_name)
+
+    def run(self) -> None:
+        candidates = self._ping()
+        self._agent._clear_reset_state()
+        futures: Dict[object, str] = {}
+        with ThreadPoolExecutor(max_workers=self._slots) as pool:
+            while candidates is not None:
+                pending = []
+                for response in candidates:
+                    deploy_goal = response.deployGoal
+                    if not deploy_goal or response.opCode == OpCode.NOOP:
+                        continue
+                    if deploy_goal.envName in self._failed:
+                        continue
+                    if response.opCode in (OpCode.TERMINATE, OpCode.DELETE):
+                        if deploy_goal.envName not in self._goals:
+                            self._remove_env(deploy_goal)
+                        continue
+                    pending.append(response)
+
+                running = {
+                    name: goal.systemPriority for name, goal in self._goals.items()
+                }
+                for response in select_concurrent_goals(
+                    pending, running, self._slots - len(futures)
+                ):
+                    futures[self._start(pool, response)] = response.deployGoal.envName
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._finish(futures.pop(future), future)
+                candidates = self._ping()
+
+            # the server is unreachable, let the running envs finish
+            for future in list(futures):
+                self._finish(futures.pop(future), future)
+
+        self._ping()
+        for env_name in list(self._stage_timers):
+            self._update_stage_timer(env_name)
+        for env_name in list(self._agent._envs):
+            self._agent.clean_stale_builds(env_name)
+        log.info("Complete the deploy with {} worker slots".format(self._slots))
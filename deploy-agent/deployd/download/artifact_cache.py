@@ -0,0 +1,156 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import lockfile
+
+from deployd.common.utils import link_or_copy, mkdir_p
+
+log = logging.getLogger(__name__)
+
+
+class ArtifactCache(object):
+    """Host-local cache of downloaded packages shared by all environments.
+
+    Packages are stored as ``objects/<key>`` where the key is the sha1 of the
+    artifact url and its published checksum. ``index.json`` maps every url to
+    its object and checksum, a hit needs the checksum currently published for
+    the url to match. Objects are evicted least recently used first once the
+    cache grows over ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir, max_bytes) -> None:
+        self._cache_dir = cache_dir
+        self._objects_dir = os.path.join(cache_dir, "objects")
+        self._index_fn = os.path.join(cache_dir, "index.json")
+        self._max_bytes = max_bytes
+        mkdir_p(self._objects_dir)
+        self._lock = lockfile.FileLock("{}.lock".format(self._index_fn))
+
+    @staticmethod
+    def _get_key(url, checksum) -> str:
+        return hashlib.sha1("{}\n{}".format(url, checksum or "").encode()).hexdigest()
+
+    def _object_path(self, key) -> str:
+        return os.path.join(self._objects_dir, key)
+
+    def _load_index(self) -> dict:
+        try:
+            with open(self._index_fn, "r") as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError:
+            log.warning(
+                "Corrupt artifact cache index {}, reset it".format(self._index_fn)
+            )
+            return {}
+
+    def _dump_index(self, index) -> None:
+        tmp_fn = "{}.tmp".format(self._index_fn)
+        with open(tmp_fn, "w") as f:
+            json.dump(index, f)
+        os.rename(tmp_fn, self._index_fn)
+
+    def mkstemp(self) -> str:
+        """Return a new temporary file on the same filesystem as the cache"""
+        fd, path = tempfile.mkstemp(dir=self._cache_dir, suffix=".tmp")
+        os.close(fd)
+        return path
+
+    def materialize(self, url, dest, checksum=None) -> bool:
+        """Link the cached package of url to dest.
+
+        :param checksum: the checksum url is currently published with, a
+            package cached under another checksum is a miss
+        return: bool, False on a cache miss
+        """
+        with self._lock:
+            index = self._load_index()
+            entry = index.get(url)
+            if not entry:
+                return False
+            if entry["checksum"] != checksum:
+                log.info("{} was republished, the cached package is stale".format(url))
+                return False
+            path = self._object_path(entry["key"])
+            if not os.path.exists(path):
+                del index[url]
+                self._dump_index(index)
+                return False
+            if os.path.lexists(dest):
+                os.remove(dest)
+            method = link_or_copy(path, dest)
+            entry["last_used"] = time.time()
+            self._dump_index(index)
+        log.info("Artifact cache hit for {}, {} to {}".format(url, method, dest))
+        return True
+
+    def add(self, url, path, checksum=None, move=False) -> None:
+        """Add a verified package to the cache.
+
+        :param move: take ownership of path instead of linking it
+        """
+        key = self._get_key(url, checksum)
+        object_path = self._object_path(key)
+        with self._lock:
+            index = self._load_index()
+            if not os.path.exists(object_path):
+                if move:
+                    os.rename(path, object_path)
+                else:
+                    tmp_path = "{}.tmp".format(object_path)
+                    if os.path.lexists(tmp_path):
+                        os.remove(tmp_path)
+                    link_or_copy(path, tmp_path)
+                    os.rename(tmp_path, object_path)
+            elif move:
+                os.remove(path)
+            previous = index.get(url)
+            if previous and previous["key"] != key:
+                self._remove_object(url, previous["key"])
+            index[url] = {
+                "key": key,
+                "checksum": checksum,
+                "size": os.path.getsize(object_path),
+                "last_used": time.time(),
+            }
+            self._evict(index, keep=url)
+            self._dump_index(index)
+        log.info("Added {} to the artifact cache".format(url))
+
+    def _evict(self, index, keep=None) -> None:
+        """Remove least recently used objects until the cache fits its budget"""
+        total = sum(entry["size"] for entry in index.values())
+        by_last_used = sorted(index.items(), key=lambda item: item[1]["last_used"])
+        for url, entry in by_last_used:
+            if total <= self._max_bytes:
+                break
+            if url == keep:
+                continue
+            del index[url]
+            total -= entry["size"]
+            self._remove_object(url, entry["key"])
+
+    def _remove_object(self, url, key) -> None:
+        try:
+            os.remove(self._object_path(key))
+            log.info("Removed {} from the artifact cache".format(url))
+        except OSError:
+            log.exception("Failed: remove cached artifact {}".format(url))
@@ -0,0 +1,188 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import logging
+import shutil
+import subprocess
+import tarfile
+import threading
+from typing import Iterator, List, Optional
+
+from deployd.download.download_helper import STREAM_CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+
+class Decompressor(object):
+    """A compression format of tarballs and the tools which can decompress it.
+
+    :param commands: external decompressors writing to stdout, in order of
+                     preference. They run on their own cores, pigz also
+                     uses extra threads to read, write and check.
+    :param tarfile_mode: the compression tarfile handles in-process, used
+                         when none of the commands is installed
+    """
+
+    def __init__(self, name, extensions, magic, commands, tarfile_mode=None) -> None:
+        self.name = name
+        self.extensions = extensions
+        self.magic = magic
+        self.commands = commands
+        self.tarfile_mode = tarfile_mode
+
+    def get_command(self) -> Optional[List[str]]:
+        for command in self.commands:
+            if shutil.which(command[0]):
+                return command
+        return None
+
+
+DECOMPRESSORS = [
+    Decompressor("gzip", ("tar.gz", "tgz"), b"\x1f\x8b", [["pigz", "-dc"]], "gz"),
+    Decompressor(
+        "bzip2",
+        ("tar.bz2", "tbz2"),
+        b"BZh",
+        [["lbzip2", "-dc"], ["pbzip2", "-dc"]],
+        "bz2",
+    ),
+    Decompressor(
+        "xz", ("tar.xz", "txz"), b"\xfd7zXZ\x00", [["xz", "-dc", "-T0"]], "xz"
+    ),
+    Decompressor("zstd", ("tar.zst", "tzst"), b"\x28\xb5\x2f\xfd", [["zstd", "-dc"]]),
+    Decompressor("lz4", ("tar.lz4",), b"\x04\x22\x4d\x18", [["lz4", "-dc"]]),
+]
+
+# the longest magic number
+MAGIC_BYTES = 6
+
+
+def get_decompressor(extension=None, header=None) -> Optional[Decompressor]:
+    """Pick the decompressor by the package extension, else by magic bytes.
+
+    return: None for an uncompressed tarball or an unknown format
+    """
+    for decompressor in DECOMPRESSORS:
+        if extension in decompressor.extensions:
+            return decompressor
+    if header:
+        for decompressor in DECOMPRESSORS:
+            if header.startswith(decompressor.magic):
+                return decompressor
+    return None
+
+
+def _read_header(path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(MAGIC_BYTES)
+
+
+def _pump(source, sink, errors) -> None:
+    """Copy a file object without a file descriptor into a pipe"""
+    try:
+        for chunk in iter(lambda: source.read(STREAM_CHUNK_SIZE), b""):
+            sink.write(chunk)
+    except BrokenPipeError:
+        # the decompressor died, its exit code tells why
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            sink.close()
+        except BrokenPipeError:
+            pass
+
+
+@contextlib.contextmanager
+def _open_piped(command, source) -> Iterator[tarfile.TarFile]:
+    stdin_file = None
+    pump = None
+    errors = []
+    if isinstance(source, str):
+        stdin_file = open(source, "rb")
+        stdin = stdin_file
+    else:
+        stdin = subprocess.PIPE
+    process = subprocess.Popen(
+        command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if stdin_file:
+        stdin_file.close()
+    else:
+        pump = threading.Thread(target=_pump, args=(source, process.stdin, errors))
+        pump.daemon = True
+        pump.start()
+
+    succeeded = False
+    try:
+        with tarfile.open(fileobj=process.stdout, mode="r|") as tfile:
+            yield tfile
+        # read the end of the stream, the decompressor checks its trailer
+        while process.stdout.read(STREAM_CHUNK_SIZE):
+            pass
+        succeeded = True
+    finally:
+        if not succeeded:
+            process.kill()
+        process.stdout.close()
+        error = process.stderr.read()
+        process.stderr.close()
+        returncode = process.wait()
+        # on failure the pump may still wait for the network, leave it behind
+        if pump and succeeded:
+            pump.join()
+
+    if errors:
+        raise errors[0]
+    if returncode:
+        raise tarfile.ReadError(
+            "{} exited with {}: {}".format(
+                " ".join(command), returncode, error.decode(errors="replace").strip()
+            )
+        )
+
+
+@contextlib.contextmanager
+def open_tar(source, extension=None) -> Iterator[tarfile.TarFile]:
+    """Open a tarball for extraction with the fastest decompressor installed.
+
+    :param source: the path of the tarball, or a readable file object to
+                   extract it while it is downloaded. A file object is not
+                   seekable, so its format is only told by the extension.
+    """
+    is_path = isinstance(source, str)
+    header = _read_header(source) if is_path else None
+    decompressor = get_decompressor(extension, header)
+    command = decompressor.get_command() if decompressor else None
+
+    if command:
+        log.info("Decompress with {}".format(" ".join(command)))
+        with _open_piped(command, source) as tfile:
+            yield tfile
+        return
+
+    if decompressor and not decompressor.tarfile_mode:
+        raise tarfile.CompressionError(
+            "{} packages need one of {} installed".format(
+                decompressor.name, ", ".join(c[0] for c in decompressor.commands)
+            )
+        )
+    if is_path:
+        with tarfile.open(source) as tfile:
+            yield tfile
+    else:
+        with tarfile.open(fileobj=source, mode="r|*") as tfile:
+            yield tfile
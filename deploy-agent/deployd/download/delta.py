@@ -0,0 +1,169 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Delta packages between two consecutive builds.
+
+A delta package is published next to the full package as
+``<artifactUrl>.delta-from-<base build id>``. It is a tarball, in any of the
+compressions the downloader supports, which holds:
+
+- every file, symlink and directory added or changed since the base build
+- ``.teletraan-delta.json``, the manifest::
+
+      {
+          "base": "<base build id>",
+          "files": {
+              "<path>": {"sha1": "<sha1 of the content>", "size": <bytes>},
+              "<symlink path>": {"link": "<symlink target>"},
+              ...
+          }
+      }
+
+  where files lists every file and symlink of the new build, relative to
+  its root.
+
+The new build is the content of the delta, completed with reflinks, or
+copies, of the unchanged files of the extracted base build. A base file is
+only taken when its content still has the sha1 and size of the manifest, the
+enabled build may have been changed in place since it was extracted.
+"""
+
+import json
+import logging
+import os
+import shutil
+from typing import Set
+
+from deployd.common.utils import reflink_or_copy
+from deployd.download.download_helper import DownloadHelper
+from deployd.staging.stager import Stager
+
+log = logging.getLogger(__name__)
+
+DELTA_MANIFEST = ".teletraan-delta.json"
+
+
+class DeltaError(Exception):
+    """The delta cannot be applied to the base build"""
+
+
+def get_delta_url(url, base_build) -> str:
+    return "{}.delta-from-{}".format(url, base_build)
+
+
+def _base_path(base_dir, name) -> str:
+    """Return the path of name in the base build.
+
+    The Transformer rewrites the deploy scripts of an enabled build in place,
+    their original is in the template directory.
+    """
+    script_prefix = Stager._script_dirname + os.sep
+    template_dir = os.path.join(base_dir, Stager._template_dirname)
+    if name.startswith(script_prefix) and os.path.isdir(template_dir):
+        return os.path.join(template_dir, name[len(script_prefix) :])
+    return os.path.join(base_dir, name)
+
+
+def _check_content(path, name, entry) -> None:
+    """Raise DeltaError unless path is the file or symlink of entry"""
+    if "link" in entry:
+        if not os.path.islink(path) or os.readlink(path) != entry["link"]:
+            raise DeltaError("{} is not the symlink of the manifest".format(name))
+        return
+    if (
+        os.path.islink(path)
+        or os.path.getsize(path) != entry.get("size")
+        or DownloadHelper.hash_file(path) != entry.get("sha1")
+    ):
+        raise DeltaError("{} does not have the content of the manifest".format(name))
+
+
+def _reuse_base_file(src, dst, name, entry) -> None:
+    """Recreate the base file src at dst, if it has the content of entry"""
+    if "link" in entry:
+        _check_content(src, name, entry)
+        os.symlink(entry["link"], dst)
+        return
+    if os.path.islink(src) or os.path.getsize(src) != entry.get("size"):
+        raise DeltaError("{} changed since the base build".format(name))
+    reflink_or_copy(src, dst)
+    # the copy is checked, src can still change while it is read
+    _check_content(dst, name, entry)
+    shutil.copystat(src, dst)
+
+
+def _make_parents(base_dir, working_dir, name, created_dirs) -> None:
+    """Create the missing parents of name with the modes of the base build"""
+    missing = []
+    parent = os.path.dirname(name)
+    while (
+        parent
+        and parent not in created_dirs
+        and not os.path.isdir(os.path.join(working_dir, parent))
+    ):
+        missing.append(parent)
+        parent = os.path.dirname(parent)
+    for parent in reversed(missing):
+        path = os.path.join(working_dir, parent)
+        os.mkdir(path)
+        base_parent = os.path.join(base_dir, parent)
+        if os.path.isdir(base_parent):
+            shutil.copymode(base_parent, path)
+        created_dirs.add(parent)
+
+
+def apply_delta(base_dir, base_build, working_dir) -> int:
+    """Complete the delta extracted to working_dir with the base build.
+
+    return: int, the number of files taken from the base build
+    """
+    manifest_fn = os.path.join(working_dir, DELTA_MANIFEST)
+    try:
+        with open(manifest_fn, "r") as f:
+            manifest = json.load(f)
+        os.remove(manifest_fn)
+    except (IOError, ValueError) as e:
+        raise DeltaError("Invalid delta manifest: {}".format(e))
+
+    if manifest.get("base") != base_build:
+        raise DeltaError(
+            "The delta is based on build {}, not {}".format(
+                manifest.get("base"), base_build
+            )
+        )
+
+    files = manifest.get("files")
+    if not isinstance(files, dict):
+        raise DeltaError("The delta manifest has no checksums")
+
+    working_dir = os.path.realpath(working_dir)
+    created_dirs: Set[str] = set()
+    reused = 0
+    for name, entry in files.items():
+        name = os.path.normpath(name)
+        dst = os.path.join(working_dir, name)
+        if name.startswith(os.pardir) or os.path.isabs(name):
+            raise DeltaError("{} is outside of the build".format(name))
+        if os.path.lexists(dst):
+            # added or changed by the delta
+            _check_content(dst, name, entry)
+            continue
+        src = _base_path(base_dir, name)
+        if not os.path.lexists(src):
+            raise DeltaError("{} is missing from build {}".format(name, base_build))
+
+        _make_parents(base_dir, working_dir, name, created_dirs)
+        _reuse_base_file(src, dst, name, entry)
+        reused += 1
+    return reused
@@ -15,21 +15,64 @@
 import abc
 import hashlib
 import logging
+from typing import Optional
 
 log = logging.getLogger(__name__)
 
 DOWNLOAD_VALIDATE_METRICS = "deployd.stats.download.validate"
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class HashingStream(object):
+    """Read-only file object which hashes every byte read through it.
+
+    It wraps the body of a download so the artifact can be verified while it
+    is being extracted, without writing it to disk first.
+    """
+
+    def __init__(self, source, algorithm=None) -> None:
+        self._source = source
+        self._hash = hashlib.new(algorithm) if algorithm else None
+        self._sink = None
+        self.bytes_read = 0
+
+    def tee(self, sink) -> None:
+        """also write everything read to the sink file object"""
+        self._sink = sink
+
+    def read(self, size=-1) -> bytes:
+        data = self._source.read(size if size is not None and size >= 0 else None)
+        if data:
+            if self._hash:
+                self._hash.update(data)
+            if self._sink:
+                self._sink.write(data)
+            self.bytes_read += len(data)
+        return data
+
+    def drain(self) -> None:
+        """consume whatever is left in the source, e.g. the tar padding"""
+        while self.read(STREAM_CHUNK_SIZE):
+            pass
+
+    def hexdigest(self) -> Optional[str]:
+        return self._hash.hexdigest() if self._hash else None
+
+    def close(self) -> None:
+        self._source.close()
 
 
 class DownloadHelper(metaclass=abc.ABCMeta):
     def __init__(self, url) -> None:
         self._url = url
+        # the published checksum the download was verified against, if any
+        self.checksum = None
 
     @staticmethod
     def hash_file(file_path) -> str:
         sha = hashlib.sha1()
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
                 sha.update(chunk)
         return sha.hexdigest()
 
@@ -37,7 +80,7 @@ class DownloadHelper(metaclass=abc.ABCMeta):
     def md5_file(file_path) -> str:
         md5 = hashlib.md5()
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
                 md5.update(chunk)
         return md5.hexdigest()
 
@@ -45,6 +88,27 @@ class DownloadHelper(metaclass=abc.ABCMeta):
     def download(self, local_full_fn):
         pass
 
+    def open_stream(self) -> Optional[HashingStream]:
+        """Open the artifact as a readable stream.
+
+        Return None if the helper cannot stream, callers then fall back to
+        download().
+        """
+        return None
+
+    def verify_stream(self, stream) -> bool:
+        """Verify a fully consumed stream returned by open_stream()."""
+        return True
+
+    def get_checksum(self) -> Optional[str]:
+        """Return the checksum the artifact is currently published with.
+
+        It is compared to the checksum of a cached package, so an artifact
+        republished under the same url is downloaded again. None if the
+        helper has no checksum.
+        """
+        return None
+
     @abc.abstractmethod
     def validate_source(self):
         pass
@@ -15,11 +15,9 @@
 from logging import Logger, getLogger
 from typing import Optional
 
-import boto3
 from urllib.parse import urlparse
 
 from deployd.download.download_helper import DownloadHelper
-from deployd.download.s3_download_helper import S3DownloadHelper
 from deployd.download.http_download_helper import HTTPDownloadHelper
 from deployd.download.local_download_helper import LocalDownloadHelper
 
@@ -37,13 +35,17 @@ class DownloadHelperFactory(object):
             if aws_access_key_id is None or aws_secret_access_key is None:
                 log.error("aws access key id and secret access key not found")
                 return None
+            # boto3 takes hundreds of milliseconds to import, only s3 urls need it
+            import boto3
+            from deployd.download.s3_download_helper import S3DownloadHelper
+
             s3_client = boto3.client(
                 "s3",
                 aws_access_key_id=aws_access_key_id,
                 aws_secret_access_key=aws_secret_access_key,
             )
             return S3DownloadHelper(
-                local_full_fn=url, s3_client=s3_client, url=None, config=config
+                local_full_fn=url, s3_client=s3_client, url=url, config=config
             )
         elif url_parse.scheme == "file":
             return LocalDownloadHelper(url=url)
@@ -16,27 +16,40 @@ import argparse
 from deployd.common import LOG_FORMAT
 from deployd.common.config import Config
 from deployd.common.status_code import Status
+from deployd.common.stats import create_sc_increment
+from deployd.download.artifact_cache import ArtifactCache
+from deployd.download.decompressor import open_tar
+from deployd.download.delta import apply_delta, get_delta_url
 from deployd.download.download_helper_factory import DownloadHelperFactory
+from deployd.download.extractor import ParallelExtractor
 from deployd.download.gpg_helper import gpgHelper
+from deployd.staging.stager import Stager
 import os
 import re
+import shutil
 import sys
 import tarfile
 import zipfile
 import logging
 import traceback
+from typing import Optional
+from urllib.parse import urlparse
 
 log = logging.getLogger(__name__)
 
 
 class Downloader(object):
-    def __init__(self, config, build, url, env_name) -> None:
-        self._matcher = re.compile(r"^.*?[.](?P<ext>tar\.gz|tar\.bz2|\w+)$")
+    # archives which have to be on disk before they can be extracted
+    _DISK_ONLY_EXTENSIONS = ("zip", "gpg")
+
+    def __init__(self, config, build, url, env_name, target=None) -> None:
+        self._matcher = re.compile(r"^.*?[.](?P<ext>tar\.(?:gz|bz2|xz|zst|lz4)|\w+)$")
         self._base_dir = config.get_builds_directory()
         self._build_name = env_name
         self._build = build
         self._url = url
         self._config = config
+        self._target = target
 
     def _get_inner_extension(self, url) -> str:
         outerExtension = self._get_extension(url)
@@ -64,13 +77,57 @@ class Downloader(object):
             log.info("Create directory {}.".format(working_dir))
             os.mkdir(working_dir)
 
-        downloader = DownloadHelperFactory.gen_downloader(self._url, self._config)
-        if downloader:
+        cache = self._get_artifact_cache()
+        if cache and self._materialize_from_cache(cache, local_full_fn):
+            status = Status.SUCCEEDED
+        elif (
+            self._config.get_delta_download()
+            and extension != "gpg"
+            and self._download_delta(working_dir, extracted_file)
+        ):
+            return Status.SUCCEEDED
+        else:
+            downloader = DownloadHelperFactory.gen_downloader(self._url, self._config)
+            if not downloader:
+                return Status.FAILED
+
+            if (
+                self._config.get_streaming_download()
+                and extension not in self._DISK_ONLY_EXTENSIONS
+            ):
+                if not downloader.validate_source():
+                    log.error(f"Invalid url: {self._url}. Skip downloading.")
+                    return Status.FAILED
+                try:
+                    stream = downloader.open_stream()
+                except Exception:
+                    log.exception("Failed to open a stream from {}".format(self._url))
+                    return Status.FAILED
+                if stream:
+                    return self._stream_extract(
+                        downloader,
+                        stream,
+                        extension,
+                        working_dir,
+                        extracted_file,
+                        cache,
+                    )
+                log.info("Streaming is not available, download to {}".format(local_fn))
+
+            if os.path.lexists(local_full_fn):
+                # it may be a hardlink of a cached package, which curl -o or
+                # a ranged download would otherwise truncate in place
+                os.remove(local_full_fn)
             status = downloader.download(local_full_fn)
             if status != Status.SUCCEEDED:
                 return status
-        else:
-            return Status.FAILED
+            if cache:
+                try:
+                    cache.add(self._url, local_full_fn, downloader.checksum)
+                except Exception:
+                    log.exception(
+                        "Failed to add {} to the artifact cache".format(self._url)
+                    )
 
         if extension == "gpg":
             try:
@@ -110,12 +167,16 @@ class Downloader(object):
         try:
             if extension == "zip":
                 log.info("unzip files to {}".format(working_dir))
-                with zipfile.ZipFile(local_full_fn) as zfile:
-                    zfile.extractall(working_dir)
+                workers = self._config.get_extract_workers()
+                if workers > 1:
+                    ParallelExtractor(workers).extract_zip(local_full_fn, working_dir)
+                else:
+                    with zipfile.ZipFile(local_full_fn) as zfile:
+                        zfile.extractall(working_dir)
             else:
                 log.info("untar files to {}".format(working_dir))
-                with tarfile.open(local_full_fn) as tfile:
-                    tfile.extractall(working_dir)
+                with open_tar(local_full_fn, extension) as tfile:
+                    self._extract_tar(tfile, working_dir)
 
             # change the working directory back
             os.chdir(curr_working_dir)
@@ -136,6 +197,157 @@ class Downloader(object):
         finally:
             return status
 
+    def _extract_tar(self, tfile, working_dir) -> None:
+        workers = self._config.get_extract_workers()
+        if workers > 1:
+            count = ParallelExtractor(workers).extract_tar(tfile, working_dir)
+            log.info("Extracted {} members with {} threads".format(count, workers))
+        else:
+            tfile.extractall(working_dir)
+
+    def _get_base_build(self) -> Optional[str]:
+        """Return the enabled build of the env, deltas are applied to it"""
+        if not self._target:
+            return None
+        stager = Stager(self._config, self._build, self._target, self._build_name)
+        return stager.get_enabled_build()
+
+    def _download_delta(self, working_dir, extracted_file) -> bool:
+        """Build the package from a delta against the enabled build.
+
+        return: bool, False if the caller has to download the full package
+        """
+        base_build = self._get_base_build()
+        if not base_build or base_build == self._build:
+            return False
+        base_extracted = os.path.join(self._base_dir, "{}.extracted".format(base_build))
+        if not os.path.exists(base_extracted):
+            log.info("Build {} is not extracted, skip delta".format(base_build))
+            return False
+
+        delta_url = get_delta_url(self._url, base_build)
+        # also the marker which lets Helper find and clean up the build
+        delta_fn = os.path.join(
+            self._base_dir, "{}-{}.delta".format(self._build_name, self._build)
+        )
+        tags = {"env": self._build_name}
+        try:
+            downloader = DownloadHelperFactory.gen_downloader(delta_url, self._config)
+            if downloader and downloader.download(delta_fn) == Status.SUCCEEDED:
+                with open_tar(delta_fn) as tfile:
+                    self._extract_tar(tfile, working_dir)
+                base_dir = os.path.join(self._base_dir, base_build)
+                reused = apply_delta(base_dir, base_build, working_dir)
+                with open(extracted_file, "w"):
+                    pass
+                log.info(
+                    "Applied {} to build {}, reused {} files".format(
+                        delta_url, base_build, reused
+                    )
+                )
+                create_sc_increment(
+                    "deployd.stats.download.delta", tags=dict(tags, result="applied")
+                )
+                return True
+            log.info("No delta at {}, download the full package".format(delta_url))
+        except Exception:
+            log.exception(
+                "Failed to apply {}, download the full package".format(delta_url)
+            )
+
+        create_sc_increment(
+            "deployd.stats.download.delta", tags=dict(tags, result="fallback")
+        )
+        if os.path.exists(delta_fn):
+            os.remove(delta_fn)
+        # start the full package from an empty directory
+        shutil.rmtree(working_dir, ignore_errors=True)
+        os.mkdir(working_dir)
+        return False
+
+    def _get_artifact_cache(self) -> Optional[ArtifactCache]:
+        max_bytes = self._config.get_artifact_cache_max_bytes()
+        # local packages are already on the host
+        if not max_bytes or urlparse(self._url).scheme == "file":
+            return None
+        try:
+            return ArtifactCache(self._config.get_artifact_cache_directory(), max_bytes)
+        except Exception:
+            log.exception("Failed to open the artifact cache, skip it")
+            return None
+
+    def _materialize_from_cache(self, cache, local_full_fn) -> bool:
+        try:
+            # a hit has to match the checksum the url is published with now
+            downloader = DownloadHelperFactory.gen_downloader(self._url, self._config)
+            checksum = downloader.get_checksum() if downloader else None
+            hit = cache.materialize(self._url, local_full_fn, checksum)
+        except Exception:
+            log.exception("Failed to read {} from the artifact cache".format(self._url))
+            hit = False
+        create_sc_increment(
+            "deployd.stats.download.cache", tags={"hit": hit, "env": self._build_name}
+        )
+        return hit
+
+    def _stream_extract(
+        self, downloader, stream, extension, working_dir, extracted_file, cache=None
+    ) -> int:
+        """Extract a tarball while it is being downloaded, then verify it.
+
+        The archive never touches the disk, only an empty
+        ``{env}-{build}.streamed`` marker is left behind so that stale builds
+        are still found and cleaned up by ``Helper``. With an artifact cache
+        the bytes are also written once into the cache.
+        """
+        log.info("stream and untar {} to {}".format(self._url, working_dir))
+        cache_fn = cache.mkstemp() if cache else None
+        try:
+            try:
+                with open(cache_fn or os.devnull, "wb") as cache_file:
+                    if cache_fn:
+                        stream.tee(cache_file)
+                    with open_tar(stream, extension) as tfile:
+                        self._extract_tar(tfile, working_dir)
+                    # the checksum covers the whole artifact, not only the tar members
+                    stream.drain()
+            finally:
+                stream.close()
+
+            if not downloader.verify_stream(stream):
+                # do not leave the content of a corrupt artifact around
+                shutil.rmtree(working_dir, ignore_errors=True)
+                return Status.FAILED
+
+            if cache_fn:
+                try:
+                    cache.add(self._url, cache_fn, downloader.checksum, move=True)
+                    cache_fn = None
+                except Exception:
+                    log.exception(
+                        "Failed to add {} to the artifact cache".format(self._url)
+                    )
+
+            marker = "{}-{}.streamed".format(self._build_name, self._build)
+            with open(os.path.join(self._base_dir, marker), "w"):
+                pass
+            with open(extracted_file, "w"):
+                pass
+            log.info(
+                "Successfully streamed {} bytes from {} to {}".format(
+                    stream.bytes_read, self._url, working_dir
+                )
+            )
+            return Status.SUCCEEDED
+        except tarfile.TarError:
+            log.exception("Failed to extract tar stream")
+        except Exception:
+            log.exception("Failed to stream files")
+        finally:
+            if cache_fn and os.path.exists(cache_fn):
+                os.remove(cache_fn)
+        return Status.FAILED
+
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
@@ -169,12 +381,23 @@ def main():
         required=True,
         help="the environment name currently in deploy.",
     )
+    parser.add_argument(
+        "-t",
+        "--target",
+        dest="target",
+        required=False,
+        default=os.environ.get("TARGET"),
+        help="the deploy target directory name, deltas are applied to the build "
+        "it points to. Defaults to $TARGET, which the agent exports.",
+    )
     args = parser.parse_args()
     config = Config(args.config_file)
     logging.basicConfig(format=LOG_FORMAT, level=config.get_log_level())
 
     log.info("Start to download the package.")
-    status = Downloader(config, args.build, args.url, args.env_name).download()
+    status = Downloader(
+        config, args.build, args.url, args.env_name, target=args.target
+    ).download()
     if status != Status.SUCCEEDED:
         log.error("Download failed.")
         sys.exit(1)
@@ -0,0 +1,224 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import shutil
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from deployd.download.download_helper import STREAM_CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+
+class UnsafeArchiveError(Exception):
+    """The archive has a member which would be written outside of the target"""
+
+
+class ParallelExtractor(object):
+    """Extract archives with a pool of threads writing the file members.
+
+    Extracting packages with tens of thousands of small files is dominated by
+    the open/write/close of every member, so those run in parallel. The
+    archive itself is still read by a single thread, which also creates the
+    directories before any file is written into them. Symlinks are created in
+    member order and no later member is written through one. Hardlinks are
+    created and the permissions and modification times of directories are
+    fixed up in a final pass, directories last, like ``TarFile.extractall``
+    does.
+    """
+
+    # members up to this size are read into memory and written by the pool,
+    # bigger ones are copied by the reading thread
+    SMALL_FILE_BYTES = STREAM_CHUNK_SIZE
+    # the small files read before the pool writes them
+    BATCH_FILES = 4096
+    BATCH_BYTES = 32 * 1024 * 1024
+
+    def __init__(self, workers) -> None:
+        self._workers = workers
+        self._dirs = set()
+        self._symlinks = set()
+
+    def _target_path(self, dest, name) -> str:
+        # no realpath, it costs a syscall per path component. Only the
+        # symlinks created from the archive can be in the way, they are
+        # looked up instead.
+        path = os.path.normpath(os.path.join(dest, name))
+        if os.path.commonpath([dest, path]) != dest:
+            raise UnsafeArchiveError("{} is outside of {}".format(name, dest))
+        if self._symlinks:
+            parent = os.path.dirname(path)
+            while parent != dest:
+                if parent in self._symlinks:
+                    raise UnsafeArchiveError(
+                        "{} is below the symlink {}".format(name, parent)
+                    )
+                parent = os.path.dirname(parent)
+        return path
+
+    def _makedirs(self, path) -> None:
+        if path not in self._dirs:
+            os.makedirs(path, exist_ok=True)
+            self._dirs.add(path)
+
+    def _write_files(self, tfile, files) -> None:
+        for member, path, data in files:
+            with open(path, "wb") as f:
+                f.write(data)
+            self._fixup(tfile, member, path)
+
+    def _write_batch(self, pool, tfile, batch) -> None:
+        # The reading thread waits meanwhile. Reading the archive holds the
+        # GIL, so with both at once every syscall of the writers would wait
+        # for the next switch interval.
+        slices = [batch[i :: self._workers] for i in range(self._workers)]
+        self._wait([pool.submit(self._write_files, tfile, files) for files in slices])
+
+    def extract_tar(self, tfile, dest) -> int:
+        """Extract an open TarFile, also works for stream modes like "r|*".
+
+        return: int, the number of members extracted
+        """
+        dest = os.path.realpath(dest)
+        fixups = []
+        hardlinks = []
+        batch = []
+        batch_paths = set()
+        batch_bytes = 0
+        count = 0
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            for member in tfile:
+                count += 1
+                path = self._target_path(dest, member.name)
+                if path in self._symlinks and not (member.issym() or member.islnk()):
+                    raise UnsafeArchiveError(
+                        "{} would be written through a symlink".format(member.name)
+                    )
+                if member.isdir():
+                    self._makedirs(path)
+                    fixups.append((member, path))
+                    continue
+                self._makedirs(os.path.dirname(path))
+                if member.issym():
+                    if path in batch_paths:
+                        # the pending file would be written through the link
+                        self._write_batch(pool, tfile, batch)
+                        batch = []
+                        batch_paths = set()
+                        batch_bytes = 0
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    os.symlink(member.linkname, path)
+                    self._symlinks.add(path)
+                    fixups.append((member, path))
+                elif member.islnk():
+                    hardlinks.append((member, path))
+                elif member.isfile():
+                    source = tfile.extractfile(member)
+                    if member.size > self.SMALL_FILE_BYTES:
+                        with open(path, "wb") as f:
+                            shutil.copyfileobj(source, f, STREAM_CHUNK_SIZE)
+                        fixups.append((member, path))
+                        continue
+                    batch.append((member, path, source.read()))
+                    batch_paths.add(path)
+                    batch_bytes += member.size
+                    if (
+                        len(batch) >= self.BATCH_FILES
+                        or batch_bytes >= self.BATCH_BYTES
+                    ):
+                        self._write_batch(pool, tfile, batch)
+                        batch = []
+                        batch_paths = set()
+                        batch_bytes = 0
+                else:
+                    # devices and fifos are rare enough to not bother
+                    tfile.extract(member, dest)
+            if batch:
+                self._write_batch(pool, tfile, batch)
+
+        for member, path in hardlinks:
+            target = self._target_path(dest, member.linkname)
+            if os.path.lexists(path):
+                os.remove(path)
+            try:
+                os.link(target, path, follow_symlinks=False)
+            except OSError:
+                shutil.copy2(target, path, follow_symlinks=False)
+            fixups.append((member, path))
+
+        # directories last and deepest first, their mtime changes while their
+        # content is written
+        files = [item for item in fixups if not item[0].isdir()]
+        dirs = sorted(
+            (item for item in fixups if item[0].isdir()),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+        for member, path in files + dirs:
+            self._fixup(tfile, member, path)
+        return count
+
+    @staticmethod
+    def _fixup(tfile, member, path) -> None:
+        # the same attributes TarFile.extractall restores
+        tfile.chown(member, path, False)
+        if not member.issym():
+            tfile.chmod(member, path)
+            tfile.utime(member, path)
+
+    def extract_zip(self, zip_fn, dest) -> int:
+        """Extract a zip file, every worker reads from its own handle.
+
+        return: int, the number of members extracted
+        """
+        dest = os.path.realpath(dest)
+        local = threading.local()
+        handles = []
+        lock = threading.Lock()
+
+        def write(info, path) -> None:
+            if not hasattr(local, "zfile"):
+                local.zfile = zipfile.ZipFile(zip_fn)
+                with lock:
+                    handles.append(local.zfile)
+            with local.zfile.open(info) as source, open(path, "wb") as f:
+                shutil.copyfileobj(source, f, STREAM_CHUNK_SIZE)
+
+        with zipfile.ZipFile(zip_fn) as zfile:
+            infos = zfile.infolist()
+        files = []
+        for info in infos:
+            path = self._target_path(dest, info.filename)
+            if info.is_dir():
+                self._makedirs(path)
+            else:
+                self._makedirs(os.path.dirname(path))
+                files.append((info, path))
+        try:
+            with ThreadPoolExecutor(max_workers=self._workers) as pool:
+                self._wait([pool.submit(write, info, path) for info, path in files])
+        finally:
+            for handle in handles:
+                handle.close()
+        return len(infos)
+
+    @staticmethod
+    def _wait(futures) -> None:
+        for future in futures:
+            # raise the first error of the workers
+            future.result()
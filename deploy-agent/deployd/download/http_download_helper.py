@@ -16,11 +16,17 @@ from deployd.common.caller import Caller
 from deployd.common.helper import Helper
 from deployd.common.status_code import Status
 from deployd.common.config import Config
-from deployd.download.download_helper import DownloadHelper, DOWNLOAD_VALIDATE_METRICS
-from deployd.common.stats import create_sc_increment
+from deployd.download.download_helper import (
+    DownloadHelper,
+    HashingStream,
+    DOWNLOAD_VALIDATE_METRICS,
+)
+from deployd.download.partial_download import PartialDownload
+from deployd.common.stats import create_sc_gauge, create_sc_increment
 import os
 import requests
 import logging
+from typing import Optional
 from urllib.parse import ParseResult, urlparse
 
 requests.packages.urllib3.disable_warnings()
@@ -29,9 +35,16 @@ log = logging.getLogger(__name__)
 
 
 class HTTPDownloadHelper(DownloadHelper):
+    # seconds to wait for the server to connect or send more data
+    _STREAM_TIMEOUT = 60
+    # the body is read raw, it must be the bytes published, not a gzip of them
+    _HEADERS = {"Accept-Encoding": "identity"}
+
     def __init__(self, url=None, config=None) -> None:
         super().__init__(url)
         self._config = config if config else Config()
+        # sha1 of the last resumable download, computed while it was written
+        self._download_sha1 = None
 
     def _download_files(self, local_full_fn) -> int:
         download_cmd = ["curl", "-o", local_full_fn, "-fksS", self._url]
@@ -47,13 +60,90 @@ class HTTPDownloadHelper(DownloadHelper):
         log.info("Finish downloading: {} to {}".format(self._url, local_full_fn))
         return status_code
 
+    def _download_resumable(self, local_full_fn) -> int:
+        """Download through a checkpointed partial file, resume it if possible"""
+        partial = PartialDownload(local_full_fn, self._url)
+        offset = partial.load()
+        try:
+            response = self._get_range(offset, partial.validator)
+            if response.status_code == 416 or (
+                response.status_code == 206
+                and self._get_range_start(response) != offset
+            ):
+                # the partial file is complete or longer than the object now,
+                # or the server sent another range than the one asked for
+                response.close()
+                partial.discard()
+                offset = 0
+                response = self._get_range(offset, None)
+            with response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # the object changed, If-Range made the server send all of it
+                    offset = 0
+                elif self._get_range_start(response) != offset:
+                    raise IOError(
+                        "Unexpected Content-Range {}".format(
+                            response.headers.get("Content-Range")
+                        )
+                    )
+                validator = response.headers.get("ETag") or response.headers.get(
+                    "Last-Modified"
+                )
+                partial.write(response.raw, offset, validator)
+            partial.commit()
+            self._download_sha1 = partial.hexdigest()
+        except Exception:
+            log.exception("Failed to download {}".format(self._url))
+            return Status.FAILED
+
+        create_sc_gauge(
+            "deployd.stats.download.resumed_bytes",
+            partial.resumed_bytes,
+            tags={"type": "http"},
+        )
+        log.info(
+            "Finish downloading: {} to {}, resumed {} bytes".format(
+                self._url, local_full_fn, partial.resumed_bytes
+            )
+        )
+        return Status.SUCCEEDED
+
+    @staticmethod
+    def _get_range_start(response) -> Optional[int]:
+        """first byte of a 206 response, from Content-Range: bytes start-end/size"""
+        content_range = response.headers.get("Content-Range", "")
+        unit, _, byte_range = content_range.partition(" ")
+        try:
+            if unit == "bytes":
+                return int(byte_range.split("-", 1)[0])
+        except ValueError:
+            pass
+        return None
+
+    def _get_range(self, offset, validator) -> requests.Response:
+        headers = dict(self._HEADERS)
+        if offset and validator:
+            headers.update({"Range": "bytes={}-".format(offset), "If-Range": validator})
+        return requests.get(
+            self._url,
+            headers=headers,
+            stream=True,
+            verify=False,
+            timeout=self._STREAM_TIMEOUT,
+        )
+
     def download(self, local_full_fn) -> int:
         log.info("Start to download from url {} to {}".format(self._url, local_full_fn))
         if not self.validate_source():
             log.error(f"Invalid url: {self._url}. Skip downloading.")
             return Status.FAILED
 
-        status_code = self._download_files(local_full_fn)
+        self._download_sha1 = None
+        if self._config.get_resumable_download():
+            status_code = self._download_resumable(local_full_fn)
+        else:
+            status_code = self._download_files(local_full_fn)
         if status_code != Status.SUCCEEDED:
             log.error("Failed to download the tar ball for {}".format(local_full_fn))
             build_name = Helper.get_build_name(local_full_fn.rsplit("/", 1)[-1])
@@ -62,28 +152,58 @@ class HTTPDownloadHelper(DownloadHelper):
             return status_code
 
         try:
-            sha_url = "{}.sha1".format(self._url)
-            sha_r = requests.get(sha_url)
-            if sha_r.status_code != 200:
-                log.warning(
-                    "Skip checksum verification. Invalid response from {}".format(
-                        sha_url
-                    )
-                )
+            sha_value = self._get_checksum()
+            if sha_value is None:
                 return status_code
 
-            sha_value = sha_r.content
-            hash_value = self.hash_file(local_full_fn)
+            hash_value = self._download_sha1 or self.hash_file(local_full_fn)
             if hash_value != sha_value:
                 log.error("Checksum failed for {}".format(local_full_fn))
                 return Status.FAILED
 
+            self.checksum = sha_value
             log.info("Successfully downloaded to {}".format(local_full_fn))
             return Status.SUCCEEDED
         except requests.ConnectionError:
             log.error("Could not connect to: {}".format(self._url))
             return Status.FAILED
 
+    def _get_checksum(self) -> Optional[str]:
+        """Return the published sha1 of the artifact, None if there is none"""
+        sha_url = "{}.sha1".format(self._url)
+        sha_r = requests.get(sha_url, headers=self._HEADERS)
+        if sha_r.status_code != 200:
+            log.warning(
+                "Skip checksum verification. Invalid response from {}".format(sha_url)
+            )
+            return None
+        return sha_r.text.strip()
+
+    def get_checksum(self) -> Optional[str]:
+        return self._get_checksum()
+
+    def open_stream(self) -> HashingStream:
+        log.info("Start to stream from url {}".format(self._url))
+        response = requests.get(
+            self._url,
+            headers=self._HEADERS,
+            stream=True,
+            verify=False,
+            timeout=self._STREAM_TIMEOUT,
+        )
+        response.raise_for_status()
+        # read the raw body so the bytes hashed are the bytes published, which
+        # the identity Accept-Encoding keeps the server from compressing
+        return HashingStream(response.raw, "sha1")
+
+    def verify_stream(self, stream) -> bool:
+        sha_value = self._get_checksum()
+        if sha_value is not None and stream.hexdigest() != sha_value:
+            log.error("Checksum failed for {}".format(self._url))
+            return False
+        self.checksum = sha_value
+        return True
+
     def validate_source(self) -> bool:
         tags = {"type": "http", "url": self._url}
         create_sc_increment(DOWNLOAD_VALIDATE_METRICS, tags=tags)
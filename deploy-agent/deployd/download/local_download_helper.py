@@ -13,10 +13,11 @@
 # limitations under the License.
 
 from deployd.common.caller import Caller
-from deployd.download.download_helper import DownloadHelper
+from deployd.download.download_helper import DownloadHelper, HashingStream
 from deployd.common.status_code import Status
 import logging
 import os
+from urllib.parse import urlparse
 
 log = logging.getLogger(__name__)
 
@@ -50,5 +51,8 @@ class LocalDownloadHelper(DownloadHelper):
             )
         return error
 
+    def open_stream(self) -> HashingStream:
+        return HashingStream(open(urlparse(self._url).path, "rb"))
+
     def validate_source(self) -> bool:
         return True
@@ -0,0 +1,154 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+
+from deployd.download.download_helper import STREAM_CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+
+class PartialDownload(object):
+    """Checkpointed ``.partial`` file of a download which can be resumed.
+
+    The ``.partial.json`` sidecar records the url, the validator (ETag or
+    Last-Modified) of the remote object, and the offset and sha1 of the prefix
+    last flushed to disk. hashlib objects cannot be serialized, so on resume
+    the hash state is rebuilt by re-hashing the local prefix, which also
+    catches a partial file that was corrupted in between.
+    """
+
+    # flush and record the progress every this many bytes
+    CHECKPOINT_BYTES = 8 * 1024 * 1024
+
+    def __init__(self, local_full_fn, url) -> None:
+        self._local_full_fn = local_full_fn
+        self._url = url
+        self.path = "{}.partial".format(local_full_fn)
+        self._state_fn = "{}.json".format(self.path)
+        self._sha1 = hashlib.sha1()
+        self.offset = 0
+        self.validator = None
+        # bytes of the previous attempts which did not have to be downloaded again
+        self.resumed_bytes = 0
+
+    def load(self, validator=None) -> int:
+        """Return the offset to resume from, 0 if the download has to restart.
+
+        :param validator: the current validator of the remote object, if known
+        """
+        try:
+            with open(self._state_fn, "r") as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            self.discard()
+            return 0
+
+        offset = state.get("offset", 0)
+        if (
+            state.get("url") != self._url
+            or not state.get("validator")
+            or (validator and validator != state["validator"])
+            or not os.path.exists(self.path)
+            or os.path.getsize(self.path) < offset
+        ):
+            log.info("Cannot resume the download of {}, restart it".format(self._url))
+            self.discard()
+            return 0
+
+        sha1 = hashlib.sha1()
+        with open(self.path, "r+b") as f:
+            remaining = offset
+            while remaining:
+                chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                sha1.update(chunk)
+                remaining -= len(chunk)
+            # drop whatever was written after the last checkpoint
+            f.truncate(offset)
+        if sha1.hexdigest() != state.get("sha1"):
+            log.warning("Partial download {} is corrupt, restart it".format(self.path))
+            self.discard()
+            return 0
+
+        self._sha1 = sha1
+        self.offset = offset
+        self.validator = state["validator"]
+        log.info("Resume the download of {} from byte {}".format(self._url, offset))
+        return offset
+
+    def write(self, body, offset, validator) -> None:
+        """Write the body, a readable of the object from offset, to the partial file.
+
+        The progress is checkpointed even when reading the body fails, so the
+        next attempt can pick up from there.
+        """
+        if offset != self.offset:
+            # the server sent the whole object
+            self._sha1 = hashlib.sha1()
+            self.offset = 0
+        else:
+            self.resumed_bytes = offset
+        self.validator = validator
+
+        with open(self.path, "r+b" if self.offset else "wb") as f:
+            f.seek(self.offset)
+            f.truncate()
+            last_checkpoint = self.offset
+            try:
+                for chunk in iter(lambda: body.read(STREAM_CHUNK_SIZE), b""):
+                    f.write(chunk)
+                    self._sha1.update(chunk)
+                    self.offset += len(chunk)
+                    if self.offset - last_checkpoint >= self.CHECKPOINT_BYTES:
+                        self._checkpoint(f)
+                        last_checkpoint = self.offset
+            finally:
+                self._checkpoint(f)
+
+    def _checkpoint(self, f) -> None:
+        if not self.validator:
+            # without a validator a resumed download could mix two versions
+            return
+        f.flush()
+        os.fsync(f.fileno())
+        state = {
+            "url": self._url,
+            "validator": self.validator,
+            "offset": self.offset,
+            "sha1": self._sha1.hexdigest(),
+        }
+        tmp_fn = "{}.tmp".format(self._state_fn)
+        with open(tmp_fn, "w") as state_file:
+            json.dump(state, state_file)
+        os.rename(tmp_fn, self._state_fn)
+
+    def hexdigest(self) -> str:
+        """sha1 of the bytes of the partial file, resumed and written"""
+        return self._sha1.hexdigest()
+
+    def commit(self) -> None:
+        """Move the completed partial file to its final name"""
+        os.rename(self.path, self._local_full_fn)
+        if os.path.exists(self._state_fn):
+            os.remove(self._state_fn)
+
+    def discard(self) -> None:
+        for fn in (self.path, self._state_fn):
+            if os.path.exists(fn):
+                os.remove(fn)
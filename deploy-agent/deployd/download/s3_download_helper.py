@@ -21,8 +21,15 @@ import botocore
 
 from deployd.common.config import Config
 from deployd.common.status_code import Status
-from deployd.download.download_helper import DownloadHelper, DOWNLOAD_VALIDATE_METRICS
-from deployd.common.stats import create_sc_increment
+from deployd.download.download_helper import (
+    DownloadHelper,
+    HashingStream,
+    DOWNLOAD_VALIDATE_METRICS,
+)
+from deployd.download.partial_download import PartialDownload
+from deployd.download.s3_ranged_downloader import S3RangedDownloader, etag_is_md5
+from deployd.common.stats import create_sc_gauge, create_sc_increment, create_sc_timing
+from typing import Optional
 
 log = logging.getLogger(__name__)
 
@@ -65,9 +72,31 @@ class S3DownloadHelper(DownloadHelper):
                 log.error("s3 key {} not found".format(self._key))
                 return Status.FAILED
 
-            self._s3_client.download_file(self._bucket_name, self._key, local_full_fn)
+            concurrency = self._config.get_s3_download_concurrency()
+            if concurrency > 1:
+                if not self._ranged_download(
+                    local_full_fn, object_metadata, concurrency
+                ):
+                    return Status.FAILED
+                if not etag_is_md5(object_metadata) and not self._verify_sha1(
+                    local_full_fn
+                ):
+                    return Status.FAILED
+                self.checksum = object_metadata["ETag"].strip('"')
+                log.info("Successfully downloaded to {}".format(local_full_fn))
+                return Status.SUCCEEDED
+
+            if self._config.get_resumable_download():
+                self._resumable_download(local_full_fn, object_metadata)
+            else:
+                self._s3_client.download_file(
+                    self._bucket_name, self._key, local_full_fn
+                )
             etag = object_metadata["ETag"]
-            if "-" not in etag:
+            if not etag_is_md5(object_metadata):
+                if not self._verify_sha1(local_full_fn):
+                    return Status.FAILED
+            elif "-" not in etag:
                 if etag.startswith('"') and etag.endswith('"'):
                     etag = etag[1:-1]
 
@@ -80,6 +109,7 @@ class S3DownloadHelper(DownloadHelper):
                     "MD5 verification currently not supported on multipart uploads."
                 )
 
+            self.checksum = etag.strip('"')
             log.info("Successfully downloaded to {}".format(local_full_fn))
             return Status.SUCCEEDED
         except Exception:
@@ -88,6 +118,111 @@ class S3DownloadHelper(DownloadHelper):
             )
             return Status.FAILED
 
+    def _get_published_sha1(self) -> Optional[str]:
+        """Return the sha1 published next to the object, None if there is none"""
+        try:
+            response = self._s3_client.get_object(
+                Bucket=self._bucket_name, Key="{}.sha1".format(self._key)
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+        return response["Body"].read().decode().strip()
+
+    def _verify_sha1(self, local_full_fn) -> bool:
+        """Verify an encrypted object, whose ETag is not an MD5, by its sha1"""
+        sha_value = self._get_published_sha1()
+        if sha_value is None:
+            log.info(
+                "The ETag of encrypted {} is not an MD5 and there is no "
+                "published sha1, skip verification.".format(self._key)
+            )
+            return True
+        if self.hash_file(local_full_fn) != sha_value:
+            log.error("Checksum failed for {}".format(local_full_fn))
+            return False
+        return True
+
+    def _ranged_download(self, local_full_fn, object_metadata, concurrency) -> bool:
+        ranged = S3RangedDownloader(
+            self._s3_client,
+            self._bucket_name,
+            self._key,
+            concurrency=concurrency,
+            part_size=self._config.get_s3_download_part_size(),
+        )
+        verified = ranged.download(local_full_fn, object_metadata)
+
+        tags = {"type": "s3", "bucket": self._bucket_name}
+        elapsed = max(ranged.time_elapsed, 0.001)
+        create_sc_timing("deployd.stats.download.time_elapsed_sec", elapsed, tags=tags)
+        create_sc_gauge(
+            "deployd.stats.download.bytes_per_sec",
+            int(ranged.bytes_downloaded / elapsed),
+            tags=tags,
+        )
+        create_sc_gauge("deployd.stats.download.parts", ranged.parts, tags=tags)
+        create_sc_gauge("deployd.stats.download.retries", ranged.retries, tags=tags)
+        return verified
+
+    def _resumable_download(self, local_full_fn, object_metadata) -> None:
+        """Download through a checkpointed partial file, resume it if possible"""
+        etag = object_metadata["ETag"]
+        partial = PartialDownload(local_full_fn, self._url)
+        offset = partial.load(validator=etag)
+        if offset < object_metadata["ContentLength"]:
+            kwargs = {"Bucket": self._bucket_name, "Key": self._key, "IfMatch": etag}
+            if offset:
+                kwargs["Range"] = "bytes={}-".format(offset)
+            response = self._s3_client.get_object(**kwargs)
+            partial.write(response["Body"], offset, etag)
+        partial.commit()
+        create_sc_gauge(
+            "deployd.stats.download.resumed_bytes",
+            partial.resumed_bytes,
+            tags={"type": "s3", "bucket": self._bucket_name},
+        )
+        log.info(
+            "Downloaded {} to {}, resumed {} bytes".format(
+                self._key, local_full_fn, partial.resumed_bytes
+            )
+        )
+
+    def open_stream(self) -> HashingStream:
+        log.info(f"Start to stream file {self._key} from s3 bucket {self._bucket_name}")
+        response = self._s3_client.get_object(Bucket=self._bucket_name, Key=self._key)
+        self._stream_etag = response["ETag"].strip('"')
+        self._stream_etag_is_md5 = etag_is_md5(response)
+        algorithm = "md5" if self._stream_etag_is_md5 else "sha1"
+        return HashingStream(response["Body"], algorithm)
+
+    def verify_stream(self, stream) -> bool:
+        if not self._stream_etag_is_md5:
+            sha_value = self._get_published_sha1()
+            if sha_value is not None and stream.hexdigest() != sha_value:
+                log.error("Checksum failed for {}".format(self._url))
+                return False
+            self.checksum = self._stream_etag
+            return True
+
+        if "-" in self._stream_etag:
+            log.info("MD5 verification currently not supported on multipart uploads.")
+            self.checksum = self._stream_etag
+            return True
+
+        if stream.hexdigest() != self._stream_etag:
+            log.error("MD5 verification failed. tarball is corrupt.")
+            return False
+        self.checksum = self._stream_etag
+        return True
+
+    def get_checksum(self) -> Optional[str]:
+        object_metadata = self._get_object_metadata()
+        if object_metadata is None:
+            return None
+        return object_metadata["ETag"].strip('"')
+
     def _get_object_metadata(self):
         """
         Return the object metadata at the specified key, or None if not found
@@ -0,0 +1,171 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from deployd.download.download_helper import DownloadHelper, STREAM_CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+
+def etag_is_md5(object_metadata) -> bool:
+    """Return False for SSE-KMS and SSE-C objects, their ETag is not an MD5"""
+    encryption = object_metadata.get("ServerSideEncryption") or ""
+    return not (
+        encryption.startswith("aws:kms") or object_metadata.get("SSECustomerAlgorithm")
+    )
+
+
+class S3RangedDownloader(object):
+    """Download an s3 object with concurrent ranged GETs.
+
+    Every part is written in place into a preallocated file. If the object was
+    uploaded in multiple parts, the download reuses the upload part size so
+    the MD5 of every part can be checked against the multipart ETag. The
+    ETag of an SSE-KMS or SSE-C object is not an MD5, those are not verified.
+    """
+
+    def __init__(
+        self, s3_client, bucket, key, concurrency, part_size, max_retry=3
+    ) -> None:
+        self._s3_client = s3_client
+        self._bucket = bucket
+        self._key = key
+        self._concurrency = concurrency
+        self._part_size = part_size
+        self._max_retry = max_retry
+        self._lock = threading.Lock()
+        self.bytes_downloaded = 0
+        self.parts = 0
+        self.retries = 0
+        self.time_elapsed = 0.0
+
+    def _get_upload_part_size(self) -> int:
+        metadata = self._s3_client.head_object(
+            Bucket=self._bucket, Key=self._key, PartNumber=1
+        )
+        return metadata["ContentLength"]
+
+    @staticmethod
+    def _get_ranges(size, part_size) -> List[Tuple[int, int]]:
+        return [
+            (start, min(start + part_size, size) - 1)
+            for start in range(0, size, part_size)
+        ]
+
+    def _download_part(self, local_full_fn, etag, start, end) -> bytes:
+        """Download bytes [start, end] into the file, return the part MD5"""
+        attempt = 0
+        while True:
+            try:
+                md5 = hashlib.md5()
+                response = self._s3_client.get_object(
+                    Bucket=self._bucket,
+                    Key=self._key,
+                    Range="bytes={}-{}".format(start, end),
+                    IfMatch=etag,
+                )
+                with open(local_full_fn, "r+b") as f:
+                    f.seek(start)
+                    body = response["Body"]
+                    for chunk in iter(lambda: body.read(STREAM_CHUNK_SIZE), b""):
+                        md5.update(chunk)
+                        f.write(chunk)
+                    written = f.tell() - start
+                if written != end - start + 1:
+                    raise IOError(
+                        "Got {} bytes for range {}-{}".format(written, start, end)
+                    )
+                with self._lock:
+                    self.bytes_downloaded += written
+                return md5.digest()
+            except Exception:
+                attempt += 1
+                if attempt > self._max_retry:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                log.warning(
+                    "Failed to download range {}-{} of {}, retry {}".format(
+                        start, end, self._key, attempt
+                    ),
+                    exc_info=True,
+                )
+
+    def download(self, local_full_fn, object_metadata) -> bool:
+        """Download the object described by head_object to local_full_fn.
+
+        return: bool, False when the content does not match an MD5 ETag
+        """
+        start_time = time.time()
+        size = object_metadata["ContentLength"]
+        etag = object_metadata["ETag"]
+        etag_value = etag.strip('"')
+        verify = etag_is_md5(object_metadata)
+        part_size = self._part_size
+        upload_parts = None
+        if verify and "-" in etag_value:
+            upload_parts = int(etag_value.split("-")[1])
+            part_size = self._get_upload_part_size()
+
+        ranges = self._get_ranges(size, part_size)
+        self.parts = len(ranges)
+        with open(local_full_fn, "wb") as f:
+            f.truncate(size)
+
+        log.info(
+            "Download {} bytes of {} in {} parts with {} threads".format(
+                size, self._key, self.parts, self._concurrency
+            )
+        )
+        with ThreadPoolExecutor(max_workers=self._concurrency) as pool:
+            digests = list(
+                pool.map(
+                    lambda r: self._download_part(local_full_fn, etag, r[0], r[1]),
+                    ranges,
+                )
+            )
+        self.time_elapsed = time.time() - start_time
+
+        if not verify:
+            log.info(
+                "The ETag of encrypted {} is not an MD5, skip it".format(self._key)
+            )
+            return True
+        if upload_parts is not None:
+            if upload_parts != len(digests):
+                log.info(
+                    "Upload parts are not of equal size, skip multipart MD5 verification."
+                )
+                return True
+            md5 = hashlib.md5(b"".join(digests)).hexdigest()
+            computed = "{}-{}".format(md5, len(digests))
+        elif len(digests) == 1:
+            computed = digests[0].hex()
+        else:
+            computed = DownloadHelper.md5_file(local_full_fn)
+
+        if computed != etag_value:
+            log.error(
+                "MD5 verification failed. Expected {}, got {}.".format(
+                    etag_value, computed
+                )
+            )
+            return False
+        return True
@@ -25,12 +25,54 @@ from deployd.common import LOG_FORMAT
 from deployd.common.caller import Caller
 from deployd.common.config import Config
 from deployd.common.status_code import Status
-from deployd.common.stats import create_sc_increment
+from deployd.common.stats import create_sc_gauge, create_sc_increment
+from deployd.common.utils import link_or_copy
 from .transformer import Transformer
 
 log = logging.getLogger(__name__)
 
 
+def link_tree(src, dst) -> int:
+    """Materialize the tree src at dst with hardlinks, or reflinks, and copy
+    only the files neither works for.
+
+    return: int, the number of bytes copied
+    """
+    bytes_copied = 0
+    dirs_copied = []
+    for root, dirs, files in os.walk(src, followlinks=True):
+        dst_root = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        os.makedirs(dst_root, exist_ok=True)
+        dirs_copied.append((root, dst_root))
+        for filename in files:
+            src_fn = os.path.join(root, filename)
+            dst_fn = os.path.join(dst_root, filename)
+            method = link_or_copy(src_fn, dst_fn)
+            if method != "hardlink":
+                # a reflink or copy is a new inode, keep mode and mtime as copy2 does
+                shutil.copystat(src_fn, dst_fn)
+            if method == "copy":
+                bytes_copied += os.path.getsize(dst_fn)
+    # after the files, which change the mtime of their directory
+    for root, dst_root in reversed(dirs_copied):
+        shutil.copystat(root, dst_root)
+    return bytes_copied
+
+
+def copy_tree(src, dst) -> int:
+    """shutil.copytree counting the bytes copied
+    return: int, the number of bytes copied
+    """
+    sizes = []
+
+    def copy_function(src_fn, dst_fn):
+        sizes.append(os.path.getsize(src_fn))
+        return shutil.copy2(src_fn, dst_fn)
+
+    shutil.copytree(src, dst, copy_function=copy_function)
+    return sum(sizes)
+
+
 class Stager(object):
     _script_dirname = "teletraan"
     _template_dirname = "teletraan_template"
@@ -39,8 +81,11 @@ class Stager(object):
         self._build_dir = config.get_builds_directory()
         self._user_role = config.get_user_role()
         agent_dir = config.get_agent_directory()
+        self._link_templates = config.get_link_script_templates()
         self._transformer = transformer or Transformer(
-            agent_dir=agent_dir, env_name=env_name
+            agent_dir=agent_dir,
+            env_name=env_name,
+            max_workers=config.get_transform_workers(),
         )
         self._build = build
         self._target = target
@@ -123,7 +168,15 @@ class Stager(object):
         template_dir = os.path.join(self._target, self._template_dirname)
         # copy user script template to a dedicated template directory
         if not os.path.exists(template_dir):
-            shutil.copytree(script_dir, template_dir)
+            if self._link_templates:
+                bytes_copied = link_tree(script_dir, template_dir)
+            else:
+                bytes_copied = copy_tree(script_dir, template_dir)
+            create_sc_gauge(
+                "deployd.stats.staging.bytes_copied",
+                bytes_copied,
+                tags={"env_name": self._env_name, "link": self._link_templates},
+            )
 
         self._transformer.transform_scripts(
             script_dir=template_dir,
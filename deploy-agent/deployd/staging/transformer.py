@@ -12,26 +12,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
+import stat
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
 import re
 import logging
-from typing import List
+from typing import List, Optional
 from deployd import IS_PINTEREST
 
 log = logging.getLogger(__name__)
 
+# bytes looked at to tell a binary file from a script
+BINARY_CHECK_BYTES = 8192
+
 
 class TeletraanTemplate(Template):
     delimiter = "$TELETRAAN_"
     idpattern = r"[a-zA-Z][_a-z0-9A-Z\-]*"
 
 
+# the TeletraanTemplate forms: $TELETRAAN_X, $TELETRAAN_{X} and the
+# $TELETRAAN_$TELETRAAN_ escape
+_SIMPLE_TEMPLATE = (
+    r"(?i:\$TELETRAAN_)(?:(?P<escaped>(?i:\$TELETRAAN_))"
+    r"|(?P<named>[a-zA-Z][_a-z0-9A-Z\-]*)|\{(?P<braced>[a-zA-Z][_a-z0-9A-Z\-]*)\})"
+)
+_SIMPLE_PATTERN = re.compile(_SIMPLE_TEMPLATE)
+# plus ${TELETRAAN_X:default} and {$TELETRAAN_X:default}, so a file is
+# rewritten in a single pass
+_TEMPLATE_PATTERN = re.compile(
+    r"(?P<braces>\{\$|\$\{)TELETRAAN_(?P<key>[a-zA-Z0-9\-_]+)(?P<colon>:)?(?P<value>.*?)\}"
+    r"|" + _SIMPLE_TEMPLATE
+)
+
+
 class Transformer(object):
-    def __init__(self, agent_dir, env_name, dict_fn=None) -> None:
+    def __init__(self, agent_dir, env_name, dict_fn=None, max_workers=1) -> None:
         self._agent_dir = agent_dir
         self._env_name = env_name
+        self._max_workers = max_workers
+        self._state_fn = os.path.join(agent_dir, "{}_SCRIPT_STATE".format(env_name))
         self._load_config(dict_fn)
 
     def _load_config(self, fn) -> None:
@@ -42,48 +66,132 @@ class Transformer(object):
 
         if not os.path.isfile(fn):
             self._dictionary = {}
-            return
-
-        with open(fn, "r") as f:
-            self._dictionary = dict(
-                (n.strip("\"\n' ") for n in line.split("=", 1)) for line in f
-            )
+        else:
+            with open(fn, "r") as f:
+                self._dictionary = dict(
+                    (n.strip("\"\n' ") for n in line.split("=", 1)) for line in f
+                )
+        self._dictionary_hash = hashlib.sha1(
+            json.dumps(self._dictionary, sort_keys=True).encode()
+        ).hexdigest()
 
     def dict_size(self) -> int:
         return len(self._dictionary)
 
-    def _translate(self, from_path, to_path) -> None:
+    def _replace(self, match) -> str:
+        if not match.group("braces"):
+            return self._replace_simple(match)
+        value = match.group("value") if match.group("colon") else None
+        value = self._dictionary.get(match.group("key"), value)
+        if value is None:
+            # left as is, but the $TELETRAAN_ forms inside still apply
+            text = match.group()
+            return text[0] + _SIMPLE_PATTERN.sub(self._replace_simple, text[1:])
+        # the second pass of the former translation ran over substituted
+        # values and defaults too
+        return _SIMPLE_PATTERN.sub(self._replace_simple, value)
+
+    def _replace_simple(self, match) -> str:
+        if match.group("escaped"):
+            return TeletraanTemplate.delimiter
+        value = self._dictionary.get(match.group("named") or match.group("braced"))
+        return match.group() if value is None else value
+
+    def translate(self, content) -> str:
+        """substitute the script config into a template"""
+        return _TEMPLATE_PATTERN.sub(self._replace, content)
+
+    def _translate(self, from_path, to_path, state=None) -> Optional[str]:
+        """translate from_path to to_path unless its inputs did not change
+        return: str, the state of to_path, None on error or for binary files
+        """
         try:
-            with open(from_path, "r") as f:
-                res = f.read()
-
-            matcher = "(\{\$|\$\{)TELETRAAN_(?P<KEY>[a-zA-Z0-9\-_]+)(?P<COLON>:)?(?P<VALUE>.*?)\}"
-            match_string = re.finditer(matcher, res)
-            for match in match_string:
-                key = match.group("KEY")
-                colon = match.group("COLON")
-                value = match.group("VALUE")
-                if colon is None:
-                    value = None
-                value = self._dictionary.get(key, value)
-                if value is not None:
-                    res = res.replace(match.group(), value)
-
-            s = TeletraanTemplate(res)
-            res = s.safe_substitute(self._dictionary)
-            with open(to_path, "w") as f:
-                f.write(res)
+            with open(from_path, "rb") as f:
+                data = f.read()
+            if b"\0" in data[:BINARY_CHECK_BYTES]:
+                log.info("skip translating binary file {}".format(from_path))
+                return None
+
+            digest = hashlib.sha1(self._dictionary_hash.encode())
+            digest.update(data)
+            digest = digest.hexdigest()
+            if state and state == self._get_state(to_path, digest):
+                log.debug("{} is up to date".format(to_path))
+                return state
+
+            if self._write(to_path, self.translate(data.decode()).encode()):
+                log.info("finish translating: {} to {}".format(from_path, to_path))
+            return self._get_state(to_path, digest)
         except Exception:
             log.error(
                 "Fail to translate script {}, stacktrace: {}".format(
                     from_path, traceback.format_exc()
                 )
             )
+            return None
+
+    @staticmethod
+    def _write(to_path, data) -> bool:
+        """replace to_path with data unless it already has this content.
+
+        The new file is renamed over to_path, it may be a hardlink to its
+        template, and keeps the mode and owner of the file it replaces.
+        return: bool, False when to_path was left as is
+        """
+        try:
+            st = os.stat(to_path)
+            if st.st_size == len(data):
+                with open(to_path, "rb") as f:
+                    if f.read() == data:
+                        return False
+        except OSError:
+            st = None
+        tmp_path = "{}.tmp".format(to_path)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        if st is not None:
+            os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+            try:
+                os.chown(tmp_path, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+        os.replace(tmp_path, to_path)
+        return True
+
+    @staticmethod
+    def _get_state(to_path, digest) -> Optional[str]:
+        """the input digest and the identity of the file written from it,
+        a new build behind the same path is never taken as up to date
+        """
+        try:
+            st = os.stat(to_path)
+        except OSError:
+            return None
+        return "{} {} {} {} {} {}".format(
+            digest, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+        )
+
+    def _load_state(self) -> dict:
+        try:
+            with open(self._state_fn, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _dump_state(self, state) -> None:
+        tmp_fn = "{}.tmp".format(self._state_fn)
+        try:
+            with open(tmp_fn, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_fn, self._state_fn)
+        except OSError:
+            log.warning("Failed to save the script state {}".format(self._state_fn))
 
     def transform_scripts(self, script_dir, template_dirname, script_dirname) -> List:
         scripts = []
         suffix = ".tmpl"
         try:
+            paths = []
             for root, dirs, files in os.walk(script_dir):
                 for filename in files:
                     if IS_PINTEREST or filename.endswith(suffix):
@@ -92,12 +200,20 @@ class Transformer(object):
                         to_path = to_path.replace(suffix, "")
 
                         if os.path.isfile(from_path):  # We only care about files
-                            self._translate(from_path, to_path)
-                            log.info(
-                                "finish translating: {} to {}".format(
-                                    from_path, to_path
-                                )
-                            )
+                            paths.append((from_path, to_path))
+
+            old_state = self._load_state()
+            with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+                states = pool.map(
+                    lambda p: self._translate(p[0], p[1], old_state.get(p[1])), paths
+                )
+                new_state = {
+                    to_path: state
+                    for (_, to_path), state in zip(paths, states)
+                    if state
+                }
+            if new_state != old_state:
+                self._dump_state(new_state)
         except OSError:
             # if scripts_dir doesn't exist, there is no local build,
             # go on and return empty list.
@@ -31,6 +31,9 @@ class DeployGoal(object):
         self.scriptVariables = None
         self.firstDeploy = None
         self.isDocker = None
+        # set by the server for system level deploys, goals of the same
+        # priority have no ordering between them
+        self.systemPriority = None
 
         if jsonValue:
             self.deployId = jsonValue.get("deployId")
@@ -54,6 +57,7 @@ class DeployGoal(object):
             self.scriptVariables = jsonValue.get("scriptVariables")
             self.firstDeploy = jsonValue.get("firstDeploy")
             self.isDocker = jsonValue.get("isDocker")
+            self.systemPriority = jsonValue.get("systemPriority")
 
     def __key(self) -> Tuple:
         return (
@@ -69,6 +73,7 @@ class DeployGoal(object):
             self.scriptVariables,
             self.firstDeploy,
             self.isDocker,
+            self.systemPriority,
         )
 
     def __hash__(self) -> int:
@@ -86,7 +91,7 @@ class DeployGoal(object):
         return (
             "DeployGoal(deployId={}, envId={}, envName={}, stageName={}, stageType={}, "
             "deployStage={}, build={}, deployAlias={}, agentConfig={},"
-            "scriptVariables={}, firstDeploy={}, isDocker={})".format(
+            "scriptVariables={}, firstDeploy={}, isDocker={}, systemPriority={})".format(
                 self.deployId,
                 self.envId,
                 self.envName,
@@ -99,5 +104,6 @@ class DeployGoal(object):
                 self.scriptVariables,
                 self.firstDeploy,
                 self.isDocker,
+                self.systemPriority,
             )
         )
@@ -0,0 +1,116 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from deployd.client.restfulclient import RestfulClient
+
+
+class PingHandler(BaseHTTPRequestHandler):
+    # keep the connection open between requests
+    protocol_version = "HTTP/1.1"
+    bodies = []
+    # set to answer the held long-poll pings
+    goal_changed = threading.Event()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.bodies.append(json.loads(body))
+        query = parse_qs(urlparse(self.path).query)
+        wait_seconds = int(query.get("longPollSeconds", ["0"])[0])
+        if wait_seconds:
+            self.goal_changed.wait(wait_seconds)
+        response = json.dumps({"opCode": "NOOP"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if wait_seconds:
+            self.send_header("X-Teletraan-Long-Poll", "held")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestRestfulClient(unittest.TestCase):
+    def setUp(self):
+        PingHandler.bodies = []
+        PingHandler.goal_changed = threading.Event()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), PingHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.config = mock.Mock()
+        self.config.get_restful_service_url.return_value = "http://127.0.0.1:{}".format(
+            self.server.server_port
+        )
+        self.config.get_restful_service_version.return_value = "v1"
+        self.config.get_restful_service_token.return_value = ""
+        self.config.get_verify_https_certificate.return_value = "False"
+        self.config.get_restful_service_pool_size.return_value = 2
+        self.config.get_restful_service_gzip.return_value = False
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    @mock.patch("deployd.client.restfulclient.create_sc_increment")
+    def test_reuse_connection(self, mock_increment):
+        client = RestfulClient._cls(self.config)
+        for i in range(3):
+            client._ping_internal({"hostId": str(i)})
+
+        self.assertEqual(client._get_num_connections(), 1)
+        reused = [
+            c.kwargs["tags"]["reused"]
+            for c in mock_increment.call_args_list
+            if c.kwargs["name"] == "deploy.agent.rest.connection"
+        ]
+        self.assertEqual(reused, [False, True, True])
+        self.assertEqual([b["hostId"] for b in PingHandler.bodies], ["0", "1", "2"])
+
+    def test_gzip_body(self):
+        self.config.get_restful_service_gzip.return_value = True
+        client = RestfulClient._cls(self.config)
+        self.assertEqual(client._ping_internal({"hostId": "h1"}), {"opCode": "NOOP"})
+        self.assertEqual(PingHandler.bodies, [{"hostId": "h1"}])
+
+    def test_long_poll_ping(self):
+        client = RestfulClient._cls(self.config)
+        ping_request = mock.Mock()
+        ping_request.to_json.return_value = {"hostId": "h1"}
+        timer = threading.Timer(0.2, PingHandler.goal_changed.set)
+        timer.start()
+        response = client.ping(ping_request, wait_seconds=10)
+        timer.join()
+
+        self.assertEqual(response.opCode, "NOOP")
+        self.assertTrue(PingHandler.goal_changed.is_set())
+        self.assertTrue(client.long_poll_held)
+
+        client.ping(ping_request)
+        self.assertFalse(client.long_poll_held)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import unittest
+
+import tests
+from deployd.common.build_gc import BuildCollector
+
+
+class TestBuildCollector(tests.FileTestCase):
+    def _touch(self, *names):
+        for name in names:
+            with open(os.path.join(self.builds_dir, name), "w") as f:
+                f.write(name)
+
+    def test_retire(self):
+        os.makedirs(os.path.join(self.builds_dir, "abc", "teletraan"))
+        self._touch(
+            "abc/teletraan/start",
+            "abc.extracted",
+            "abc.staged",
+            "env-abc.tar.gz",
+            "env-abc.tar.gz.partial",
+            "env-abcd.tar.gz",
+            "other-abc.tar.gz",
+        )
+        collector = BuildCollector(self.builds_dir)
+        collector.retire("abc", "env")
+        collector.join(10)
+        self.assertEqual(
+            sorted(os.listdir(self.builds_dir)),
+            [BuildCollector.TRASH_DIRNAME, "env-abcd.tar.gz", "other-abc.tar.gz"],
+        )
+        self.assertEqual(
+            os.listdir(os.path.join(self.builds_dir, BuildCollector.TRASH_DIRNAME)),
+            [],
+        )
+
+    def test_empty_leftover_trash(self):
+        trash_dir = os.path.join(self.builds_dir, BuildCollector.TRASH_DIRNAME)
+        os.makedirs(os.path.join(trash_dir, "old.123"))
+        collector = BuildCollector(self.builds_dir)
+        collector.retire("missing", "env")
+        collector.join(10)
+        self.assertEqual(os.listdir(trash_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
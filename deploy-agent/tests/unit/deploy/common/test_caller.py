@@ -0,0 +1,58 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+import unittest
+
+from deployd.common.caller import Caller
+
+
+class TestCaller(unittest.TestCase):
+    def test_call_and_log(self):
+        output, error, status = Caller.call_and_log(
+            ["sh", "-c", "echo out1; echo err >&2; echo out2; exit 3"]
+        )
+        self.assertEqual(re.sub(r"\[\d+\.\d\d\]", "", output), "out1\nout2")
+        self.assertTrue(output.startswith("[0."))
+        self.assertEqual(re.sub(r"\[\d+\.\d\d\]", "", error), "err")
+        self.assertEqual(status, 3)
+
+    def test_busy_stderr_with_idle_stdout(self):
+        # more than a pipe buffer on stderr before anything on stdout
+        cmd = ["sh", "-c", "seq 20000 >&2; echo done"]
+        output, error, status = Caller.call_and_log(cmd)
+        self.assertEqual(status, 0)
+        self.assertTrue(output.endswith("]done"))
+        self.assertEqual(len(error.splitlines()), 20000)
+
+    def test_output_cap(self):
+        output, error, status = Caller.call_and_log(
+            ["sh", "-c", "seq 10000"], max_chars=100
+        )
+        self.assertEqual(status, 0)
+        lines = output.splitlines()
+        self.assertTrue(lines[0].startswith("[dropped "))
+        self.assertTrue(lines[-1].endswith("]10000"))
+        self.assertLessEqual(len("\n".join(lines[1:])), 100)
+
+    def test_missing_command(self):
+        output, error, status = Caller.call_and_log(["/nonexistent/command"])
+        self.assertIsNone(output)
+        self.assertIn("No such file", error)
+        self.assertEqual(status, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -55,6 +55,83 @@ class TestConfigFunctions(tests.TestCase):
         self.assertEqual(os.environ["COMPUTE_ENV_TYPE"], "PRODUCTION")
         self.assertEqual(self.config.get_target(), "/tmp/pinboard")
 
+    def test_get_env_target(self):
+        config = Config(config_reader=self.config._config_reader)
+        config._configs = {"target": "/var/current"}
+        self.assertEqual(config.get_env_target("other"), "/tmp/other")
+        self.assertEqual(
+            config.get_env_target("other", {"target": "/var/other"}), "/var/other"
+        )
+
+    def test_copy_does_not_export(self):
+        deploy_goal = {}
+        deploy_goal["deployId"] = "456"
+        deploy_goal["stageName"] = "prod"
+        deploy_goal["envName"] = "sidecar"
+        deploy_goal["deployStage"] = DeployStage.SERVING_BUILD
+        response = PingResponse(jsonValue={"deployGoal": deploy_goal})
+        with mock.patch.dict(os.environ, {"ENV_NAME": "main", "OTHER": "1"}):
+            config = self.config.copy()
+            config.update_variables(DeployStatus(response))
+            self.assertEqual(os.environ["ENV_NAME"], "main")
+            environ = config.get_subprocess_environ()
+        self.assertEqual(environ["ENV_NAME"], "sidecar")
+        self.assertEqual(environ["DEPLOY_ID"], "456")
+        self.assertEqual(environ["OTHER"], "1")
+        self.assertEqual(config.get_target(), "/tmp/sidecar")
+
+    def test_snapshot_reloads_on_change(self):
+        filename = os.path.join(self.dirname, "snapshot.conf")
+        with open(filename, "w") as f:
+            f.write("[default_config]\nmax_retry = 5\n")
+            f.write('http_download_allow_list = ["a.com"]\n')
+        config = Config(filenames=filename)
+        self.assertEqual(config.get_subproces_max_retry(), 5)
+        self.assertEqual(config.get_http_download_allow_list(), ["a.com"])
+        self.assertEqual(config.get_backoff_factor(), 2)
+
+        with open(filename, "w") as f:
+            f.write("[default_config]\nmax_retry = 7\n")
+        stat = os.stat(filename)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        # only a new deploy goal picks up the change
+        self.assertEqual(config.get_subproces_max_retry(), 5)
+
+        deploy_goal = {"deployId": "789", "envName": "pinboard"}
+        deploy_goal["deployStage"] = DeployStage.SERVING_BUILD
+        response = {"deployGoal": deploy_goal, "opCode": OpCode.NOOP}
+        status = DeployStatus(PingResponse(jsonValue=response))
+        with mock.patch.dict(os.environ):
+            config.update_variables(status)
+            self.assertEqual(config.get_subproces_max_retry(), 7)
+            self.assertEqual(config.get_http_download_allow_list(), [])
+
+            status.runtime_config = {"max_retry": "9"}
+            config.update_variables(status)
+            self.assertEqual(config.get_subproces_max_retry(), 9)
+
+    def test_update_variables_only_changes_diff(self):
+        deploy_goal = {"deployId": "123", "envName": "pinboard"}
+        deploy_goal["stageName"] = "beta"
+        deploy_goal["deployStage"] = DeployStage.SERVING_BUILD
+        response = PingResponse(
+            jsonValue={"deployGoal": deploy_goal, "opCode": OpCode.NOOP}
+        )
+        with mock.patch.dict(os.environ):
+            config = Config(config_reader=self.config._config_reader)
+            config.update_variables(DeployStatus(response))
+            self.assertEqual(os.environ["STAGE_NAME"], "beta")
+
+            del deploy_goal["stageName"]
+            deploy_goal["deployId"] = "124"
+            response = PingResponse(
+                jsonValue={"deployGoal": deploy_goal, "opCode": OpCode.NOOP}
+            )
+            config.update_variables(DeployStatus(response))
+            self.assertEqual(os.environ["DEPLOY_ID"], "124")
+            self.assertEqual(os.environ["ENV_NAME"], "pinboard")
+            self.assertNotIn("STAGE_NAME", os.environ)
+
     def test_init(self):
         Config()
 
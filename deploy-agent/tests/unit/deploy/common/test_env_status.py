@@ -0,0 +1,151 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import tests
+
+from deployd.common.env_status import EnvStatus, SqliteEnvStatus, create_env_status
+from deployd.common.types import AgentStatus, DeployStage, DeployStatus, OpCode
+from deployd.types.ping_response import PingResponse
+
+
+def make_status(env_name, deploy_id="1"):
+    deploy_goal = {
+        "deployId": deploy_id,
+        "envId": "id-{}".format(env_name),
+        "envName": env_name,
+        "stageName": "prod",
+        "deployStage": DeployStage.SERVING_BUILD,
+    }
+    response = PingResponse(
+        jsonValue={"deployGoal": deploy_goal, "opCode": OpCode.DEPLOY}
+    )
+    return DeployStatus(response)
+
+
+class TestEnvStatus(tests.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.status_fn = os.path.join(self.base_dir, "env_status")
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_json_round_trip(self):
+        env_status = EnvStatus(self.status_fn)
+        self.assertEqual(env_status.load_envs(), {})
+        envs = {"a": make_status("a"), "b": make_status("b")}
+        self.assertTrue(env_status.dump_envs(envs))
+        self.assertFalse(os.path.exists("{}.tmp".format(self.status_fn)))
+        loaded = EnvStatus(self.status_fn).load_envs()
+        self.assertEqual(sorted(loaded), ["a", "b"])
+        self.assertEqual(loaded["a"].report.deployId, "1")
+
+    def test_json_skips_unchanged(self):
+        env_status = EnvStatus(self.status_fn)
+        envs = {"a": make_status("a")}
+        env_status.dump_envs(envs)
+        with mock.patch.object(env_status, "_write") as write:
+            env_status.dump_envs(envs)
+            self.assertFalse(write.called)
+            envs["a"].report.status = AgentStatus.SUCCEEDED
+            env_status.dump_envs(envs)
+            self.assertTrue(write.called)
+
+    def test_sqlite_round_trip(self):
+        env_status = SqliteEnvStatus(self.status_fn)
+        self.assertEqual(env_status.load_envs(), {})
+        envs = {"a": make_status("a"), "b": make_status("b")}
+        self.assertTrue(env_status.dump_envs(envs))
+        del envs["b"]
+        envs["a"].report.status = AgentStatus.SUCCEEDED
+        self.assertTrue(env_status.dump_envs(envs))
+
+        loaded = SqliteEnvStatus(self.status_fn).load_envs()
+        self.assertEqual(list(loaded), ["a"])
+        self.assertEqual(loaded["a"].report.status, AgentStatus.SUCCEEDED)
+        self.assertFalse(os.path.exists(self.status_fn))
+
+    def test_sqlite_writes_changed_envs(self):
+        env_status = SqliteEnvStatus(self.status_fn)
+        envs = {name: make_status(name) for name in "abc"}
+        env_status.dump_envs(envs)
+        envs["b"].report.status = AgentStatus.SUCCEEDED
+        conn = env_status._get_conn()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        env_status.dump_envs(envs)
+        env_status.dump_envs(envs)
+        conn.set_trace_callback(None)
+        writes = [s for s in statements if s.startswith("INSERT")]
+        self.assertEqual(len(writes), 1)
+        self.assertIn("'b'", writes[0])
+
+    def test_sqlite_imports_json(self):
+        EnvStatus(self.status_fn).dump_envs({"a": make_status("a", "7")})
+        env_status = SqliteEnvStatus(self.status_fn)
+        self.assertEqual(env_status.load_envs()["a"].report.deployId, "7")
+        self.assertFalse(os.path.exists(self.status_fn))
+        self.assertTrue(os.path.exists("{}.imported".format(self.status_fn)))
+        loaded = SqliteEnvStatus(self.status_fn).load_envs()
+        self.assertEqual(loaded["a"].report.deployId, "7")
+
+    def test_sqlite_retries_a_failed_import(self):
+        EnvStatus(self.status_fn).dump_envs({"a": make_status("a", "7")})
+        connect = sqlite3.connect
+
+        class FailingConnection(object):
+            def __init__(self, *args, **kwargs):
+                self._conn = connect(*args, **kwargs)
+
+            def __getattr__(self, name):
+                return getattr(self._conn, name)
+
+            def __enter__(self):
+                return self._conn.__enter__()
+
+            def __exit__(self, *args):
+                return self._conn.__exit__(*args)
+
+            def executemany(self, *args):
+                raise sqlite3.OperationalError("disk I/O error")
+
+        with mock.patch("deployd.common.env_status.sqlite3.connect", FailingConnection):
+            env_status = SqliteEnvStatus(self.status_fn)
+            self.assertEqual(env_status.load_envs()["a"].report.deployId, "7")
+        self.assertTrue(os.path.exists(self.status_fn))
+        self.assertFalse(os.path.exists("{}.db".format(self.status_fn)))
+
+        loaded = SqliteEnvStatus(self.status_fn).load_envs()
+        self.assertEqual(loaded["a"].report.deployId, "7")
+        self.assertFalse(os.path.exists(self.status_fn))
+
+    def test_create_env_status(self):
+        config = mock.Mock()
+        config.get_env_status_fn.return_value = self.status_fn
+        config.get_env_status_backend.return_value = "sqlite"
+        self.assertIsInstance(create_env_status(config), SqliteEnvStatus)
+        config.get_env_status_backend.return_value = "json"
+        env_status = create_env_status(config)
+        self.assertNotIsInstance(env_status, SqliteEnvStatus)
+        self.assertIsInstance(env_status, EnvStatus)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import time
+import unittest
+import mock
+import tests
+
+from deployd.common.exit_watcher import ExitWatcher, TimerQueue
+
+
+class TestTimerQueue(tests.TestCase):
+    def test_pop_expired_in_deadline_order(self):
+        timers = TimerQueue()
+        self.assertIsNone(timers.next_timeout())
+        timers.schedule("timeout", 0.02)
+        timers.schedule("ping", 0.01)
+        timers.schedule("retry", 60)
+        self.assertLessEqual(timers.next_timeout(), 0.01)
+        time.sleep(0.03)
+        self.assertEqual(timers.pop_expired(), ["ping", "timeout"])
+        self.assertGreater(timers.next_timeout(), 50)
+
+    def test_cancel(self):
+        timers = TimerQueue()
+        timers.schedule("timeout", 0)
+        timers.schedule("ping", 0)
+        timers.cancel("timeout")
+        self.assertEqual(timers.pop_expired(), ["ping"])
+
+
+class TestExitWatcher(tests.TestCase):
+    def _assert_wakes_on_exit(self):
+        process = subprocess.Popen(["sleep", "0.1"])
+        with ExitWatcher(process) as watcher:
+            self.assertIsNone(watcher.wait(0))
+            start = time.monotonic()
+            self.assertEqual(watcher.wait(30), 0)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertEqual(watcher.wait(30), 0)
+
+    def test_wait(self):
+        self._assert_wakes_on_exit()
+
+    def test_wait_without_pidfd(self):
+        with mock.patch("os.pidfd_open", side_effect=OSError, create=True):
+            self._assert_wakes_on_exit()
+
+    def test_wait_timeout(self):
+        process = subprocess.Popen(["sleep", "30"])
+        try:
+            with ExitWatcher(process) as watcher:
+                self.assertIsNone(watcher.wait(0.1))
+        finally:
+            process.kill()
+            process.wait()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from deployd.common.facts_cache import FactsCache
+
+
+class TestFactsCache(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.cache_fn = os.path.join(self.base_dir, "host_facts")
+        self.fetch = mock.Mock(
+            side_effect=lambda keys: {key: "{}-value".format(key) for key in keys}
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _cache(self):
+        return FactsCache(
+            self.cache_fn, 60, ttls={"instance_id": None}, fetch=self.fetch
+        )
+
+    def test_fetch_missing_keys_once(self):
+        cache = self._cache()
+        expected = {"instance_id": "instance_id-value", "ec2_tags": "ec2_tags-value"}
+        self.assertEqual(cache.get(["instance_id", "ec2_tags"]), expected)
+        self.assertEqual(cache.get(["instance_id", "ec2_tags"]), expected)
+        self.fetch.assert_called_once_with({"instance_id", "ec2_tags"})
+
+        # another agent process reads the cache from disk
+        self.assertEqual(self._cache().get(["instance_id", "ec2_tags"]), expected)
+        self.assertEqual(self.fetch.call_count, 1)
+
+    @mock.patch("deployd.common.facts_cache.time.time")
+    def test_refresh_stale_keys_in_background(self, mock_time):
+        mock_time.return_value = 1000
+        cache = self._cache()
+        cache.get(["instance_id", "ec2_tags"])
+
+        mock_time.return_value = 2000
+        self.fetch.side_effect = lambda keys: {key: "new" for key in keys}
+        # the stale value is served while it is refreshed
+        self.assertEqual(cache.get(["ec2_tags"]), {"ec2_tags": "ec2_tags-value"})
+        cache.join()
+        self.assertEqual(
+            cache.get(["instance_id", "ec2_tags"]),
+            {"instance_id": "instance_id-value", "ec2_tags": "new"},
+        )
+        # the immutable key was never fetched again
+        self.fetch.assert_called_with({"ec2_tags"})
+
+    def test_keep_cached_values_when_facter_fails(self):
+        cache = self._cache()
+        cache.get(["ec2_tags"])
+        self.fetch.side_effect = lambda keys: None
+        self.assertEqual(
+            cache.get(["ec2_tags", "stage_type"]), {"ec2_tags": "ec2_tags-value"}
+        )
+
+    def test_missing_values_are_not_cached(self):
+        cache = self._cache()
+        self.fetch.side_effect = lambda keys: {"instance_id": None}
+        self.assertEqual(cache.get(["instance_id"]), {})
+        self.fetch.side_effect = lambda keys: {"instance_id": "i-1"}
+        self.assertEqual(cache.get(["instance_id"]), {"instance_id": "i-1"})
+        self.assertEqual(self.fetch.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import mock
+import tests
+
+from deployd.common.executor import Executor
+from deployd.common.forked_process import (
+    ForkedProcess,
+    IN_PROCESS_COMMANDS,
+    get_in_process_main,
+)
+from deployd.common.types import AgentStatus
+
+
+def main():
+    print("argv {}".format(" ".join(sys.argv[1:])))
+    if "sleep" in sys.argv:
+        time.sleep(60)
+    if "fail" in sys.argv:
+        sys.exit(3)
+    if "raise" in sys.argv:
+        raise ValueError("boom")
+    return 0
+
+
+class TestForkedProcess(tests.TestCase):
+    def setUp(self):
+        self.fdout_fn = tempfile.mkstemp()[1]
+        self.fdout = open(self.fdout_fn, "a+")
+
+    def tearDown(self):
+        self.fdout.close()
+        os.remove(self.fdout_fn)
+
+    def _output(self):
+        with open(self.fdout_fn) as f:
+            return f.read()
+
+    def test_get_in_process_main(self):
+        with mock.patch.dict(IN_PROCESS_COMMANDS, {"fake-stage": __name__}):
+            self.assertIs(get_in_process_main(["/usr/bin/fake-stage", "-e"]), main)
+        self.assertIsNone(get_in_process_main(["/bin/echo", "hello"]))
+
+    def test_exit_code(self):
+        process = ForkedProcess(["fake-stage", "ok"], main, stdout=self.fdout)
+        self.assertEqual(process.wait(timeout=10), 0)
+        self.assertEqual(self._output(), "argv ok\n")
+
+        process = ForkedProcess(["fake-stage", "fail"], main, stdout=self.fdout)
+        self.assertEqual(process.wait(), 3)
+
+        process = ForkedProcess(["fake-stage", "raise"], main, stdout=self.fdout)
+        self.assertEqual(process.wait(), 1)
+        self.assertIn("ValueError: boom", self._output())
+
+    def test_wait_timeout_and_kill(self):
+        process = ForkedProcess(
+            ["fake-stage", "sleep"], main, stdout=self.fdout, preexec_fn=os.setsid
+        )
+        self.assertIsNone(process.poll())
+        with self.assertRaises(subprocess.TimeoutExpired):
+            process.wait(timeout=0.2)
+        os.kill(process.pid, signal.SIGKILL)
+        self.assertEqual(process.wait(), -signal.SIGKILL)
+
+    def test_executor_runs_in_process(self):
+        executor = Executor(callback=mock.Mock(return_value=False))
+        executor.IN_PROCESS_STAGES = True
+        executor.LOG_FILENAME = self.fdout_fn
+        executor.MAX_RUNNING_TIME = 10
+        executor.MIN_RUNNING_TIME = 2
+        executor.MAX_RETRY = 1
+        executor.PROCESS_POLL_INTERVAL = 0.1
+        executor.MAX_TAIL_BYTES = 10240
+        with mock.patch.dict(IN_PROCESS_COMMANDS, {"fake-stage": __name__}):
+            with mock.patch("subprocess.Popen") as popen:
+                deploy_report = executor.run_cmd(cmd=["fake-stage", "ok"])
+        self.assertFalse(popen.called)
+        self.assertEqual(deploy_report.status_code, AgentStatus.SUCCEEDED)
+        self.assertIn("argv ok", self._output())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler
+from unittest import mock
+
+import requests
+
+from deployd.common.health_snapshot import HealthSnapshot, list_containers
+
+CONTAINERS = [
+    {
+        "Id": "1",
+        "Image": "service:abc123",
+        "Names": ["/web"],
+        "Labels": {"redeploy_when_unhealthy": "enabled", "redeploy_max_retry": "2"},
+        "Status": "Up 2 hours (unhealthy)",
+    },
+    {
+        "Id": "2",
+        "Image": "service:abc123",
+        "Names": ["/sidecar"],
+        "Labels": {},
+        "Status": "Up 2 hours (healthy)",
+    },
+    {
+        "Id": "3",
+        "Image": "batch:def456",
+        "Names": ["/batch"],
+        "Labels": {},
+        "Status": "Up 3 seconds (health: starting)",
+    },
+    {
+        "Id": "4",
+        "Image": "nocheck:def456",
+        "Names": ["/nocheck"],
+        "Labels": {},
+        "Status": "Up 2 hours",
+    },
+]
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        FakeDockerHandler.requests.append(self.path)
+        body = json.dumps(CONTAINERS).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_status(env_name, commit):
+    status = mock.Mock()
+    status.report.envName = env_name
+    status.build_info.build_commit = commit
+    return status
+
+
+class TestHealthSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp_dir, "docker.sock")
+        self.server = socketserver.UnixStreamServer(self.socket_path, FakeDockerHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        FakeDockerHandler.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_list_containers(self):
+        self.assertEqual(list_containers(self.socket_path, timeout=5), CONTAINERS)
+
+    @mock.patch("subprocess.run")
+    def test_one_query_for_all_envs(self, run):
+        statuses = [
+            make_status("service", "abc123"),
+            make_status("batch", "def456"),
+        ]
+        health = HealthSnapshot(self.socket_path)
+        health.take(statuses)
+        self.assertEqual(
+            health.get_container_health_info("abc123", "service", 0), "redeploy-1"
+        )
+        self.assertEqual(
+            health.get_container_health_info("abc123", "service", 2),
+            "web:unhealthy;sidecar:healthy",
+        )
+        self.assertEqual(
+            health.get_container_health_info("def456", "batch", 0), "batch:starting"
+        )
+        self.assertEqual(FakeDockerHandler.requests, ["/containers/json"])
+        self.assertFalse(run.called)
+
+    @mock.patch("deployd.common.health_snapshot.read_healthcheck_configs")
+    @mock.patch("deployd.common.health_snapshot.check_http_health")
+    def test_http_checks_run_in_take(self, check_http_health, read_configs):
+        read_configs.return_value = {"HEALTHCHECK_HTTP": "localhost:9999/health"}
+        check_http_health.return_value = True
+        health = HealthSnapshot(self.socket_path, timeout=1)
+        health.take([make_status("other", "fff000")])
+        check_http_health.assert_called_once_with("http://localhost:9999/health", 1)
+        with mock.patch(
+            "deployd.common.utils.read_healthcheck_configs",
+            return_value=read_configs.return_value,
+        ):
+            self.assertEqual(
+                health.get_container_health_info("fff000", "other", 0),
+                "other:healthy",
+            )
+        self.assertEqual(check_http_health.call_count, 1)
+
+    @mock.patch("deployd.common.health_snapshot.get_container_health_info")
+    def test_docker_cli_without_socket(self, get_container_health_info):
+        health = HealthSnapshot(os.path.join(self.tmp_dir, "missing.sock"))
+        health.take([make_status("service", "abc123")])
+        health.get_container_health_info("abc123", "service", 0)
+        get_container_health_info.assert_called_once_with(
+            "abc123", "service", 0, http_check=health._check_http_health
+        )
+
+    @mock.patch("deployd.common.utils.get_docker_cli_containers", return_value=[])
+    @mock.patch("deployd.common.utils.read_healthcheck_configs")
+    @mock.patch("requests.get")
+    def test_docker_cli_http_check_timeout(self, get, read_configs, cli_containers):
+        read_configs.return_value = {
+            "HEALTHCHECK_HTTP": "localhost:9999/health",
+            "HEALTHCHECK_REDEPLOY_WHEN_UNHEALTHY": "True",
+        }
+        get.side_effect = requests.ReadTimeout()
+        health = HealthSnapshot(os.path.join(self.tmp_dir, "missing.sock"), timeout=1)
+        health.take([make_status("other", "fff000")])
+        self.assertEqual(
+            health.get_container_health_info("fff000", "other", 0), "redeploy-1"
+        )
+        get.assert_called_once_with("http://localhost:9999/health", timeout=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+import mock
+import tests
+
+from deployd.common.executor import Executor
+from deployd.common.output_tee import OutputTee, rotate_log
+from deployd.common.types import AgentStatus
+
+
+class TestOutputTee(tests.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.log_fn = os.path.join(self.base_dir, "env.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _run(self, cmd, tail_bytes=10, rotate_bytes=0):
+        tee = OutputTee(self.log_fn, tail_bytes, rotate_bytes)
+        try:
+            process = subprocess.Popen(cmd, stdout=tee.writer, stderr=tee.writer)
+            tee.close_writer()
+            while tee.drain():
+                process.poll()
+            process.wait()
+            self.assertLessEqual(len(tee._tail), tail_bytes + 1)
+            return tee.get_output()
+        finally:
+            tee.close()
+
+    def test_tail_and_log(self):
+        output = self._run(["seq", "100000"])
+        self.assertEqual(output, "999\n100000")
+        with open(self.log_fn) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 100000)
+        self.assertEqual(lines[-1], "100000")
+
+    def test_rotate_while_writing(self):
+        self._run(["seq", "100000"], rotate_bytes=64 * 1024)
+        self.assertLessEqual(os.path.getsize(self.log_fn), 64 * 1024)
+        self.assertTrue(os.path.exists("{}.1".format(self.log_fn)))
+
+    def test_rotate_log(self):
+        self.assertFalse(rotate_log(self.log_fn, 10))
+        with open(self.log_fn, "w") as f:
+            f.write("x" * 20)
+        self.assertFalse(rotate_log(self.log_fn, 0))
+        self.assertFalse(rotate_log(self.log_fn, 100))
+        self.assertTrue(rotate_log(self.log_fn, 10))
+        self.assertFalse(os.path.exists(self.log_fn))
+        self.assertEqual(os.path.getsize("{}.1".format(self.log_fn)), 20)
+
+    def test_daemon_outlives_the_tee(self):
+        status_fn = os.path.join(self.base_dir, "status")
+        # the background job still holds the pipe when the command exits
+        script = "(sleep 0.5; seq 100000; echo $? > {}) & echo started".format(
+            status_fn
+        )
+        tee = OutputTee(self.log_fn, 20)
+        try:
+            process = subprocess.Popen(["sh", "-c", script], stdout=tee.writer)
+            tee.close_writer()
+            process.wait()
+            self.assertTrue(tee.drain())
+            self.assertEqual(tee.get_output(), "started")
+        finally:
+            tee.close()
+
+        for _ in range(100):
+            if os.path.exists(status_fn) and os.path.getsize(status_fn):
+                break
+            time.sleep(0.1)
+        with open(status_fn) as f:
+            self.assertEqual(f.read(), "0\n")
+        with open(self.log_fn) as f:
+            self.assertEqual(f.read().splitlines()[-1], "100000")
+
+    def _run_cmd(self, output_pipe):
+        executor = Executor(callback=mock.Mock(return_value=False))
+        executor.OUTPUT_PIPE = output_pipe
+        executor.LOG_FILENAME = self.log_fn
+        executor.MAX_RUNNING_TIME = 30
+        executor.MIN_RUNNING_TIME = 30
+        executor.MAX_RETRY = 1
+        executor.PROCESS_POLL_INTERVAL = 1
+        executor.MAX_TAIL_BYTES = 10
+        return executor.run_cmd(cmd=["seq", "200000"])
+
+    def test_executor_output(self):
+        for output_pipe in (False, True):
+            deploy_report = self._run_cmd(output_pipe)
+            self.assertEqual(deploy_report.status_code, AgentStatus.SUCCEEDED)
+            self.assertEqual(deploy_report.output_msg, "999\n200000")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,8 +13,14 @@
 # limitations under the License.
 
 from deployd.common.stats import (
-    MetricCache,
+    DDSketch,
+    MetricAggregator,
+    MetricPipeline,
+    SegmentedMetricCache,
     Stat,
+    StatsdCounter,
+    aggregate_stats,
+    _reset_after_fork,
     MetricClient,
     TimeElapsed,
     MetricCacheConfigurationError,
@@ -24,6 +30,8 @@ from deployd import __version__
 import unittest
 import os
 import json
+import shutil
+import tempfile
 import socket
 from time import sleep
 from unittest import mock
@@ -32,44 +40,7 @@ from unittest import mock
 class TestMetricCacheExceptions(unittest.TestCase):
     def test__MetricCacheConfigurationError(self):
         with self.assertRaises(MetricCacheConfigurationError):
-            MetricCache(path=None)
-
-
-class TestMetricCache(unittest.TestCase):
-    path = "tests/unit/deploy/common/test_stats.cache"
-    data = "testdata"
-
-    def test_exists(self):
-        cache = MetricCache(self.path)
-        self.assertTrue(cache.exists())
-
-    def test_is_empty(self):
-        cache = MetricCache(self.path)
-        cache.truncate()
-        self.assertTrue(cache.is_empty())
-
-    def test_read(self):
-        cache = MetricCache(self.path)
-        cache.truncate()
-        with open(self.path, "w") as fh:
-            fh.write("{}\n".format(self.data))
-        count = 0
-        for _ in cache.read():
-            count += 1
-        self.assertEqual(count, 1)
-
-    def test_write(self):
-        cache = MetricCache(self.path)
-        cache.truncate()
-        cache.write(self.data)
-        with open(self.path, "r") as fh:
-            validate = fh.read()
-        expect = "{}\n".format(self.data)
-        self.assertEqual(validate, expect)
-
-    def tearDown(self):
-        MetricCache(self.path)
-        os.remove(self.path)
+            SegmentedMetricCache(path=None)
 
 
 class TestStat(unittest.TestCase):
@@ -179,8 +150,9 @@ class TestMetricClient(unittest.TestCase):
         self.client = MetricClient(port=self.port, cache_path=self.cache_path)
 
     def tearDown(self):
-        MetricCache(self.cache_path)
-        os.remove(self.cache_path)
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+        shutil.rmtree(self.client.cache.segment_dir, ignore_errors=True)
 
     def test__add_default_tags(self):
         tag_version = {"deploy_agent_version": __version__}
@@ -202,6 +174,315 @@ class TestMetricClient(unittest.TestCase):
         mock_connect_ex.raiseError.side_effect = Exception(socket.error)
         self.assertFalse(self.client.is_healthy())
 
+    @mock.patch("deployd.common.stats.MetricClient._health", (None, False))
+    def test_is_healthy_cached(self):
+        with mock.patch.object(self.client, "is_healthy", return_value=True) as check:
+            self.assertTrue(self.client.is_healthy_cached())
+            self.assertTrue(self.client.is_healthy_cached())
+            self.assertEqual(check.call_count, 1)
+
+    @mock.patch("deployd.common.stats.MetricClient._health", (None, False))
+    def test_send_batch_unhealthy(self):
+        with mock.patch.object(self.client, "is_healthy", return_value=False):
+            self.client.send_batch(
+                [Stat(mtype="increment", name="a"), Stat(mtype="increment", name="b")]
+            )
+        (segment,) = self.client.cache.seal()
+        stats = list(self.client.cache.read(segment))
+        self.assertEqual([stat.name for stat in stats], ["a", "b"])
+        self.assertEqual(stats[0].tags, {"deploy_agent_version": __version__})
+
+    def _statsd_sink(self):
+        """a local statsd socket receiving the counter packets of the client"""
+        sink = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))
+        sink.settimeout(5)
+        self.addCleanup(sink.close)
+        self.client._counter = StatsdCounter(
+            "127.0.0.1:{}".format(sink.getsockname()[1])
+        )
+        return sink
+
+    @mock.patch("deployd.common.stats.MetricClient._health", (None, False))
+    @mock.patch("deployd.common.stats.sc", autospec=True)
+    @mock.patch("deployd.common.stats.sc_v2", autospec=True)
+    def test_replay_aggregates_increments(self, sc_v2, sc):
+        sink = self._statsd_sink()
+        for _ in range(10000):
+            self.client.cache.write(Stat(mtype="increment", name="a", tags={"x": 1}))
+        self.client.cache.write(Stat(mtype="gauge", name="g", value=1))
+        self.client.cache.write(Stat(mtype="gauge", name="g", value=2))
+        with mock.patch.object(self.client, "is_healthy", return_value=True):
+            self.client.send_batch([])
+            MetricClient._replay_thread.join(10)
+        # the real increment takes no count, 10000 increments are one packet each
+        self.assertFalse(sc.increment.called)
+        self.assertEqual(
+            [sink.recv(1024), sink.recv(1024)],
+            [b"a.cluster:10000|c|#x:1", b"a:10000|c|#x:1"],
+        )
+        sc.gauge.assert_called_once_with("g", 2, sample_rate=None, tags=None)
+        self.assertTrue(self.client.cache.is_empty())
+
+    @mock.patch("deployd.common.stats.MetricClient._health", (None, False))
+    @mock.patch("deployd.common.stats._RateLimiter.wait")
+    @mock.patch("deployd.common.stats.sc", autospec=True)
+    @mock.patch("deployd.common.stats.sc_v2", autospec=True)
+    def test_replay_rate_limits_merged_stats(self, sc_v2, sc, wait):
+        sink = self._statsd_sink()
+        # one per segment, merged across both
+        for name in ("a", "a", "b"):
+            self.client.cache.write(Stat(mtype="increment", name=name))
+            self.client.cache.seal()
+        with mock.patch.object(self.client, "is_healthy", return_value=True):
+            self.client.send_batch([])
+            MetricClient._replay_thread.join(10)
+        self.assertEqual(sink.recv(1024), b"a.cluster:2|c")
+        sc.increment.assert_called_once_with("b", None, None)
+        self.assertEqual(wait.call_args_list, [mock.call(2)] * 2)
+
+    @mock.patch("deployd.common.stats.MetricClient._health", (None, False))
+    def test_replay_keeps_merged_stats_when_sink_goes_down(self):
+        self.client.cache.write(Stat(mtype="increment", name="a"))
+        with mock.patch.object(
+            self.client, "is_healthy", side_effect=[True, True, False]
+        ):
+            self.client.HEALTH_CHECK_TTL = -1
+            self.client.send_batch([])
+            MetricClient._replay_thread.join(10)
+        (segment,) = self.client.cache.seal()
+        self.assertEqual([stat.name for stat in self.client.cache.read(segment)], ["a"])
+
+    def test_statsd_counter_format(self):
+        self.assertEqual(StatsdCounter.format("a", 3), b"a:3|c")
+        self.assertEqual(
+            StatsdCounter.format("a", 3, {"y": 2, "x": "b"}), b"a:3|c|#x:b,y:2"
+        )
+
+
+class TestSegmentedMetricCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "metrics.cache")
+        self.stat = Stat(mtype="timing", name="t", value=1.5, tags={"a": "b"})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_seal_read(self):
+        cache = SegmentedMetricCache(self.path)
+        self.assertTrue(cache.is_empty())
+        cache.write(self.stat)
+        self.assertFalse(cache.is_empty())
+        (segment,) = cache.seal()
+        cache.write(self.stat)
+        (stat,) = cache.read(segment)
+        self.assertEqual(
+            (stat.mtype, stat.name, stat.value, stat.tags),
+            ("timing", "t", 1.5, {"a": "b"}),
+        )
+        cache.remove(segment)
+        self.assertEqual(len(cache.segments()), 1)
+
+    def test_evicts_oldest_segment(self):
+        line = len(SegmentedMetricCache.encode(self.stat)) + 1
+        cache = SegmentedMetricCache(self.path, segment_size=line, max_segments=2)
+        for value in range(3):
+            cache.write(Stat(mtype="gauge", name="g", value=value))
+        values = [stat.value for fn in cache.seal() for stat in cache.read(fn)]
+        self.assertEqual(values, [1, 2])
+
+    def test_replays_legacy_cache(self):
+        # the json lines cache file of older agents
+        with open(self.path, "w") as fh:
+            fh.write("{}\n".format(self.stat.serialize()))
+        cache = SegmentedMetricCache(self.path)
+        self.assertFalse(cache.is_empty())
+        (segment,) = cache.seal()
+        self.assertEqual([stat.name for stat in cache.read(segment)], ["t"])
+        cache.remove(segment)
+        self.assertTrue(cache.is_empty())
+
+    def test_aggregate_stats(self):
+        stats = aggregate_stats(
+            [
+                Stat(mtype="increment", name="a", tags={"x": 1, "y": 2}),
+                Stat(mtype="increment", name="a", value=3, tags={"y": 2, "x": 1}),
+                Stat(mtype="increment", name="a", tags={"x": 2}),
+                Stat(mtype="timing", name="t", value=1),
+                Stat(mtype="timing", name="t", value=2),
+            ]
+        )
+        self.assertEqual(
+            [(stat.name, stat.value) for stat in stats],
+            [("a", 4), ("a", 1), ("t", 1), ("t", 2)],
+        )
+
+
+class TestMetricPipeline(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.pipeline = MetricPipeline(
+            max_size=2, flush_interval=60, client_factory=lambda: self.client
+        )
+
+    def test_put_does_not_send(self):
+        tags = {"env_name": "a"}
+        self.pipeline.put(Stat(mtype="increment", name="a", tags=tags))
+        tags["env_name"] = "b"
+        self.assertFalse(self.client.send_batch.called)
+        self.pipeline.flush()
+        stats = self.client.send_batch.call_args[0][0]
+        self.assertEqual([stat.tags for stat in stats], [{"env_name": "a"}])
+        self.pipeline.flush()
+        self.assertEqual(self.client.send_batch.call_count, 1)
+
+    def test_overflow_spills_to_cache(self):
+        self.client._add_default_tags = mock.Mock(side_effect=lambda tags: tags)
+        for name in "abc":
+            self.pipeline.put(Stat(mtype="increment", name=name))
+        self.assertEqual(self.client.cache.write.call_count, 1)
+        self.pipeline.flush()
+        stats = self.client.send_batch.call_args[0][0]
+        self.assertEqual([stat.name for stat in stats], ["a", "b"])
+
+    def test_flush_in_forked_child(self):
+        client = mock.Mock()
+        pipeline = MetricPipeline(flush_interval=60, client_factory=lambda: client)
+        pipeline.put(Stat(mtype="increment", name="parent"))
+        # as in a child forked while the parent was flushing
+        pipeline._pid = -1
+        pipeline._flush_lock.acquire()
+        pipeline.flush()
+        self.assertFalse(client.send_batch.called)
+        pipeline.put(Stat(mtype="increment", name="child"))
+        pipeline.flush()
+        (stat,) = client.send_batch.call_args[0][0]
+        self.assertEqual(stat.name, "child")
+
+    def test_replay_lock_is_reset_in_forked_child(self):
+        lock = MetricClient._replay_lock
+        lock.acquire()
+        try:
+            # as in a child forked while a parent thread started a replay
+            _reset_after_fork()
+            self.assertIsNot(MetricClient._replay_lock, lock)
+            self.assertTrue(MetricClient._replay_lock.acquire(timeout=1))
+            MetricClient._replay_lock.release()
+        finally:
+            lock.release()
+
+    def test_flush_thread_survives_errors(self):
+        pipeline = MetricPipeline(
+            flush_interval=0.01, client_factory=lambda: self.client
+        )
+        aggregator = mock.Mock()
+        aggregator.offer.side_effect = [RuntimeError("boom"), False]
+        aggregator.flush.return_value = []
+        pipeline._aggregator = aggregator
+        pipeline.put(Stat(mtype="gauge", name="a", value=1))
+        for _ in range(500):
+            if aggregator.offer.called:
+                break
+            sleep(0.01)
+        # the flush of a failed, the thread goes on with the next stats
+        pipeline.put(Stat(mtype="gauge", name="b", value=1))
+        for _ in range(500):
+            if self.client.send_batch.called:
+                break
+            sleep(0.01)
+        (stat,) = self.client.send_batch.call_args[0][0]
+        self.assertEqual(stat.name, "b")
+        self.assertTrue(pipeline._thread.is_alive())
+
+    def test_dead_flush_thread_is_restarted(self):
+        self.pipeline._thread = mock.Mock()
+        self.pipeline._thread.is_alive.return_value = False
+        self.pipeline._pid = os.getpid()
+        self.pipeline.put(Stat(mtype="gauge", name="a", value=1))
+        self.assertTrue(self.pipeline._thread.is_alive())
+
+    def test_background_flush(self):
+        pipeline = MetricPipeline(
+            flush_interval=0.01, client_factory=lambda: self.client
+        )
+        # counters are held for the aggregation window
+        pipeline.put(Stat(mtype="gauge", name="a", value=1))
+        for _ in range(500):
+            if self.client.send_batch.called:
+                break
+            sleep(0.01)
+        self.assertTrue(self.client.send_batch.called)
+
+
+class TestMetricAggregator(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = MetricAggregator(
+            patterns="deploy.agent.rest.*,latency", window=60, counter_patterns=""
+        )
+
+    def test_sketch_quantiles(self):
+        sketch = DDSketch(relative_accuracy=0.01)
+        for value in range(1, 1001):
+            sketch.add(value)
+        self.assertAlmostEqual(sketch.quantile(0.5), 500, delta=5)
+        self.assertAlmostEqual(sketch.quantile(0.99), 990, delta=10)
+        self.assertEqual(sketch.quantile(1), 1000)
+        self.assertIsNone(DDSketch().quantile(0.5))
+
+    def test_counters_are_summed_per_tags(self):
+        for code in (200, 200, 500):
+            self.assertTrue(
+                self.aggregator.offer(
+                    Stat(
+                        mtype="increment",
+                        name="deploy.agent.rest.status",
+                        tags={"status_code": code},
+                    )
+                )
+            )
+        self.assertFalse(self.aggregator.offer(Stat(mtype="increment", name="other")))
+        self.assertEqual(self.aggregator.flush(), [])
+        stats = self.aggregator.flush(force=True)
+        self.assertEqual(
+            [(stat.tags["status_code"], stat.value) for stat in stats],
+            [(200, 2), (500, 1)],
+        )
+        self.assertEqual(self.aggregator.flush(force=True), [])
+
+    def test_counters_are_aggregated_by_default(self):
+        aggregator = MetricAggregator(patterns="", window=60)
+        for _ in range(3):
+            self.assertTrue(aggregator.offer(Stat(mtype="increment", name="other")))
+        self.assertFalse(aggregator.offer(Stat(mtype="timing", name="t", value=1)))
+        (stat,) = aggregator.flush(force=True)
+        self.assertEqual((stat.mtype, stat.name, stat.value), ("increment", "other", 3))
+
+    def test_timings_are_sent_as_percentiles(self):
+        for value in range(1, 101):
+            self.aggregator.offer(Stat(mtype="timing", name="latency", value=value))
+        stats = {stat.name: stat for stat in self.aggregator.flush(force=True)}
+        self.assertEqual(stats["latency.count"].value, 100)
+        self.assertEqual(stats["latency.max"].value, 100)
+        self.assertAlmostEqual(stats["latency.p50"].value, 50, delta=1)
+        self.assertEqual(stats["latency.p99"].mtype, "gauge")
+        self.assertEqual(stats["latency.count"].mtype, "gauge")
+
+    def test_pipeline_holds_aggregates_for_the_window(self):
+        client = mock.Mock()
+        pipeline = MetricPipeline(
+            flush_interval=60,
+            client_factory=lambda: client,
+            aggregator_factory=lambda: self.aggregator,
+        )
+        pipeline.put(Stat(mtype="increment", name="deploy.agent.rest.status"))
+        pipeline.put(Stat(mtype="increment", name="deploy.agent.rest.status"))
+        pipeline.flush(force=False)
+        self.assertFalse(client.send_batch.called)
+        pipeline.flush()
+        (stat,) = client.send_batch.call_args[0][0]
+        self.assertEqual(stat.value, 2)
+
 
 class TestTimeElapsed(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,99 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from deployd.download.artifact_cache import ArtifactCache
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.base_dir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _write(self, name, size):
+        path = os.path.join(self.base_dir, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+
+    def test_materialize(self):
+        cache = ArtifactCache(self.cache_dir, max_bytes=1024)
+        dest = os.path.join(self.base_dir, "env2-b1.tar.gz")
+        self.assertFalse(cache.materialize("https://repo/b1.tar.gz", dest))
+
+        src = self._write("env1-b1.tar.gz", 100)
+        cache.add("https://repo/b1.tar.gz", src, checksum="abc")
+        self.assertTrue(cache.materialize("https://repo/b1.tar.gz", dest, "abc"))
+        self.assertEqual(os.path.getsize(dest), 100)
+        # same filesystem, so the package is hardlinked rather than copied
+        self.assertEqual(os.stat(dest).st_ino, os.stat(src).st_ino)
+
+        # the cached package survives the removal of the env packages
+        os.remove(src)
+        os.remove(dest)
+        self.assertTrue(cache.materialize("https://repo/b1.tar.gz", dest, "abc"))
+
+    def test_republished_package_is_a_miss(self):
+        cache = ArtifactCache(self.cache_dir, max_bytes=1024)
+        cache.add("https://repo/b1.tar.gz", self._write("b1", 100), checksum="abc")
+        dest = os.path.join(self.base_dir, "dest")
+        self.assertFalse(cache.materialize("https://repo/b1.tar.gz", dest, "def"))
+        self.assertFalse(os.path.exists(dest))
+
+        cache.add("https://repo/b1.tar.gz", self._write("b1", 50), checksum="def")
+        self.assertTrue(cache.materialize("https://repo/b1.tar.gz", dest, "def"))
+        self.assertEqual(os.path.getsize(dest), 50)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, "objects"))), 1)
+
+    def test_lru_eviction(self):
+        cache = ArtifactCache(self.cache_dir, max_bytes=250)
+        cache.add("https://repo/b1.tar.gz", self._write("b1", 100))
+        cache.add("https://repo/b2.tar.gz", self._write("b2", 100))
+        # b1 becomes the most recently used package
+        self.assertTrue(
+            cache.materialize(
+                "https://repo/b1.tar.gz", os.path.join(self.base_dir, "d")
+            )
+        )
+        cache.add("https://repo/b3.tar.gz", self._write("b3", 100))
+
+        dest = os.path.join(self.base_dir, "dest")
+        self.assertFalse(cache.materialize("https://repo/b2.tar.gz", dest))
+        self.assertTrue(cache.materialize("https://repo/b1.tar.gz", dest))
+        self.assertTrue(cache.materialize("https://repo/b3.tar.gz", dest))
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, "objects"))), 2)
+
+    def test_add_moves_temporary_file(self):
+        cache = ArtifactCache(self.cache_dir, max_bytes=1024)
+        tmp = cache.mkstemp()
+        with open(tmp, "wb") as f:
+            f.write(b"content")
+        cache.add("https://repo/b1.tar.gz", tmp, checksum="abc", move=True)
+        self.assertFalse(os.path.exists(tmp))
+
+        dest = os.path.join(self.base_dir, "dest")
+        self.assertTrue(cache.materialize("https://repo/b1.tar.gz", dest, "abc"))
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), b"content")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+from deployd.download.decompressor import get_decompressor, open_tar
+
+
+class TestDecompressor(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.tar_fn = os.path.join(self.base_dir, "package.tar")
+        with tarfile.open(self.tar_fn, "w") as tfile:
+            info = tarfile.TarInfo("app/README")
+            info.size = 5
+            tfile.addfile(info, io.BytesIO(b"hello"))
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _compress(self, command, extension):
+        path = "{}.{}".format(self.tar_fn, extension)
+        with open(self.tar_fn, "rb") as src, open(path, "wb") as dst:
+            subprocess.check_call(command, stdin=src, stdout=dst)
+        return path
+
+    def _names(self, source, extension=None):
+        with open_tar(source, extension) as tfile:
+            return [member.name for member in tfile]
+
+    def test_get_decompressor(self):
+        self.assertEqual(get_decompressor("tar.zst").name, "zstd")
+        self.assertEqual(get_decompressor("tgz").name, "gzip")
+        self.assertEqual(get_decompressor("tar", b"\x28\xb5\x2f\xfd\x00").name, "zstd")
+        self.assertEqual(get_decompressor(None, b"\x04\x22\x4d\x18").name, "lz4")
+        self.assertIsNone(get_decompressor("tar", b"app/RE"))
+
+    @unittest.skipUnless(shutil.which("zstd"), "zstd is not installed")
+    def test_zstd(self):
+        path = self._compress(["zstd", "-c"], "zst")
+        self.assertEqual(self._names(path, "tar.zst"), ["app/README"])
+        # told by the magic bytes
+        self.assertEqual(self._names(path), ["app/README"])
+        # a file object is piped into the decompressor
+        with open(path, "rb") as f:
+            stream = io.BytesIO(f.read())
+        self.assertEqual(self._names(stream, "tar.zst"), ["app/README"])
+        self.assertEqual(stream.read(), b"")
+
+    @unittest.skipUnless(shutil.which("lz4"), "lz4 is not installed")
+    def test_lz4(self):
+        path = self._compress(["lz4", "-c"], "lz4")
+        self.assertEqual(self._names(path, "tar.lz4"), ["app/README"])
+
+    @unittest.skipUnless(shutil.which("zstd"), "zstd is not installed")
+    def test_corrupt_package(self):
+        path = self._compress(["zstd", "-c"], "zst")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 4)
+        with self.assertRaises(tarfile.TarError):
+            self._names(path, "tar.zst")
+
+    @mock.patch("deployd.download.decompressor.shutil.which", return_value=None)
+    def test_in_process_fallback(self, mock_which):
+        path = self._compress(["gzip", "-c"], "gz")
+        self.assertEqual(self._names(path, "tar.gz"), ["app/README"])
+
+        path = self._compress(["xz", "-c"], "xz") if shutil.which("xz") else None
+        if path:
+            with open(path, "rb") as f:
+                self.assertEqual(self._names(f, "tar.xz"), ["app/README"])
+
+        with self.assertRaises(tarfile.CompressionError):
+            self._names(io.BytesIO(b""), "tar.zst")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+from deployd.common.status_code import Status
+from deployd.download.delta import DELTA_MANIFEST, DeltaError, apply_delta
+from deployd.download.downloader import Downloader
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def entry(data):
+    return {"sha1": hashlib.sha1(data.encode()).hexdigest(), "size": len(data)}
+
+
+def read(path):
+    with open(path, "r") as f:
+        return f.read()
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.builds_dir = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.builds_dir, "b1")
+        write(os.path.join(self.base_dir, "app/lib/same.py"), "same")
+        write(os.path.join(self.base_dir, "app/lib/changed.py"), "old")
+        write(os.path.join(self.base_dir, "app/removed.py"), "removed")
+        # the transformed script of the enabled build and its template
+        write(os.path.join(self.base_dir, "teletraan/restarting"), "env=prod")
+        write(os.path.join(self.base_dir, "teletraan_template/restarting"), "env=$ENV")
+        os.symlink("lib/same.py", os.path.join(self.base_dir, "app/current"))
+        with open(os.path.join(self.builds_dir, "b1.extracted"), "w"):
+            pass
+        self.files = {
+            "app/lib/same.py": entry("same"),
+            "app/lib/changed.py": entry("new"),
+            "app/current": {"link": "lib/same.py"},
+            "teletraan/restarting": entry("env=$ENV"),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.builds_dir)
+
+    def _make_delta(self, path, base="b1", files=None):
+        with tarfile.open(path, "w:gz") as tfile:
+            manifest = json.dumps({"base": base, "files": files or self.files})
+            for name, data in (
+                (DELTA_MANIFEST, manifest.encode()),
+                ("app/lib/changed.py", b"new"),
+            ):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tfile.addfile(info, io.BytesIO(data))
+
+    def _extract_delta(self, working_dir, **kwargs):
+        delta_fn = os.path.join(self.builds_dir, "delta.tar.gz")
+        self._make_delta(delta_fn, **kwargs)
+        with tarfile.open(delta_fn) as tfile:
+            tfile.extractall(working_dir)
+
+    def test_apply_delta(self):
+        working_dir = os.path.join(self.builds_dir, "b2")
+        self._extract_delta(working_dir)
+
+        self.assertEqual(apply_delta(self.base_dir, "b1", working_dir), 3)
+        self.assertEqual(read(os.path.join(working_dir, "app/lib/changed.py")), "new")
+        self.assertEqual(read(os.path.join(working_dir, "app/lib/same.py")), "same")
+        # a file of its own, writes to either build do not change the other
+        self.assertEqual(
+            os.stat(os.path.join(working_dir, "app/lib/same.py")).st_nlink, 1
+        )
+        self.assertEqual(
+            os.readlink(os.path.join(working_dir, "app/current")), "lib/same.py"
+        )
+        self.assertFalse(os.path.exists(os.path.join(working_dir, "app/removed.py")))
+        self.assertFalse(os.path.exists(os.path.join(working_dir, DELTA_MANIFEST)))
+        # scripts are copied from the template
+        script = os.path.join(working_dir, "teletraan/restarting")
+        self.assertEqual(read(script), "env=$ENV")
+        self.assertEqual(os.stat(script).st_nlink, 1)
+        # the base build is untouched
+        self.assertEqual(read(os.path.join(self.base_dir, "app/lib/changed.py")), "old")
+
+    def test_wrong_base(self):
+        working_dir = os.path.join(self.builds_dir, "b2")
+        self._extract_delta(working_dir, base="b0")
+        with self.assertRaises(DeltaError):
+            apply_delta(self.base_dir, "b1", working_dir)
+
+    def test_missing_base_file(self):
+        working_dir = os.path.join(self.builds_dir, "b2")
+        files = dict(self.files, **{"app/lib/gone.py": entry("gone")})
+        self._extract_delta(working_dir, files=files)
+        with self.assertRaises(DeltaError):
+            apply_delta(self.base_dir, "b1", working_dir)
+
+    def test_base_file_changed_in_place(self):
+        write(os.path.join(self.base_dir, "app/lib/same.py"), "edit")
+        working_dir = os.path.join(self.builds_dir, "b2")
+        self._extract_delta(working_dir)
+        with self.assertRaises(DeltaError):
+            apply_delta(self.base_dir, "b1", working_dir)
+
+    def test_manifest_without_checksums(self):
+        working_dir = os.path.join(self.builds_dir, "b2")
+        self._extract_delta(working_dir, files=list(self.files))
+        with self.assertRaises(DeltaError):
+            apply_delta(self.base_dir, "b1", working_dir)
+
+    def _downloader(self):
+        config = mock.Mock()
+        config.get_builds_directory.return_value = self.builds_dir
+        config.get_agent_directory.return_value = self.builds_dir
+        config.get_artifact_cache_max_bytes.return_value = 0
+        config.get_streaming_download.return_value = False
+        config.get_delta_download.return_value = True
+        config.get_extract_workers.return_value = 1
+        target = os.path.join(self.builds_dir, "target")
+        os.symlink(self.base_dir, target)
+        return Downloader(config, "b2", "https://repo/b2.tar.gz", "env", target=target)
+
+    @mock.patch("deployd.download.downloader.DownloadHelperFactory.gen_downloader")
+    def test_download_delta(self, mock_gen_downloader):
+        helper = mock.Mock()
+        helper.download.side_effect = lambda fn: (
+            self._make_delta(fn) or Status.SUCCEEDED
+        )
+        mock_gen_downloader.return_value = helper
+
+        self.assertEqual(self._downloader().download(), Status.SUCCEEDED)
+        mock_gen_downloader.assert_called_once_with(
+            "https://repo/b2.tar.gz.delta-from-b1", mock.ANY
+        )
+        self.assertEqual(
+            read(os.path.join(self.builds_dir, "b2/app/lib/same.py")), "same"
+        )
+        self.assertTrue(os.path.exists(os.path.join(self.builds_dir, "b2.extracted")))
+
+    @mock.patch("deployd.download.downloader.DownloadHelperFactory.gen_downloader")
+    def test_fall_back_to_full_package(self, mock_gen_downloader):
+        def download(fn):
+            if ".delta-from-" in mock_gen_downloader.call_args[0][0]:
+                self._make_delta(fn, base="b0")
+            else:
+                with tarfile.open(fn, "w:gz") as tfile:
+                    tfile.addfile(tarfile.TarInfo("full"), io.BytesIO(b""))
+            return Status.SUCCEEDED
+
+        helper = mock.Mock()
+        helper.download.side_effect = download
+        mock_gen_downloader.return_value = helper
+
+        self.assertEqual(self._downloader().download(), Status.SUCCEEDED)
+        self.assertEqual(os.listdir(os.path.join(self.builds_dir, "b2")), ["full"])
+        self.assertFalse(os.path.exists(os.path.join(self.builds_dir, "env-b2.delta")))
+
+    @mock.patch("deployd.download.downloader.DownloadHelperFactory.gen_downloader")
+    def test_fall_back_when_base_changed(self, mock_gen_downloader):
+        write(os.path.join(self.base_dir, "app/lib/same.py"), "edit")
+
+        def download(fn):
+            if ".delta-from-" in mock_gen_downloader.call_args[0][0]:
+                self._make_delta(fn)
+            else:
+                with tarfile.open(fn, "w:gz") as tfile:
+                    tfile.addfile(tarfile.TarInfo("full"), io.BytesIO(b""))
+            return Status.SUCCEEDED
+
+        helper = mock.Mock()
+        helper.download.side_effect = download
+        mock_gen_downloader.return_value = helper
+
+        self.assertEqual(self._downloader().download(), Status.SUCCEEDED)
+        self.assertEqual(os.listdir(os.path.join(self.builds_dir, "b2")), ["full"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+from deployd.common.status_code import Status
+from deployd.download.download_helper import HashingStream
+from deployd.download.downloader import Downloader
+
+
+class TestStreamingDownloader(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.builds_dir = os.path.join(self.base_dir, "builds")
+        os.mkdir(self.builds_dir)
+        self.tarball = os.path.join(self.base_dir, "artifact.tar.gz")
+        with tarfile.open(self.tarball, "w:gz") as tfile:
+            data = b"echo hello\n"
+            info = tarfile.TarInfo("teletraan/RESTARTING")
+            info.size = len(data)
+            tfile.addfile(info, io.BytesIO(data))
+        self.url = "file://{}".format(self.tarball)
+
+        self.config = mock.Mock()
+        self.config.get_builds_directory.return_value = self.builds_dir
+        self.config.get_streaming_download.return_value = True
+        self.config.get_artifact_cache_max_bytes.return_value = 0
+        self.config.get_extract_workers.return_value = 1
+        self.config.get_delta_download.return_value = False
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_stream_extract(self):
+        status = Downloader(self.config, "b1", self.url, "env1").download()
+
+        self.assertEqual(status, Status.SUCCEEDED)
+        script = os.path.join(self.builds_dir, "b1", "teletraan", "RESTARTING")
+        with open(script) as f:
+            self.assertEqual(f.read(), "echo hello\n")
+        self.assertTrue(os.path.exists(os.path.join(self.builds_dir, "b1.extracted")))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.builds_dir, "env1-b1.streamed"))
+        )
+        self.assertFalse(
+            os.path.exists(os.path.join(self.builds_dir, "env1-b1.tar.gz"))
+        )
+
+    @mock.patch("deployd.download.downloader.DownloadHelperFactory.gen_downloader")
+    def test_stream_checksum_failure(self, mock_gen_downloader):
+        helper = mock.Mock()
+        helper.validate_source.return_value = True
+        helper.open_stream.return_value = HashingStream(
+            open(self.tarball, "rb"), "sha1"
+        )
+        helper.verify_stream.side_effect = lambda stream: stream.hexdigest() == "bad"
+        mock_gen_downloader.return_value = helper
+
+        status = Downloader(self.config, "b1", self.url, "env1").download()
+
+        self.assertEqual(status, Status.FAILED)
+        helper.download.assert_not_called()
+        self.assertFalse(os.path.exists(os.path.join(self.builds_dir, "b1")))
+        self.assertFalse(os.path.exists(os.path.join(self.builds_dir, "b1.extracted")))
+
+    def test_get_extension(self):
+        downloader = Downloader(self.config, "b1", "https://repo/b1.tar.zst", "env")
+        self.assertEqual(downloader._get_extension("b1.tar.zst"), "tar.zst")
+        self.assertEqual(downloader._get_extension("b1.tar.lz4.gpg"), "gpg")
+        self.assertEqual(downloader._get_inner_extension("b1.tar.lz4.gpg"), "tar.lz4")
+        self.assertEqual(downloader._get_extension("b1.tgz"), "tgz")
+
+    def test_hashing_stream(self):
+        stream = HashingStream(open(self.tarball, "rb"), "sha1")
+        stream.read(10)
+        stream.drain()
+        stream.close()
+        with open(self.tarball, "rb") as f:
+            content = f.read()
+        self.assertEqual(stream.bytes_read, len(content))
+        self.assertEqual(stream.hexdigest(), hashlib.sha1(content).hexdigest())
+
+
+class TestDownloaderArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.builds_dir = os.path.join(self.base_dir, "builds")
+        os.mkdir(self.builds_dir)
+        self.config = mock.Mock()
+        self.config.get_builds_directory.return_value = self.builds_dir
+        self.config.get_streaming_download.return_value = False
+        self.config.get_artifact_cache_max_bytes.return_value = 1024 * 1024
+        self.config.get_extract_workers.return_value = 4
+        self.config.get_delta_download.return_value = False
+        self.config.get_artifact_cache_directory.return_value = os.path.join(
+            self.base_dir, "cache"
+        )
+        self.url = "https://deployrepo/teletraan/b1.tar.gz"
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    @mock.patch("deployd.download.downloader.DownloadHelperFactory.gen_downloader")
+    def test_cache_hit_skips_download(self, mock_gen_downloader):
+        def download(local_full_fn):
+            with tarfile.open(local_full_fn, "w:gz") as tfile:
+                info = tarfile.TarInfo("README")
+                tfile.addfile(info, io.BytesIO(b""))
+            return Status.SUCCEEDED
+
+        helper = mock.Mock()
+        helper.download.side_effect = download
+        helper.checksum = "abc"
+        helper.get_checksum.return_value = "abc"
+        mock_gen_downloader.return_value = helper
+
+        status = Downloader(self.config, "b1", self.url, "env1").download()
+        self.assertEqual(status, Status.SUCCEEDED)
+        self.assertEqual(helper.download.call_count, 1)
+
+        # another env deploys the same build, e.g. a sidecar
+        os.remove(os.path.join(self.builds_dir, "b1.extracted"))
+        status = Downloader(self.config, "b1", self.url, "env2").download()
+        self.assertEqual(status, Status.SUCCEEDED)
+        self.assertEqual(helper.download.call_count, 1)
+        self.assertTrue(os.path.exists(os.path.join(self.builds_dir, "env2-b1.tar.gz")))
+        self.assertTrue(os.path.exists(os.path.join(self.builds_dir, "b1", "README")))
+
+        # the build is republished under the same url
+        helper.checksum = helper.get_checksum.return_value = "def"
+        os.remove(os.path.join(self.builds_dir, "b1.extracted"))
+        status = Downloader(self.config, "b1", self.url, "env3").download()
+        self.assertEqual(status, Status.SUCCEEDED)
+        self.assertEqual(helper.download.call_count, 2)
+
+    @mock.patch("deployd.download.downloader.DownloadHelperFactory.gen_downloader")
+    def test_download_does_not_write_through_cache_link(self, mock_gen_downloader):
+        def download(local_full_fn):
+            # like curl -o, truncate and write the destination in place
+            with open(local_full_fn, "wb") as f:
+                with open(self.tarball, "rb") as src:
+                    f.write(src.read())
+            return Status.SUCCEEDED
+
+        self.tarball = os.path.join(self.base_dir, "b1.tar.gz")
+        with tarfile.open(self.tarball, "w:gz") as tfile:
+            tfile.addfile(tarfile.TarInfo("README"), io.BytesIO(b""))
+        # a package left over from a previous cache hit
+        cached = os.path.join(self.base_dir, "cached")
+        with open(cached, "wb") as f:
+            f.write(b"cached package")
+        os.link(cached, os.path.join(self.builds_dir, "env1-b1.tar.gz"))
+
+        helper = mock.Mock()
+        helper.download.side_effect = download
+        helper.checksum = None
+        mock_gen_downloader.return_value = helper
+        self.config.get_artifact_cache_max_bytes.return_value = 0
+
+        status = Downloader(self.config, "b1", self.url, "env1").download()
+
+        self.assertEqual(status, Status.SUCCEEDED)
+        with open(cached, "rb") as f:
+            self.assertEqual(f.read(), b"cached package")
+        self.assertTrue(os.path.exists(os.path.join(self.builds_dir, "b1", "README")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from deployd.download.extractor import ParallelExtractor, UnsafeArchiveError
+
+
+def add_file(tfile, name, data, mode=0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = 1500000000
+    tfile.addfile(info, io.BytesIO(data))
+
+
+def add_symlink(tfile, name, linkname):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.SYMTYPE
+    info.linkname = linkname
+    tfile.addfile(info)
+
+
+def snapshot(root):
+    """Return {relative path: (type, mode, content or link target, mtime)}"""
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                value = ("link", os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                value = ("dir", stat.S_IMODE(st.st_mode), int(st.st_mtime))
+            else:
+                with open(path, "rb") as f:
+                    value = (
+                        "file",
+                        stat.S_IMODE(st.st_mode),
+                        f.read(),
+                        int(st.st_mtime),
+                    )
+            result[os.path.relpath(path, root)] = value
+    return result
+
+
+class TestParallelExtractor(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.tar_fn = os.path.join(self.base_dir, "package.tar.gz")
+        with tarfile.open(self.tar_fn, "w:gz") as tfile:
+            # every directory is in the archive, an implicit one would get
+            # the time of the extraction as mtime
+            for name, mode in (("app", 0o755), ("app/bin", 0o750), ("app/lib", 0o755)):
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.DIRTYPE
+                info.mode = mode
+                info.mtime = 1400000000
+                tfile.addfile(info)
+            for i in range(50):
+                add_file(tfile, "app/lib/mod{}.py".format(i), b"x = %d\n" % i)
+            add_file(tfile, "app/bin/run.sh", b"#!/bin/sh\n", mode=0o755)
+            big = os.urandom(ParallelExtractor.SMALL_FILE_BYTES + 1)
+            add_file(tfile, "app/data.bin", big)
+            add_symlink(tfile, "app/bin/current", "run.sh")
+            info = tarfile.TarInfo("app/bin/run-again.sh")
+            info.type = tarfile.LNKTYPE
+            info.linkname = "app/bin/run.sh"
+            tfile.addfile(info)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_extract_tar_like_extractall(self):
+        expected_dir = os.path.join(self.base_dir, "expected")
+        with tarfile.open(self.tar_fn) as tfile:
+            tfile.extractall(expected_dir)
+
+        dest = os.path.join(self.base_dir, "dest")
+        with tarfile.open(self.tar_fn) as tfile:
+            count = ParallelExtractor(4).extract_tar(tfile, dest)
+
+        self.assertEqual(count, 57)
+        self.assertEqual(snapshot(dest), snapshot(expected_dir))
+        self.assertEqual(
+            os.stat(os.path.join(dest, "app/bin/run.sh")).st_ino,
+            os.stat(os.path.join(dest, "app/bin/run-again.sh")).st_ino,
+        )
+
+    def test_extract_tar_stream(self):
+        dest = os.path.join(self.base_dir, "dest")
+        with open(self.tar_fn, "rb") as f:
+            with tarfile.open(fileobj=f, mode="r|*") as tfile:
+                ParallelExtractor(4).extract_tar(tfile, dest)
+        self.assertTrue(os.path.exists(os.path.join(dest, "app/lib/mod49.py")))
+
+    def test_reject_unsafe_member(self):
+        with tarfile.open(self.tar_fn, "w") as tfile:
+            add_file(tfile, "../escape.txt", b"boom")
+        dest = os.path.join(self.base_dir, "dest")
+        with tarfile.open(self.tar_fn) as tfile:
+            with self.assertRaises(UnsafeArchiveError):
+                ParallelExtractor(4).extract_tar(tfile, dest)
+        self.assertFalse(os.path.exists(os.path.join(self.base_dir, "escape.txt")))
+
+    def test_extract_symlinked_directory(self):
+        with tarfile.open(self.tar_fn, "w") as tfile:
+            add_file(tfile, "app/releases/v1/run.sh", b"#!/bin/sh\n")
+            add_symlink(tfile, "app/current", "releases/v1")
+            add_file(tfile, "app/releases/v1/lib.sh", b"")
+        expected_dir = os.path.join(self.base_dir, "expected")
+        with tarfile.open(self.tar_fn) as tfile:
+            tfile.extractall(expected_dir)
+
+        dest = os.path.join(self.base_dir, "dest")
+        with tarfile.open(self.tar_fn) as tfile:
+            ParallelExtractor(4).extract_tar(tfile, dest)
+        self.assertEqual(snapshot(dest), snapshot(expected_dir))
+
+    def test_reject_member_below_symlink(self):
+        outside = os.path.join(self.base_dir, "outside")
+        os.mkdir(outside)
+        with tarfile.open(self.tar_fn, "w") as tfile:
+            add_symlink(tfile, "app/current", outside)
+            add_file(tfile, "app/current/run.sh", b"boom")
+        dest = os.path.join(self.base_dir, "dest")
+        with tarfile.open(self.tar_fn) as tfile:
+            with self.assertRaises(UnsafeArchiveError):
+                ParallelExtractor(4).extract_tar(tfile, dest)
+        self.assertEqual(os.listdir(outside), [])
+
+    def test_symlink_replaces_pending_file(self):
+        outside = os.path.join(self.base_dir, "outside.conf")
+        with open(outside, "wb") as f:
+            f.write(b"keep")
+        with tarfile.open(self.tar_fn, "w") as tfile:
+            add_file(tfile, "app/app.conf", b"boom")
+            add_symlink(tfile, "app/app.conf", outside)
+        dest = os.path.join(self.base_dir, "dest")
+        with tarfile.open(self.tar_fn) as tfile:
+            ParallelExtractor(4).extract_tar(tfile, dest)
+        self.assertEqual(os.readlink(os.path.join(dest, "app/app.conf")), outside)
+        with open(outside, "rb") as f:
+            self.assertEqual(f.read(), b"keep")
+
+    def test_extract_zip(self):
+        zip_fn = os.path.join(self.base_dir, "package.zip")
+        with zipfile.ZipFile(zip_fn, "w") as zfile:
+            zfile.writestr("app/", b"")
+            for i in range(50):
+                zfile.writestr("app/lib/mod{}.py".format(i), b"x = %d\n" % i)
+        dest = os.path.join(self.base_dir, "dest")
+
+        self.assertEqual(ParallelExtractor(4).extract_zip(zip_fn, dest), 51)
+        with open(os.path.join(dest, "app/lib/mod7.py"), "rb") as f:
+            self.assertEqual(f.read(), b"x = 7\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,6 +14,7 @@
 
 from deployd.download.http_download_helper import HTTPDownloadHelper
 from deployd.common.config import Config
+import io
 import unittest
 from unittest import mock
 import logging
@@ -53,6 +54,15 @@ class TestHttpDownloadHelper(unittest.TestCase):
         self.assertTrue(result)
         mock_get_http_download_allow_list.assert_called_once()
 
+    @mock.patch("deployd.download.http_download_helper.requests.get")
+    def test_open_stream_asks_for_identity_encoding(self, mock_get):
+        mock_get.return_value.raw = io.BytesIO(b"package")
+        stream = self.downloader.open_stream()
+
+        self.assertEqual(stream.read(), b"package")
+        headers = mock_get.call_args[1]["headers"]
+        self.assertEqual(headers["Accept-Encoding"], "identity")
+
 
 if __name__ == "__main__":
     unittest.main()
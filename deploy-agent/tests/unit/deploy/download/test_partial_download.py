@@ -0,0 +1,197 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from deployd.download.http_download_helper import HTTPDownloadHelper
+from deployd.download.partial_download import PartialDownload
+from deployd.download.s3_download_helper import S3DownloadHelper
+
+URL = "s3://bucket1/key1.tar.gz"
+HTTP_URL = "https://deployrepo/key1.tar.gz"
+CONTENT = bytes(range(256)) * 64
+
+
+class FlakyBody(object):
+    """A response body which breaks after limit bytes"""
+
+    def __init__(self, data, limit) -> None:
+        self._body = io.BytesIO(data)
+        self._remaining = limit
+
+    def read(self, size=-1) -> bytes:
+        if self._remaining <= 0:
+            raise IOError("connection reset by peer")
+        data = self._body.read(min(size, self._remaining, 1024))
+        self._remaining -= len(data)
+        return data
+
+
+class TestPartialDownload(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.local_full_fn = os.path.join(self.base_dir, "env-b1.tar.gz")
+        patcher = mock.patch.object(PartialDownload, "CHECKPOINT_BYTES", 4096)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _interrupted_download(self, limit, validator='"etag"', url=URL):
+        partial = PartialDownload(self.local_full_fn, url)
+        self.assertEqual(partial.load(), 0)
+        with self.assertRaises(IOError):
+            partial.write(FlakyBody(CONTENT, limit), 0, validator)
+
+    def test_resume(self):
+        self._interrupted_download(10000)
+
+        partial = PartialDownload(self.local_full_fn, URL)
+        self.assertEqual(partial.load(validator='"etag"'), 10000)
+        partial.write(io.BytesIO(CONTENT[10000:]), 10000, '"etag"')
+        partial.commit()
+
+        self.assertEqual(partial.resumed_bytes, 10000)
+        self.assertEqual(partial.hexdigest(), hashlib.sha1(CONTENT).hexdigest())
+        with open(self.local_full_fn, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(os.listdir(self.base_dir), ["env-b1.tar.gz"])
+
+    def test_restart_when_object_changed(self):
+        self._interrupted_download(10000)
+
+        partial = PartialDownload(self.local_full_fn, URL)
+        self.assertEqual(partial.load(validator='"other"'), 0)
+        self.assertFalse(os.path.exists(partial.path))
+
+    def test_restart_when_partial_file_is_corrupt(self):
+        self._interrupted_download(10000)
+        partial = PartialDownload(self.local_full_fn, URL)
+        with open(partial.path, "r+b") as f:
+            f.write(b"garbage")
+
+        self.assertEqual(partial.load(), 0)
+
+    def test_server_sends_the_whole_object(self):
+        self._interrupted_download(10000)
+
+        partial = PartialDownload(self.local_full_fn, URL)
+        self.assertEqual(partial.load(), 10000)
+        # e.g. If-Range did not match, the body starts at byte 0
+        partial.write(io.BytesIO(CONTENT), 0, '"etag"')
+        partial.commit()
+
+        self.assertEqual(partial.resumed_bytes, 0)
+        with open(self.local_full_fn, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_s3_resumable_download(self):
+        etag = '"{}"'.format(hashlib.md5(CONTENT).hexdigest())
+        self._interrupted_download(10000, validator=etag)
+
+        s3_client = mock.Mock()
+        s3_client.head_object.return_value = {
+            "ContentLength": len(CONTENT),
+            "ETag": etag,
+        }
+        s3_client.get_object.return_value = {"Body": io.BytesIO(CONTENT[10000:])}
+        config = mock.Mock()
+        config.get_s3_download_allow_list.return_value = []
+        config.get_s3_download_concurrency.return_value = 1
+        config.get_resumable_download.return_value = True
+        helper = S3DownloadHelper(None, s3_client=s3_client, url=URL, config=config)
+
+        self.assertEqual(helper.download(self.local_full_fn), 0)
+        s3_client.get_object.assert_called_once_with(
+            Bucket="bucket1", Key="key1.tar.gz", IfMatch=etag, Range="bytes=10000-"
+        )
+        with open(self.local_full_fn, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    @staticmethod
+    def _http_response(status_code, body, headers=None):
+        response = mock.MagicMock()
+        response.status_code = status_code
+        response.headers = dict(headers or {}, ETag='"etag"')
+        response.raw = io.BytesIO(body)
+        response.__enter__.return_value = response
+        return response
+
+    def _http_download(self, get, responses):
+        sha_response = mock.Mock(
+            status_code=200, text=hashlib.sha1(CONTENT).hexdigest()
+        )
+        get.side_effect = responses + [sha_response]
+        config = mock.Mock()
+        config.get_http_download_allow_list.return_value = []
+        config.get_resumable_download.return_value = True
+        helper = HTTPDownloadHelper(HTTP_URL, config=config)
+        return helper, helper.download(self.local_full_fn)
+
+    @mock.patch("deployd.download.http_download_helper.requests.get")
+    def test_http_resumable_download_checks_running_sha1(self, get):
+        with mock.patch.object(HTTPDownloadHelper, "hash_file") as hash_file:
+            helper, status = self._http_download(
+                get, [self._http_response(200, CONTENT)]
+            )
+        self.assertEqual(status, 0)
+        hash_file.assert_not_called()
+        self.assertEqual(helper.checksum, hashlib.sha1(CONTENT).hexdigest())
+        # the raw body is written, it must not be content-encoded
+        for call in get.call_args_list[:1]:
+            self.assertEqual(call[1]["headers"]["Accept-Encoding"], "identity")
+
+    @mock.patch("deployd.download.http_download_helper.requests.get")
+    def test_http_resume(self, get):
+        self._interrupted_download(10000, url=HTTP_URL)
+        content_range = "bytes 10000-{}/{}".format(len(CONTENT) - 1, len(CONTENT))
+        _, status = self._http_download(
+            get,
+            [
+                self._http_response(
+                    206, CONTENT[10000:], {"Content-Range": content_range}
+                )
+            ],
+        )
+        self.assertEqual(status, 0)
+        self.assertEqual(get.call_args_list[0][1]["headers"]["Range"], "bytes=10000-")
+        with open(self.local_full_fn, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    @mock.patch("deployd.download.http_download_helper.requests.get")
+    def test_http_restart_on_unexpected_content_range(self, get):
+        self._interrupted_download(10000, url=HTTP_URL)
+        content_range = "bytes 0-{}/{}".format(len(CONTENT) - 1, len(CONTENT))
+        _, status = self._http_download(
+            get,
+            [
+                self._http_response(206, CONTENT, {"Content-Range": content_range}),
+                self._http_response(200, CONTENT),
+            ],
+        )
+        self.assertEqual(status, 0)
+        self.assertNotIn("Range", get.call_args_list[1][1]["headers"])
+        with open(self.local_full_fn, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+
+
+if __name__ == "__main__":
+    unittest.main()
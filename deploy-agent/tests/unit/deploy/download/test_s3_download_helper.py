@@ -13,10 +13,17 @@
 # limitations under the License.
 
 from deployd.download.s3_download_helper import S3DownloadHelper
+import hashlib
+import io
+import os
+import shutil
+import tempfile
 import unittest
 from unittest import mock
 import logging
+import botocore
 from deployd.common.config import Config
+from deployd.common.status_code import Status
 
 logger = logging.getLogger()
 logger.level = logging.DEBUG
@@ -56,5 +63,70 @@ class TestS3DownloadHelper(unittest.TestCase):
         mock_get_s3_download_allow_list.assert_called_once()
 
 
+class TestS3DownloadHelperEncryption(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.target = os.path.join(self.base_dir, "build.tar.gz")
+        self.content = b"package content"
+        self.sha1 = hashlib.sha1(self.content).hexdigest()
+        self.config = mock.Mock()
+        self.config.get_s3_download_allow_list.return_value = []
+        self.config.get_s3_download_concurrency.return_value = 1
+        self.config.get_resumable_download.return_value = False
+        self.s3_client = mock.Mock()
+        # SSE-C, the ETag is not the MD5 of the content
+        self.s3_client.head_object.return_value = {
+            "ContentLength": len(self.content),
+            "ETag": '"{}"'.format(hashlib.md5(b"sse-c").hexdigest()),
+            "SSECustomerAlgorithm": "AES256",
+        }
+        self.s3_client.download_file.side_effect = self._download_file
+        self.s3_client.get_object.side_effect = self._get_object
+        self.helper = S3DownloadHelper(
+            local_full_fn="",
+            s3_client=self.s3_client,
+            url="s3://bucket1/builds/b1.tar.gz",
+            config=self.config,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _download_file(self, bucket, key, local_full_fn):
+        with open(local_full_fn, "wb") as f:
+            f.write(self.content)
+
+    def _get_object(self, Bucket, Key):
+        self.assertEqual(Key, "builds/b1.tar.gz.sha1")
+        if self.sha1 is None:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+            )
+        return {"Body": io.BytesIO(self.sha1.encode())}
+
+    def test_verify_encrypted_object_by_sha1(self):
+        self.assertEqual(self.helper.download(self.target), Status.SUCCEEDED)
+
+        self.sha1 = hashlib.sha1(b"corrupt").hexdigest()
+        self.assertEqual(self.helper.download(self.target), Status.FAILED)
+
+    def test_stream_encrypted_object(self):
+        object_response = {
+            "Body": io.BytesIO(self.content),
+            "ETag": '"{}"'.format(hashlib.md5(b"kms").hexdigest()),
+            "ServerSideEncryption": "aws:kms",
+        }
+        sha1_response = {"Body": io.BytesIO(self.sha1.encode())}
+        self.s3_client.get_object.side_effect = [object_response, sha1_response]
+
+        stream = self.helper.open_stream()
+        stream.drain()
+        self.assertTrue(self.helper.verify_stream(stream))
+
+    def test_encrypted_object_without_sha1(self):
+        self.sha1 = None
+        self.assertEqual(self.helper.download(self.target), Status.SUCCEEDED)
+
+
 if __name__ == "__main__":
     unittest.main()
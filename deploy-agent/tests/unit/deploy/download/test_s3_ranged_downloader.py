@@ -0,0 +1,115 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from deployd.download.s3_ranged_downloader import S3RangedDownloader
+
+
+class TestS3RangedDownloader(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.target = os.path.join(self.base_dir, "build.tar.gz")
+        self.content = os.urandom(100 * 1024 + 17)
+        self.failures = []
+
+        def get_object(Bucket, Key, Range, IfMatch):
+            start, end = Range[len("bytes=") :].split("-")
+            if self.failures:
+                raise self.failures.pop()
+            return {"Body": io.BytesIO(self.content[int(start) : int(end) + 1])}
+
+        self.s3_client = mock.Mock()
+        self.s3_client.get_object = mock.Mock(side_effect=get_object)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _read_target(self):
+        with open(self.target, "rb") as f:
+            return f.read()
+
+    def test_single_part_etag(self):
+        etag = '"{}"'.format(hashlib.md5(self.content).hexdigest())
+        metadata = {"ContentLength": len(self.content), "ETag": etag}
+        downloader = S3RangedDownloader(
+            self.s3_client, "bucket", "key", concurrency=4, part_size=10 * 1024
+        )
+
+        self.assertTrue(downloader.download(self.target, metadata))
+        self.assertEqual(self._read_target(), self.content)
+        self.assertEqual(downloader.parts, 11)
+        self.assertEqual(downloader.bytes_downloaded, len(self.content))
+
+    def test_multipart_etag(self):
+        upload_part_size = 32 * 1024
+        digests = b"".join(
+            hashlib.md5(self.content[i : i + upload_part_size]).digest()
+            for i in range(0, len(self.content), upload_part_size)
+        )
+        etag = '"{}-4"'.format(hashlib.md5(digests).hexdigest())
+        metadata = {"ContentLength": len(self.content), "ETag": etag}
+        self.s3_client.head_object.return_value = {"ContentLength": upload_part_size}
+        downloader = S3RangedDownloader(
+            self.s3_client, "bucket", "key", concurrency=4, part_size=1024
+        )
+
+        self.assertTrue(downloader.download(self.target, metadata))
+        self.s3_client.head_object.assert_called_once_with(
+            Bucket="bucket", Key="key", PartNumber=1
+        )
+        self.assertEqual(downloader.parts, 4)
+        self.assertEqual(self._read_target(), self.content)
+
+        corrupt = '"{}-4"'.format(hashlib.md5(b"corrupt").hexdigest())
+        metadata["ETag"] = corrupt
+        self.assertFalse(downloader.download(self.target, metadata))
+
+    def test_encrypted_etag_is_not_verified(self):
+        # the ETag of an SSE-KMS object is not the MD5 of its content
+        metadata = {
+            "ContentLength": len(self.content),
+            "ETag": '"{}-2"'.format(hashlib.md5(b"kms").hexdigest()),
+            "ServerSideEncryption": "aws:kms",
+        }
+        downloader = S3RangedDownloader(
+            self.s3_client, "bucket", "key", concurrency=4, part_size=64 * 1024
+        )
+
+        self.assertTrue(downloader.download(self.target, metadata))
+        self.s3_client.head_object.assert_not_called()
+        self.assertEqual(downloader.parts, 2)
+        self.assertEqual(self._read_target(), self.content)
+
+    def test_retry_part(self):
+        etag = '"{}"'.format(hashlib.md5(self.content).hexdigest())
+        metadata = {"ContentLength": len(self.content), "ETag": etag}
+        self.failures = [IOError("connection reset")]
+        downloader = S3RangedDownloader(
+            self.s3_client, "bucket", "key", concurrency=1, part_size=64 * 1024
+        )
+
+        self.assertTrue(downloader.download(self.target, metadata))
+        self.assertEqual(downloader.retries, 1)
+        self.assertEqual(self._read_target(), self.content)
+
+
+if __name__ == "__main__":
+    unittest.main()
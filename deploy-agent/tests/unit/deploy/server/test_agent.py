@@ -46,6 +46,7 @@ class TestDeployAgent(TestCase):
         cls.config.get_agent_directory = mock.Mock(return_value="/tmp/deployd/")
         cls.config.get_builds_directory = mock.Mock(return_value="/tmp/deployd/builds/")
         cls.config.get_log_directory = mock.Mock(return_value="/tmp/logs/")
+        cls.config.get_max_concurrent_envs = mock.Mock(return_value=1)
         ensure_dirs(cls.config)
         cls.executor = mock.Mock()
         cls.executor.execute_command = mock.Mock(
@@ -686,6 +687,59 @@ class TestDeployAgent(TestCase):
         )
         self.assertEqual(agent._curr_report.report.status, AgentStatus.SUCCEEDED)
 
+    def test_clean_stale_builds_keeps_enabled_build_of_every_env(self):
+        envs = {}
+        for name, runtime_config in (("a", {"target": "/var/a"}), ("b", None)):
+            status = DeployStatus()
+            status.report = PingReport(jsonValue=dict(self.deploy_goal1, envName=name))
+            status.runtime_config = runtime_config
+            envs[name] = status
+        estatus = mock.Mock()
+        estatus.load_envs = mock.Mock(return_value=envs)
+        config = mock.Mock()
+        config.get_env_target.side_effect = lambda name, runtime_config: (
+            runtime_config or {}
+        ).get("target", "/tmp/" + name)
+        helper = mock.Mock()
+        helper.get_enabled_build.side_effect = lambda target: {
+            "/var/a": "build_a",
+            "/tmp/b": "build_b",
+        }[target]
+        agent = DeployAgent(
+            client=mock.Mock(),
+            estatus=estatus,
+            conf=config,
+            executor=self.executor,
+            helper=helper,
+        )
+        with mock.patch.object(agent, "clean_stale_files") as clean_stale_files:
+            agent.clean_stale_builds("a")
+        self.assertIn("build_a", clean_stale_files.call_args[0][2])
+        self.assertIn("build_b", clean_stale_files.call_args[0][2])
+
+    def test_long_poll_sleep_time(self):
+        config = mock.Mock()
+        config.get_ping_long_poll_seconds.return_value = 300
+        config.get_ping_long_poll_jitter.return_value = 5
+        config.get_daemon_sleep_time.return_value = 30
+        client = mock.Mock()
+        client.long_poll_held.return_value = True
+        estatus = mock.Mock()
+        estatus.load_envs = mock.Mock(return_value={})
+        agent = DeployAgent(
+            client=client,
+            estatus=estatus,
+            conf=config,
+            executor=self.executor,
+            helper=self.helper,
+        )
+        self.assertEqual(agent._get_sleep_time(), 30)
+
+        agent._enable_long_poll()
+        self.assertLessEqual(agent._get_sleep_time(), 5)
+        client.long_poll_held.return_value = False
+        self.assertEqual(agent._get_sleep_time(), 30)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,255 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+from unittest import mock
+from tests import TestCase
+
+from deployd.agent import DeployAgent
+from deployd.common.types import (
+    AgentStatus,
+    DeployReport,
+    DeployStage,
+    DeployStatus,
+    OpCode,
+    PingStatus,
+)
+from deployd.concurrent_deploy import ConcurrentDeploy, select_concurrent_goals
+from deployd.types.ping_response import PingResponse
+
+STAGES = [DeployStage.PRE_DOWNLOAD, DeployStage.POST_DOWNLOAD]
+
+
+def make_response(env_name, priority, stage=DeployStage.PRE_DOWNLOAD):
+    return PingResponse(
+        jsonValue={
+            "opCode": OpCode.DEPLOY,
+            "deployGoal": {
+                "deployId": "deploy-{}".format(env_name),
+                "envId": "id-{}".format(env_name),
+                "envName": env_name,
+                "stageName": "prod",
+                "deployStage": stage,
+                "systemPriority": priority,
+            },
+        }
+    )
+
+
+class FakeServer(object):
+    """Hand out STAGES to every env, ordered by priority"""
+
+    def __init__(self, priorities):
+        self._priorities = priorities
+
+    def get_deploy_candidates(self, envs):
+        candidates = []
+        for env_name, priority in sorted(
+            self._priorities.items(), key=lambda item: (item[1], item[0])
+        ):
+            stage = STAGES[0]
+            status = envs.get(env_name)
+            if status:
+                stage = status.report.deployStage
+                if status.report.status == AgentStatus.SUCCEEDED:
+                    if stage == STAGES[-1]:
+                        continue
+                    stage = STAGES[STAGES.index(stage) + 1]
+            candidates.append(make_response(env_name, priority, stage))
+        return candidates
+
+
+class FakeWorker(object):
+    lock = threading.Lock()
+    running = set()
+    max_running = 0
+    history = []
+
+    def __init__(self, agent, status, callback):
+        pass
+
+    def run(self, deploy_goal):
+        cls = FakeWorker
+        with cls.lock:
+            cls.running.add(deploy_goal.envName)
+            cls.max_running = max(cls.max_running, len(cls.running))
+            cls.history.append((deploy_goal.envName, set(cls.running)))
+        time.sleep(0.1)
+        with cls.lock:
+            cls.running.discard(deploy_goal.envName)
+        return DeployReport(AgentStatus.SUCCEEDED)
+
+
+class BarrierWorker(object):
+    """Fails unless two envs are in their stage at the same time"""
+
+    barrier = None
+
+    def __init__(self, agent, status, callback):
+        pass
+
+    def run(self, deploy_goal):
+        BarrierWorker.barrier.wait()
+        return DeployReport(AgentStatus.SUCCEEDED)
+
+
+class TestSelectConcurrentGoals(TestCase):
+    def test_same_priority_runs_together(self):
+        candidates = [
+            make_response("a", 1),
+            make_response("b", 1),
+            make_response("c", 2),
+        ]
+        selected = select_concurrent_goals(candidates, {}, 4)
+        self.assertEqual([r.deployGoal.envName for r in selected], ["a", "b"])
+        selected = select_concurrent_goals(candidates, {}, 1)
+        self.assertEqual([r.deployGoal.envName for r in selected], ["a"])
+        selected = select_concurrent_goals(candidates, {"a": 1}, 4)
+        self.assertEqual([r.deployGoal.envName for r in selected], ["b"])
+
+    def test_other_priority_waits(self):
+        candidates = [make_response("c", 2)]
+        self.assertEqual(select_concurrent_goals(candidates, {"a": 1}, 4), [])
+
+    def test_no_priority_runs_alone(self):
+        candidates = [make_response("a", None), make_response("b", None)]
+        selected = select_concurrent_goals(candidates, {}, 4)
+        self.assertEqual([r.deployGoal.envName for r in selected], ["a"])
+        self.assertEqual(select_concurrent_goals(candidates, {"a": None}, 4), [])
+        candidates = [make_response("b", 1)]
+        self.assertEqual(select_concurrent_goals(candidates, {"a": None}, 4), [])
+
+
+class TestConcurrentDeploy(TestCase):
+    def test_serve_build(self):
+        config = mock.Mock()
+        config.get_max_concurrent_envs = mock.Mock(return_value=3)
+        estatus = mock.Mock()
+        estatus.load_envs = mock.Mock(return_value=None)
+        helper = mock.Mock()
+        helper.get_stale_builds = mock.Mock(return_value=[])
+        client = FakeServer({"a": 1, "b": 1, "c": 1, "d": 2})
+        agent = DeployAgent(
+            client=client,
+            estatus=estatus,
+            conf=config,
+            executor=mock.Mock(),
+            helper=helper,
+        )
+        with (
+            mock.patch("deployd.concurrent_deploy.EnvWorker", FakeWorker),
+            mock.patch("deployd.agent.create_sc_timing") as create_sc_timing,
+        ):
+            agent.serve_build()
+
+        self.assertEqual(FakeWorker.max_running, 3)
+        self.assertEqual(len(FakeWorker.history), 8)
+        for env_name in "abcd":
+            report = agent._envs[env_name].report
+            self.assertEqual(report.deployStage, STAGES[-1])
+            self.assertEqual(report.status, AgentStatus.SUCCEEDED)
+        # every stage of every env is timed
+        for name in ("time_start_sec", "time_elapsed_sec"):
+            timed = [
+                (c[1]["tags"]["env_name"], c[1]["tags"]["deploy_stage"])
+                for c in create_sc_timing.call_args_list
+                if c[0][0] == "deployd.stats.deploy.stage." + name
+            ]
+            self.assertEqual(
+                sorted(timed),
+                sorted((env, stage) for env in "abcd" for stage in STAGES),
+            )
+        # d has another priority, it never ran next to the others
+        for env_name, running in FakeWorker.history:
+            if "d" in running:
+                self.assertEqual(running, {"d"})
+
+    def test_same_priority_goals_run_concurrently(self):
+        config = mock.Mock()
+        config.get_max_concurrent_envs = mock.Mock(return_value=2)
+        estatus = mock.Mock()
+        estatus.load_envs = mock.Mock(return_value=None)
+        helper = mock.Mock()
+        helper.get_stale_builds = mock.Mock(return_value=[])
+        # the goals carry the systemPriority of their env, as the server sends it
+        agent = DeployAgent(
+            client=FakeServer({"a": 10, "b": 10}),
+            estatus=estatus,
+            conf=config,
+            executor=mock.Mock(),
+            helper=helper,
+        )
+        BarrierWorker.barrier = threading.Barrier(2, timeout=5)
+        with mock.patch("deployd.concurrent_deploy.EnvWorker", BarrierWorker):
+            agent.serve_build()
+
+        self.assertFalse(BarrierWorker.barrier.broken)
+        for env_name in "ab":
+            report = agent._envs[env_name].report
+            self.assertEqual(report.deployStage, STAGES[-1])
+            self.assertEqual(report.status, AgentStatus.SUCCEEDED)
+
+    def test_failed_dump_fails_envs_in_flight(self):
+        agent = mock.Mock()
+        agent._envs = {"a": DeployStatus(make_response("a", 1))}
+        agent._env_status.dump_envs.return_value = False
+        agent._client.get_deploy_candidates.return_value = [make_response("a", 1)]
+        concurrent = ConcurrentDeploy(agent, 2)
+        concurrent._goals["a"] = make_response("a", 1).deployGoal
+
+        concurrent._ping()
+
+        self.assertEqual(agent._envs["a"].report.status, AgentStatus.AGENT_FAILED)
+        sent = agent._client.get_deploy_candidates.call_args[0][0]
+        self.assertEqual(sent["a"].report.status, AgentStatus.AGENT_FAILED)
+
+    def _concurrent_deploy(self, candidates):
+        agent = mock.Mock()
+        agent._envs = {"a": DeployStatus(make_response("a", 1))}
+        concurrent = ConcurrentDeploy(agent, 2)
+        concurrent._goals["a"] = make_response("a", 1).deployGoal
+        acquired = []
+
+        def try_lock():
+            if concurrent._lock.acquire(timeout=5):
+                acquired.append(True)
+                concurrent._lock.release()
+
+        def get_deploy_candidates(envs):
+            # another worker can update its env meanwhile
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            self.assertEqual(acquired, [True])
+            return candidates
+
+        agent._client.get_deploy_candidates.side_effect = get_deploy_candidates
+        return concurrent
+
+    def test_ping_env(self):
+        report = DeployReport(AgentStatus.SUCCEEDED)
+        concurrent = self._concurrent_deploy([make_response("a", 1)])
+        self.assertEqual(concurrent.ping_env("a", report), PingStatus.PLAN_NO_CHANGE)
+
+        concurrent = self._concurrent_deploy([])
+        self.assertEqual(concurrent.ping_env("a", report), PingStatus.PLAN_CHANGED)
+
+        concurrent = self._concurrent_deploy(None)
+        self.assertEqual(concurrent.ping_env("a", report), PingStatus.PING_FAILED)
+
+
+if __name__ == "__main__":
+    unittest.main()
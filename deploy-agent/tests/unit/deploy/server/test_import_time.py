@@ -0,0 +1,63 @@
+# Copyright 2016 Pinterest, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import subprocess
+import sys
+import unittest
+
+# cold start budget of deployd.agent, the import time of every agent run
+AGENT_IMPORT_BUDGET_US = 1000000
+
+
+# the agent takes its single instance lock at import, which it fails while
+# this test run, which imported deployd.agent, holds it
+SKIP_LOCK = "import deployd.common.single_instance as s; s.SingleInstance = object"
+
+
+def get_import_times(module) -> dict:
+    """Import module in a fresh interpreter, return {name: cumulative us}"""
+    code = "{}; import {}".format(SKIP_LOCK, module)
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in output.splitlines():
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    def test_agent_import_budget(self):
+        times = get_import_times("deployd.agent")
+        self.assertLess(times["deployd.agent"], AGENT_IMPORT_BUDGET_US)
+        for module in ("boto3", "botocore", "daemon"):
+            self.assertNotIn(module, times)
+
+    def test_child_imports(self):
+        times = get_import_times("deployd.download.downloader")
+        self.assertNotIn("boto3", times)
+        times = get_import_times("deployd.staging.stager")
+        self.assertNotIn("boto3", times)
+        self.assertNotIn("requests", times)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 from unittest import mock
+import errno
 import os.path
 import shutil
 import unittest
@@ -20,7 +21,8 @@ import tempfile
 import getpass
 
 from deployd.common.status_code import Status
-from deployd.staging.stager import Stager
+from deployd.staging.stager import Stager, link_tree
+from deployd.staging.transformer import Transformer
 
 
 class TestStagingHelper(unittest.TestCase):
@@ -52,6 +54,7 @@ class TestStagingHelper(unittest.TestCase):
         cls.config.get_var = mock.MagicMock(side_effect=mock_get_var)
         cls.config.get_target = mock.MagicMock(return_value=target)
         cls.config.get_builds_directory = mock.MagicMock(return_value=builds_dir)
+        cls.config.get_link_script_templates = mock.MagicMock(return_value=False)
         cls.transformer = mock.Mock()
         cls.transformer.dict_size = mock.Mock(return_value=1)
         cls.transformer.transform_scripts = mock.Mock()
@@ -124,3 +127,55 @@ class TestStagingHelper(unittest.TestCase):
         # now let's make our missing_target a real target!
         os.mkdir(missing_target)
         self.assertEqual("foo", stager.get_enabled_build())
+
+    @mock.patch("deployd.staging.transformer.IS_PINTEREST", True)
+    def test_link_tree(self):
+        script_dir = os.path.join(self.base_dir, "link", "teletraan")
+        template_dir = os.path.join(self.base_dir, "link", "teletraan_template")
+        os.makedirs(os.path.join(script_dir, "sub"))
+        for name, content in (
+            ("plain", "echo plain"),
+            ("sub/config", "$TELETRAAN_foo"),
+        ):
+            with open(os.path.join(script_dir, name), "w") as f:
+                f.write(content)
+        with open(os.path.join(self.base_dir, "link_SCRIPT_CONFIG"), "w") as f:
+            f.write("foo = bar\n")
+
+        self.assertEqual(link_tree(script_dir, template_dir), 0)
+        Transformer(agent_dir=self.base_dir, env_name="link").transform_scripts(
+            template_dir, "teletraan_template", "teletraan"
+        )
+
+        plain = os.path.join(script_dir, "plain")
+        self.assertTrue(os.path.samefile(plain, os.path.join(template_dir, "plain")))
+        config = os.path.join(script_dir, "sub", "config")
+        template = os.path.join(template_dir, "sub", "config")
+        self.assertFalse(os.path.samefile(config, template))
+        with open(config) as f:
+            self.assertEqual(f.read(), "bar")
+        with open(template) as f:
+            self.assertEqual(f.read(), "$TELETRAAN_foo")
+
+    @mock.patch(
+        "deployd.common.utils.os.link",
+        side_effect=OSError(errno.EXDEV, "cross-device link"),
+    )
+    def test_link_tree_copy_keeps_stat(self, mock_link):
+        script_dir = os.path.join(self.base_dir, "copy", "teletraan")
+        template_dir = os.path.join(self.base_dir, "copy", "teletraan_template")
+        os.makedirs(script_dir)
+        script = os.path.join(script_dir, "RESTARTING")
+        with open(script, "w") as f:
+            f.write("echo restarting")
+        os.chmod(script, 0o750)
+        os.utime(script, (1400000000, 1400000000))
+        os.utime(script_dir, (1400000000, 1400000000))
+
+        link_tree(script_dir, template_dir)
+
+        template = os.path.join(template_dir, "RESTARTING")
+        self.assertFalse(os.path.samefile(script, template))
+        self.assertEqual(os.stat(template).st_mode, os.stat(script).st_mode)
+        self.assertEqual(os.stat(template).st_mtime, 1400000000)
+        self.assertEqual(os.stat(template_dir).st_mtime, 1400000000)
@@ -17,6 +17,7 @@ import os.path
 import shutil
 import unittest
 import tempfile
+from unittest import mock
 
 from deployd.staging.transformer import Transformer
 
@@ -122,3 +123,77 @@ class TransformTest(unittest.TestCase):
                 key, value = line.split("=")
                 newline = "%s=%s\n" % (key, values[key])
                 self.assertEqual(line, newline)
+
+    def test_skip_unchanged_templates(self):
+        transformer = Transformer(agent_dir=self.base_dir, env_name="123")
+        transformer.transform_scripts(
+            self.template_dir, self.template_dir, self.script_dir
+        )
+        fn2 = os.path.join(self.script_dir, "test2")
+        with mock.patch.object(transformer, "translate") as translate:
+            transformer.transform_scripts(
+                self.template_dir, self.template_dir, self.script_dir
+            )
+            self.assertFalse(translate.called)
+
+            # a new file behind the same path is translated again
+            os.remove(fn2)
+            with open(fn2, "w") as f:
+                f.write("an untransformed script")
+            transformer.transform_scripts(
+                self.template_dir, self.template_dir, self.script_dir
+            )
+            self.assertEqual(translate.call_count, 1)
+
+        # so is every template once the script config changes
+        with open(os.path.join(self.base_dir, "123_SCRIPT_CONFIG"), "a") as f:
+            f.write("Wh-O = test4\n")
+        transformer = Transformer(agent_dir=self.base_dir, env_name="123")
+        transformer.transform_scripts(
+            self.template_dir, self.template_dir, self.script_dir
+        )
+        with open(fn2, "r") as f:
+            self.assertEqual(f.read(), '$TEST="test4"')
+
+    def test_skip_binary_files(self):
+        with open(os.path.join(self.template_dir, "binary.tmpl"), "wb") as f:
+            f.write(b"\x7fELF\x00$TELETRAAN_foo")
+        transformer = Transformer(agent_dir=self.base_dir, env_name="123")
+        transformer.transform_scripts(
+            self.template_dir, self.template_dir, self.script_dir
+        )
+        self.assertFalse(os.path.exists(os.path.join(self.script_dir, "binary")))
+        self.assertTrue(os.path.exists(os.path.join(self.script_dir, "test2")))
+
+    def test_translate_in_thread_pool(self):
+        transformer = Transformer(
+            agent_dir=self.base_dir, env_name="123", max_workers=4
+        )
+        transformer.transform_scripts(
+            self.template_dir, self.template_dir, self.script_dir
+        )
+        with open(os.path.join(self.script_dir, "test2"), "r") as f:
+            self.assertEqual(f.read(), '$TEST="test2"')
+
+    def test_translate_escape(self):
+        transformer = Transformer(agent_dir=self.base_dir, env_name="123")
+        self.assertEqual(
+            transformer.translate("$TELETRAAN_$TELETRAAN_foo $TELETRAAN_{foo}"),
+            "$TELETRAAN_foo bar",
+        )
+
+    def test_translate_values_referencing_variables(self):
+        with open(os.path.join(self.base_dir, "456_SCRIPT_CONFIG"), "w") as f:
+            f.writelines(["A = $TELETRAAN_B\n", "B = bee\n"])
+        transformer = Transformer(agent_dir=self.base_dir, env_name="456")
+        self.assertEqual(transformer.translate("${TELETRAAN_A}"), "bee")
+        self.assertEqual(transformer.translate("{$TELETRAAN_A}"), "bee")
+
+    def test_translate_defaults_referencing_variables(self):
+        with open(os.path.join(self.base_dir, "456_SCRIPT_CONFIG"), "w") as f:
+            f.writelines(["B = bee\n"])
+        transformer = Transformer(agent_dir=self.base_dir, env_name="456")
+        self.assertEqual(transformer.translate("${TELETRAAN_Z:$TELETRAAN_B}"), "bee")
+        self.assertEqual(
+            transformer.translate("{$TELETRAAN_Z:$TELETRAAN_B/x}"), "bee/x"
+        )
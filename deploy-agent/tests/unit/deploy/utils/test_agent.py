@@ -111,6 +111,24 @@ class TestAgentHelperFunctions(tests.FileTestCase):
             "cmp_test",
         )
 
+    def test_get_num_builds_retain(self):
+        config = mock.Mock()
+        config.get_num_builds_retain = mock.Mock(return_value=2)
+        config.get_max_builds_retain = mock.Mock(return_value=5)
+        config.get_disk_low_watermark = mock.Mock(return_value=50)
+        config.get_disk_high_watermark = mock.Mock(return_value=90)
+        helper = Helper(config)
+        for used, retain in ((10, 5), (70, 2), (95, 1)):
+            usage = mock.Mock(total=100, used=used)
+            with mock.patch("shutil.disk_usage", return_value=usage):
+                self.assertEqual(helper.get_num_builds_retain(self.builds_dir), retain)
+
+    def test_get_enabled_build(self):
+        target = os.path.join(self.builds_dir, "target")
+        self.assertIsNone(Helper.get_enabled_build(target))
+        os.symlink(os.path.join(self.builds_dir, "abc123"), target)
+        self.assertEqual(Helper.get_enabled_build(target), "abc123")
+
     def test_get_uptime(self):
         """
         Test utils.uptime()
@@ -32,6 +32,7 @@ public class DeployGoalBean {
     private Map<String, String> scriptVariables;
     private Boolean firstDeploy;
     private Boolean isDocker;
+    private Integer systemPriority;
 
     public String getDeployId() {
         return deployId;
@@ -137,6 +138,14 @@ public class DeployGoalBean {
         this.isDocker = isDocker;
     }
 
+    public Integer getSystemPriority() {
+        return systemPriority;
+    }
+
+    public void setSystemPriority(Integer systemPriority) {
+        this.systemPriority = systemPriority;
+    }
+
     @Override
     public String toString() {
         return ReflectionToStringBuilder.toString(this);
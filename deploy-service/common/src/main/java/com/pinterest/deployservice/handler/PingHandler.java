@@ -1036,6 +1036,8 @@ public class PingHandler {
         LOG.debug("stage type: {}", envBean.getStage_type());
         goal.setStageType(envBean.getStage_type());
         goal.setIsDocker(envBean.getIs_docker());
+        // agents deploy the goals of the same system priority concurrently
+        goal.setSystemPriority(envBean.getSystem_priority());
 
         // TODO optimize the next stage here based on deploy ( some deploy does not have all the
         // stages )
@@ -17,7 +17,13 @@ package com.pinterest.deployservice.handler;
 
 import static org.junit.jupiter.api.Assertions.assertEquals;
 
+import com.pinterest.deployservice.ServiceContext;
+import com.pinterest.deployservice.bean.AgentBean;
+import com.pinterest.deployservice.bean.DeployGoalBean;
+import com.pinterest.deployservice.bean.DeployStage;
+import com.pinterest.deployservice.bean.DeployType;
 import com.pinterest.deployservice.bean.EnvironBean;
+import java.util.Collections;
 import org.junit.jupiter.api.Test;
 
 public class PingHandlerTest {
@@ -53,4 +59,41 @@ public class PingHandlerTest {
         assertEquals(10, PingHandler.calculateParallelThreshold(bean, 2, 1), 10);
         assertEquals(10, PingHandler.calculateParallelThreshold(bean, 2, 1), 100);
     }
+
+    @Test
+    public void installResponseCarriesSystemPriority() throws Exception {
+        PingHandler pingHandler = new PingHandler(new ServiceContext());
+        GoalAnalyst analyst =
+                new GoalAnalyst(
+                        null,
+                        null,
+                        null,
+                        null,
+                        null,
+                        "host",
+                        "host-id",
+                        Collections.emptyMap(),
+                        Collections.emptyMap(),
+                        Collections.emptyMap(),
+                        null);
+        for (Integer priority : new Integer[] {10, null}) {
+            EnvironBean env = new EnvironBean();
+            env.setEnv_id("env-id");
+            env.setEnv_name("sidecar");
+            env.setStage_name("prod");
+            env.setDeploy_id("deploy-id");
+            env.setDeploy_type(DeployType.REGULAR);
+            env.setSystem_priority(priority);
+            AgentBean updateBean = new AgentBean();
+            updateBean.setDeploy_stage(DeployStage.PRE_DOWNLOAD);
+
+            DeployGoalBean goal =
+                    pingHandler
+                            .generateInstallResponse(
+                                    analyst.new InstallCandidate(env, false, updateBean, null))
+                            .getDeployGoal();
+            // agents run the goals of one system priority side by side
+            assertEquals(priority, goal.getSystemPriority());
+        }
+    }
 }